@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+
+from aiohttp import web
+
+from error import ApiErrorCode, ApiServiceUnavailableError
+from limiter import ConcurrencyLimiter
+from monitoring import inc_admission_shed, set_admission_in_flight, set_admission_limit
+
+# requests of other routes (/metrics, docs) are not limited
+ROUTE_CLASSES = {
+    '/v1/inventory/get': 'reads',
+    '/v1/inventory/get_batch': 'reads',
+    '/v1/inventory/catalog/get': 'reads',
+    '/v1/inventory/grant': 'grants',
+    '/v1/inventory/grant_batch': 'grants',
+    '/v1/inventory/consume': 'grants',
+    '/internal/inventory/grant_stored_trx': 'grants',
+}
+DEFAULT_ROUTE_CLASS_SETTINGS = {
+    'reads': {'initial_limit': 64, 'min_limit': 4, 'max_limit': 512, 'target_latency_ms': 20},
+    'grants': {'initial_limit': 32, 'min_limit': 2, 'max_limit': 256, 'target_latency_ms': 50},
+}
+# remaining time budget of the client, a request can't wait in the queue longer than that
+DEADLINE_HEADER = 'X-Request-Timeout-Ms'
+
+
+# Concurrency limit of a route class adapted by AIMD: after every window_size finished requests
+# the limit is multiplied by backoff_ratio if their mean latency is above target_latency_ms,
+# otherwise it grows by one if the limit was reached in the window.
+class AdaptiveLimit:
+    def __init__(self, route_class, initial_limit, min_limit, max_limit, target_latency_ms,
+                 window_size=100, backoff_ratio=0.9):
+        self.route_class = route_class
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency_ms / 1000.0
+        self.window_size = window_size
+        self.backoff_ratio = backoff_ratio
+        self.limiter = ConcurrencyLimiter(max(min_limit, min(max_limit, initial_limit)))
+        self._reset_window()
+        set_admission_limit(route_class, self.limiter.limit)
+
+    def _reset_window(self):
+        self.samples = 0
+        self.latency_sum = 0.0
+        self.peak_in_flight = 0
+
+    def acquired(self):
+        in_flight = self.limiter.in_use
+        if in_flight > self.peak_in_flight:
+            self.peak_in_flight = in_flight
+        set_admission_in_flight(self.route_class, in_flight)
+
+    def release(self, latency):
+        self.limiter.release()
+        set_admission_in_flight(self.route_class, self.limiter.in_use)
+        self.samples += 1
+        self.latency_sum += latency
+        if self.samples >= self.window_size:
+            self.adjust()
+
+    def adjust(self):
+        mean_latency = self.latency_sum / self.samples if self.samples else 0.0
+        limit = self.limiter.limit
+        if mean_latency > self.target_latency:
+            limit = int(limit * self.backoff_ratio)
+        elif self.peak_in_flight >= limit:
+            limit += 1
+        limit = max(self.min_limit, min(self.max_limit, limit))
+        if limit != self.limiter.limit:
+            logging.debug('Admission limit of %s changed from %s to %s, mean latency %.2fms',
+                          self.route_class, self.limiter.limit, limit, mean_latency * 1000)
+            self.limiter.set_limit(limit)
+            set_admission_limit(self.route_class, limit)
+        self._reset_window()
+
+
+def get_queue_timeout(request, max_queue_ms):
+    timeout_ms = max_queue_ms
+    deadline = request.headers.get(DEADLINE_HEADER)
+    if deadline is not None:
+        try:
+            timeout_ms = min(timeout_ms, float(deadline))
+        except ValueError:
+            pass
+    return timeout_ms / 1000.0
+
+
+def shed(limit, reason, queue_timeout):
+    inc_admission_shed(limit.route_class, reason)
+    return ApiServiceUnavailableError(
+        error_message='Server is overloaded',
+        error_code=ApiErrorCode.overloaded,
+        context={'route_class': limit.route_class, 'reason': reason, 'queue_timeout_ms': queue_timeout * 1000}
+    )
+
+
+def create_limits(settings):
+    route_class_settings = settings.get('route_classes', {})
+    limits = {}
+    for route_class, defaults in DEFAULT_ROUTE_CLASS_SETTINGS.items():
+        class_settings = {**defaults, **route_class_settings.get(route_class, {})}
+        limits[route_class] = AdaptiveLimit(
+            route_class,
+            window_size=settings.get('window_size', 100),
+            backoff_ratio=settings.get('backoff_ratio', 0.9),
+            **class_settings
+        )
+    return {path: limits[route_class] for path, route_class in ROUTE_CLASSES.items()}
+
+
+# Requests over the limit of their route class wait in FIFO queue for max_queue_ms at most
+# (or less when the client sends its own deadline), then fail with 503 before reaching handlers,
+# so under overload the service answers fast instead of piling up tasks waiting for DB.
+def make_admission_middleware(limits, max_queue_ms=50, max_queue_size=1000):
+    @web.middleware
+    async def admission_middleware(request: web.Request, handler) -> web.StreamResponse:
+        limit = limits.get(request.path)
+        if limit is None:
+            return await handler(request)
+        limiter = limit.limiter
+        if limiter.in_use < limiter.limit and not limiter.waiting:
+            await limiter.acquire()
+        else:
+            queue_timeout = get_queue_timeout(request, max_queue_ms)
+            if queue_timeout <= 0:
+                raise shed(limit, 'deadline', queue_timeout)
+            if limiter.waiting >= max_queue_size:
+                raise shed(limit, 'queue_full', queue_timeout)
+            try:
+                await asyncio.wait_for(limiter.acquire(), queue_timeout)
+            except asyncio.TimeoutError:
+                raise shed(limit, 'deadline', queue_timeout)
+        limit.acquired()
+        started = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            limit.release(time.perf_counter() - started)
+
+    return admission_middleware
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import uuid
+
+import asyncpg
+
+from monitoring import (
+    inc_cache_invalidation_published, inc_cache_invalidation_received, inc_cache_invalidation_reconnect
+)
+
+# pg_notify payload is limited to 8000 bytes, player ids are sent in chunks well below that
+PLAYER_IDS_PER_NOTIFICATION = 300
+
+
+# Keeps inventory caches of all workers coherent. Player ids of committed grants are
+# coalesced and published over pg_notify in batches through a dedicated connection,
+# which also LISTENs for invalidations published by other workers.
+# If the connection drops, the local cache is flushed and bypassed until the listener is back.
+class CacheInvalidationChannel:
+    def __init__(self, cache, connect_settings, channel='inventory_cache_invalidation', notify_interval_ms=20,
+                 reconnect_interval_seconds=1.0, healthcheck_interval_seconds=5.0):
+        self.cache = cache
+        self.connect_settings = connect_settings
+        self.channel = channel
+        self.notify_interval = notify_interval_ms / 1000.0
+        self.reconnect_interval = reconnect_interval_seconds
+        self.healthcheck_interval = healthcheck_interval_seconds
+        self.sender_id = uuid.uuid4().hex[:12]
+        self._pending = set()
+        self._conn = None
+        self._task = None
+
+    def start(self):
+        self.cache.suspend()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn is not None and not self._conn.is_closed():
+            try:
+                await self._publish_pending()
+            except Exception:
+                logging.exception('Failed to publish pending cache invalidations on shutdown')
+        await self._disconnect()
+
+    def publish(self, player_id):
+        self._pending.add(player_id)
+
+    async def _run(self):
+        while True:
+            try:
+                await self._connect()
+                await self._publish_loop()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception('Cache invalidation listener failed, inventory cache is flushed and bypassed '
+                                  'until it reconnects')
+            self.cache.suspend()
+            await self._disconnect()
+            inc_cache_invalidation_reconnect()
+            await asyncio.sleep(self.reconnect_interval)
+
+    async def _connect(self):
+        self._conn = await asyncpg.connect(**self.connect_settings)
+        await self._conn.add_listener(self.channel, self._on_notification)
+        # invalidations sent before LISTEN was active are lost, start from the empty cache
+        self.cache.resume()
+        logging.info('Cache invalidation listener connected to channel %s', self.channel)
+
+    async def _disconnect(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if not conn.is_closed():
+            conn.terminate()
+
+    async def _publish_loop(self):
+        loop = asyncio.get_running_loop()
+        next_healthcheck = loop.time() + self.healthcheck_interval
+        while not self._conn.is_closed():
+            await asyncio.sleep(self.notify_interval)
+            await self._publish_pending()
+            if loop.time() >= next_healthcheck:
+                await self._conn.fetchval('SELECT 1', timeout=self.healthcheck_interval)
+                next_healthcheck = loop.time() + self.healthcheck_interval
+        raise ConnectionError('Cache invalidation listener connection is closed')
+
+    async def _publish_pending(self):
+        if not self._pending:
+            return
+        player_ids, self._pending = list(self._pending), set()
+        payloads = [
+            self.sender_id + ':' + ','.join(str(player_id) for player_id in
+                                            player_ids[i:i + PLAYER_IDS_PER_NOTIFICATION])
+            for i in range(0, len(player_ids), PLAYER_IDS_PER_NOTIFICATION)
+        ]
+        try:
+            await self._conn.execute("""
+                SELECT pg_notify($1, payload) FROM unnest($2::text[]) AS payload
+            """, self.channel, payloads)
+        except Exception:
+            # keep them for the next attempt after reconnect
+            self._pending.update(player_ids)
+            raise
+        inc_cache_invalidation_published(len(payloads), len(player_ids))
+
+    def _on_notification(self, _conn, _pid, _channel, payload):
+        sender_id, _, player_ids = payload.partition(':')
+        if sender_id == self.sender_id or not player_ids:
+            return
+        player_ids = player_ids.split(',')
+        for player_id in player_ids:
+            self.cache.invalidate(int(player_id))
+        inc_cache_invalidation_received(len(player_ids))
@@ -0,0 +1,168 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import time
+import types
+
+import serializer
+import statements
+from error import ApiValidationError
+from monitoring import inc_catalog_reload, set_catalog_items
+
+BASE_PARAMS_COUNT = 5
+PARAM_TYPES = ('int', 'str', 'bool', 'float')
+TRUE_VALUES = frozenset(('true', 't', '1', 'yes'))
+FALSE_VALUES = frozenset(('false', 'f', '0', 'no'))
+
+
+def parse_bool(value):
+    value = value.strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError(f'invalid bool {value!r}')
+
+
+PARAM_CONVERTERS = {'int': int, 'str': str, 'bool': parse_bool, 'float': float}
+
+
+def convert_param(param_type, value):
+    # base_param*_value columns are varchar, values are typed by base_param*_type
+    if value is None or param_type is None:
+        return value
+    return PARAM_CONVERTERS[param_type](value)
+
+
+def load_item(row):
+    base_params = {}
+    for i in range(1, BASE_PARAMS_COUNT + 1):
+        name = row[f'base_param{i}_name']
+        if name is None:
+            continue
+        value = row[f'base_param{i}_value']
+        try:
+            base_params[name] = convert_param(row[f'base_param{i}_type'], value)
+        except ValueError:
+            logging.warning('Catalog item %s has base_param%s %s of type %s with value %r, kept as string',
+                            row['item_code'], i, name, row[f'base_param{i}_type'], value)
+            base_params[name] = value
+    # i18n is json, not jsonb, so it comes as text
+    i18n = row['i18n']
+    if isinstance(i18n, str):
+        i18n = serializer.loads(i18n)
+    return {
+        'item_code': row['item_code'],
+        'inventory_type': row['inventory_type'],
+        'item_rarity': row['item_rarity'],
+        'gd_description': row['gd_description'],
+        'base_param_array': row['base_param_array'],
+        'base_params': base_params,
+        'ext_params': row['ext_params'] or {},
+        'i18n': i18n or {},
+    }
+
+
+# Immutable view of the whole catalog. Items are converted and the catalog response is serialized
+# once per snapshot. The version is a hash of the items, so it is the same in every worker and
+# after restarts, and is used as ETag.
+class CatalogSnapshot:
+    def __init__(self, items):
+        self.items = types.MappingProxyType(items)
+        items_json = serializer.dumps(list(items.values()))
+        self.version = hashlib.blake2b(items_json, digest_size=8).hexdigest()
+        self.etag = f'"{self.version}"'
+        self.body = b''.join((b'{"status": "OK", "data": {"version": "', self.version.encode(), b'", "items": ',
+                              items_json, b'}}'))
+        self.loaded_at = time.time()
+
+    @functools.cached_property
+    def msgpack_body(self):
+        # built on the first msgpack request, json-only clients don't pay for it
+        return serializer.msgpack_dumps({'status': 'OK', 'data': {'version': self.version,
+                                                                  'items': list(self.items.values())}})
+
+    @property
+    def msgpack_etag(self):
+        return f'"{self.version}-msgpack"'
+
+
+# Holds the current snapshot of game_inventory_dict. Readers take app.catalog.snapshot and never
+# see a half-loaded catalog, reload() builds a new snapshot and swaps the reference. Catalog
+# writes reload it right away in the worker which made them, other workers pick changes up
+# every refresh_interval_seconds.
+class Catalog:
+    def __init__(self, db_pool, refresh_interval_seconds=30.0):
+        self.db_pool = db_pool
+        self.refresh_interval = refresh_interval_seconds
+        self.snapshot = CatalogSnapshot({})
+        self._reload_lock = asyncio.Lock()
+        self._task = None
+
+    async def start(self):
+        await self.reload()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.reload()
+            except Exception:
+                inc_catalog_reload('failed')
+                logging.exception('Failed to reload catalog, version %s is kept', self.snapshot.version)
+
+    async def reload(self):
+        # reloads run one by one, so a reload started after a write always wins
+        async with self._reload_lock:
+            async with self.db_pool.acquire() as conn:
+                rows = await conn.fetch(statements.GET_CATALOG)
+            snapshot = CatalogSnapshot({row['item_code']: load_item(row) for row in rows})
+            if snapshot.version == self.snapshot.version:
+                inc_catalog_reload('unchanged')
+                return
+            logging.info('Catalog changed from version %s to %s, %s items', self.snapshot.version,
+                         snapshot.version, len(snapshot.items))
+            self.snapshot = snapshot
+            inc_catalog_reload('changed')
+            set_catalog_items(len(snapshot.items))
+
+
+def parse_catalog_item(data):
+    # arguments of INSERT_CATALOG_ITEM and UPDATE_CATALOG_ITEM, values are checked against their types
+    # here, so the snapshot never has to keep a value it can't convert
+    missing = [name for name in ('item_code', 'inventory_type', 'item_rarity', 'gd_description')
+               if data.get(name) is None]
+    if missing:
+        raise ApiValidationError(error_message='Missing catalog item fields', context={'missing': missing})
+    args = [data['item_code'], data['inventory_type'], data['item_rarity'], data['gd_description'],
+            data.get('base_param_array')]
+    errors = {}
+    for i in range(1, BASE_PARAMS_COUNT + 1):
+        name, param_type, value = (data.get(f'base_param{i}_name'), data.get(f'base_param{i}_type'),
+                                   data.get(f'base_param{i}_value'))
+        if param_type is not None and param_type not in PARAM_TYPES:
+            errors[f'base_param{i}_type'] = f"must be one of {', '.join(PARAM_TYPES)}"
+        elif name is not None and param_type is None:
+            errors[f'base_param{i}_type'] = 'required with a name'
+        else:
+            try:
+                convert_param(param_type, value)
+            except ValueError:
+                errors[f'base_param{i}_value'] = f'not {param_type}'
+        args += [name, param_type, value]
+    if errors:
+        raise ApiValidationError(error_message='Invalid catalog item params', context=errors)
+    i18n = data.get('i18n')
+    args += [data.get('ext_params'), serializer.dumps(i18n).decode('utf-8') if i18n is not None else None]
+    return args
@@ -0,0 +1,63 @@
+import logging
+
+import asyncpg
+
+import statements
+from error import ApiErrorCode, ApiLogicalError
+from event_log_writer import make_event
+
+
+class Consume:
+    def __init__(self, player_id, item_code, amount, ext_trx_id):
+        self.player_id = player_id
+        self.item_code = item_code
+        self.amount = amount
+        self.ext_trx_id = ext_trx_id
+
+
+def insufficient_amount_error(consume):
+    return ApiLogicalError(
+        error_message='Not enough items to consume',
+        error_code=ApiErrorCode.insufficient_amount,
+        context={'player_id': consume.player_id, 'item_code': consume.item_code, 'amount': consume.amount}
+    )
+
+
+def log_duplicate_consume(consume):
+    logging.info('Duplicate request detected when trying to consume player_id: %s, item_code: %s, '
+                 'ext_trx_id: %s', consume.player_id, consume.item_code, consume.ext_trx_id)
+
+
+def log_consume(consume):
+    logging.info('Inventory consumed for player_id: %s, item_code: %s, amount: %s, ext_trx_id: %s',
+                 consume.player_id, consume.item_code, consume.amount, consume.ext_trx_id)
+
+
+def consume_event(consume, inventory_type):
+    return make_event(consume.player_id, 'inventory_consumed', consume.amount,
+                      {'inventory_type': inventory_type, 'item_code': consume.item_code}, consume.ext_trx_id)
+
+
+# Consumes in its own transaction, returns inventory_type of the item or None for a duplicate.
+# Not enough items raises 420 and rolls back the ext_trx_id, so the same consume can be retried
+# after a grant.
+async def write_consume(conn, consume, log_events=True):
+    async with conn.transaction():
+        try:
+            await conn.fetchrow(statements.INSERT_INVENTORY_TRX, consume.player_id, consume.ext_trx_id)
+        except asyncpg.exceptions.IntegrityConstraintViolationError:
+            log_duplicate_consume(consume)
+            return None
+
+        row = await conn.fetchrow(statements.CONSUME_INVENTORY, consume.player_id, consume.item_code,
+                                  consume.amount)
+        if row is None:
+            raise insufficient_amount_error(consume)
+        log_consume(consume)
+
+        if log_events:
+            await conn.execute(statements.INSERT_PLAYER_EVENT, consume.player_id, 'inventory_consumed',
+                               consume.amount, {'inventory_type': row['inventory_type'],
+                                                'item_code': consume.item_code},
+                               consume.ext_trx_id)
+    return row['inventory_type']
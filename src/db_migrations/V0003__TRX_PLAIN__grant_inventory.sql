@@ -0,0 +1,109 @@
+CREATE TYPE grant_status AS ENUM ('inserted', 'updated', 'duplicate');
+
+-- Grants one item in one round-trip. Unlike insert_inventory() a duplicate ext_trx_id is
+-- reported in the result, so the caller's transaction is not aborted.
+CREATE OR REPLACE FUNCTION grant_inventory(
+    _player_id bigint,
+    _ext_trx_id varchar(40),
+    _inventory_type inventory_type,
+    _item_code varchar(20),
+    _amount bigint,
+    _log_event boolean DEFAULT true
+)
+RETURNS grant_status AS $$
+DECLARE
+    _inserted boolean;
+BEGIN
+    IF _ext_trx_id IS NULL THEN
+        RETURN 'duplicate';
+    END IF;
+    INSERT INTO player_inventory_trx (player_id, ext_trx_id) VALUES (_player_id, _ext_trx_id)
+        ON CONFLICT (player_id, ext_trx_id) DO NOTHING;
+    IF NOT FOUND THEN
+        RETURN 'duplicate';
+    END IF;
+    INSERT INTO player_inventory (player_id, inventory_type, item_code, amount)
+        VALUES (_player_id, _inventory_type, _item_code, _amount)
+        ON CONFLICT (player_id, item_code)
+        DO UPDATE SET amount = player_inventory.amount + EXCLUDED.amount
+        RETURNING (xmax = 0) INTO _inserted;
+    IF _log_event THEN
+        INSERT INTO log_player_event
+            (player_id, event_type, event_value_int, meta_data, ext_trx_id)
+        VALUES (_player_id, 'inventory_granted', _amount,
+                jsonb_build_object('inventory_type', _inventory_type, 'item_code', _item_code), _ext_trx_id);
+    END IF;
+    IF _inserted THEN
+        RETURN 'inserted';
+    END IF;
+    RETURN 'updated';
+END;
+$$ LANGUAGE plpgsql;
+
+-- Grants many items with one statement, arrays are grants in columns. Returns a status for every
+-- grant by its 1-based position. Same rules as write_grants() in grants.py: only the first grant with
+-- an idempotency key is granted, amounts of one item are summed before the upsert.
+CREATE OR REPLACE FUNCTION grant_inventory_batch(
+    _player_ids bigint[],
+    _ext_trx_ids varchar[],
+    _inventory_types inventory_type[],
+    _item_codes varchar[],
+    _amounts bigint[],
+    _log_events boolean DEFAULT true
+)
+RETURNS TABLE (idx bigint, status grant_status) AS $$
+#variable_conflict use_column
+BEGIN
+    RETURN QUERY
+    WITH input AS (
+        SELECT * FROM unnest(_player_ids, _ext_trx_ids, _inventory_types, _item_codes, _amounts)
+            WITH ORDINALITY AS t(player_id, ext_trx_id, inventory_type, item_code, amount, idx)
+    ),
+    first_seen AS (
+        SELECT DISTINCT ON (i.player_id, i.ext_trx_id) i.*
+        FROM input i
+        WHERE i.ext_trx_id IS NOT NULL
+        ORDER BY i.player_id, i.ext_trx_id, i.idx
+    ),
+    trx AS (
+        -- sorted keys keep lock order stable between concurrent batches
+        INSERT INTO player_inventory_trx (player_id, ext_trx_id)
+        SELECT f.player_id, f.ext_trx_id FROM first_seen f ORDER BY f.player_id, f.ext_trx_id
+        ON CONFLICT (player_id, ext_trx_id) DO NOTHING
+        RETURNING player_inventory_trx.player_id, player_inventory_trx.ext_trx_id
+    ),
+    granted AS (
+        SELECT f.*
+        FROM first_seen f
+            JOIN trx ON trx.player_id = f.player_id AND trx.ext_trx_id = f.ext_trx_id
+    ),
+    upserted AS (
+        INSERT INTO player_inventory (player_id, inventory_type, item_code, amount)
+        SELECT g.player_id, (array_agg(g.inventory_type ORDER BY g.idx))[1], g.item_code, sum(g.amount)::bigint
+        FROM granted g
+        GROUP BY g.player_id, g.item_code
+        ORDER BY g.player_id, g.item_code
+        ON CONFLICT (player_id, item_code)
+        DO UPDATE SET amount = player_inventory.amount + EXCLUDED.amount
+        RETURNING player_inventory.player_id, player_inventory.item_code, (player_inventory.xmax = 0) AS inserted
+    ),
+    events AS (
+        INSERT INTO log_player_event
+            (player_id, event_type, event_value_int, meta_data, ext_trx_id)
+        SELECT g.player_id, 'inventory_granted', g.amount,
+               jsonb_build_object('inventory_type', g.inventory_type, 'item_code', g.item_code), g.ext_trx_id
+        FROM granted g
+        WHERE _log_events
+    )
+    SELECT i.idx,
+           CASE
+               WHEN g.idx IS NULL THEN 'duplicate'::grant_status
+               WHEN u.inserted THEN 'inserted'::grant_status
+               ELSE 'updated'::grant_status
+           END
+    FROM input i
+        LEFT JOIN granted g ON g.idx = i.idx
+        LEFT JOIN upserted u ON u.player_id = g.player_id AND u.item_code = g.item_code
+    ORDER BY i.idx;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,5 @@
+-- Event history of one player is read by (player_id, event_time) range and paged by (event_time, id).
+-- An index on the partitioned table is created on every existing partition and on partitions
+-- created later by ensure_partitions_created.py.
+CREATE INDEX IF NOT EXISTS idx_log_player_event_player_id_event_time ON
+    log_player_event (player_id, event_time, id);
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import time
+
+from error import ApiServiceUnavailableError
+from monitoring import (
+    inc_db_pool_acquire_timeout, record_db_pool_acquire, record_db_pool_release, set_db_pool_limit
+)
+
+
+# Connection handed out by InstrumentedPool.acquire(). Counts statements run through it, other
+# attributes (transaction(), cursor() etc.) are passed to the asyncpg connection.
+class CountingConnection:
+    __slots__ = ('_conn', 'queries')
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.queries = 0
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    # coroutines of the asyncpg connection are returned as they are, no extra frame per query
+    def fetch(self, *args, **kwargs):
+        self.queries += 1
+        return self._conn.fetch(*args, **kwargs)
+
+    def fetchrow(self, *args, **kwargs):
+        self.queries += 1
+        return self._conn.fetchrow(*args, **kwargs)
+
+    def fetchval(self, *args, **kwargs):
+        self.queries += 1
+        return self._conn.fetchval(*args, **kwargs)
+
+    def execute(self, *args, **kwargs):
+        self.queries += 1
+        return self._conn.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.queries += 1
+        return self._conn.executemany(*args, **kwargs)
+
+    def copy_records_to_table(self, *args, **kwargs):
+        self.queries += 1
+        return self._conn.copy_records_to_table(*args, **kwargs)
+
+
+class PoolAcquireContext:
+    __slots__ = ('pool', 'conn', 'acquired_at')
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+
+    async def __aenter__(self):
+        self.conn = CountingConnection(await self.pool._acquire())
+        self.acquired_at = time.perf_counter()
+        return self.conn
+
+    async def __aexit__(self, *exc_info):
+        conn, self.conn = self.conn, None
+        await self.pool._release(conn._conn, time.perf_counter() - self.acquired_at, conn.queries)
+
+
+# asyncpg pool with acquire wait, hold time and queries per acquire metrics. With acquire_timeout
+# acquire() fails with 503 instead of waiting in the queue without limit. With adaptive sizing
+# connections in use are limited by a limit changed at runtime by AdaptivePoolController, the
+# asyncpg pool itself is created with the upper bound.
+class InstrumentedPool:
+    def __init__(self, pool, acquire_timeout=None, limiter=None):
+        self._pool = pool
+        self.acquire_timeout = acquire_timeout
+        self.limiter = limiter
+        self.in_use = 0
+        self.window = PoolWindowStats()
+
+    def __getattr__(self, name):
+        # get_max_size(), close() etc. are passed to asyncpg pool
+        return getattr(self._pool, name)
+
+    def acquire(self):
+        return PoolAcquireContext(self)
+
+    async def _acquire(self):
+        started = time.perf_counter()
+        timeout = self.acquire_timeout
+        try:
+            if self.limiter is not None:
+                if timeout is None:
+                    await self.limiter.acquire()
+                else:
+                    await asyncio.wait_for(self.limiter.acquire(), timeout)
+                    timeout = max(timeout - (time.perf_counter() - started), 0.001)
+            try:
+                conn = await self._pool.acquire(timeout=timeout)
+            except BaseException:
+                if self.limiter is not None:
+                    self.limiter.release()
+                raise
+        except asyncio.TimeoutError:
+            inc_db_pool_acquire_timeout()
+            raise ApiServiceUnavailableError(
+                error_message='No free database connection',
+                context={'acquire_timeout_seconds': self.acquire_timeout}
+            )
+        wait_time = time.perf_counter() - started
+        self.in_use += 1
+        self.window.record_acquire(wait_time, self.in_use)
+        record_db_pool_acquire(wait_time, self.in_use, self._pool.get_size())
+        return conn
+
+    async def _release(self, conn, hold_time, queries):
+        try:
+            await self._pool.release(conn)
+        finally:
+            self.in_use -= 1
+            if self.limiter is not None:
+                self.limiter.release()
+            self.window.record_release(hold_time)
+            record_db_pool_release(hold_time, queries, self.in_use, self._pool.get_size())
+
+
+class PoolWindowStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.acquires = 0
+        self.wait_time = 0.0
+        self.releases = 0
+        self.hold_time = 0.0
+        self.peak_in_use = 0
+
+    def record_acquire(self, wait_time, in_use):
+        self.acquires += 1
+        self.wait_time += wait_time
+        if in_use > self.peak_in_use:
+            self.peak_in_use = in_use
+
+    def record_release(self, hold_time):
+        self.releases += 1
+        self.hold_time += hold_time
+
+
+# Every interval_seconds looks at the mean acquire wait and the mean time a connection is held
+# (DB latency as seen by handlers) and moves the limit of connections in use by one step:
+# up while requests wait for connections and DB keeps up, down when DB latency grows
+# (more connections would only add contention) or when connections stay unused.
+class AdaptivePoolController:
+    def __init__(self, pool, min_size, max_size, interval_seconds=1.0, target_acquire_wait_ms=5.0,
+                 max_db_latency_ms=20.0, step=1):
+        self.pool = pool
+        self.min_size = min_size
+        self.max_size = max_size
+        self.interval = interval_seconds
+        self.target_acquire_wait = target_acquire_wait_ms / 1000.0
+        self.max_db_latency = max_db_latency_ms / 1000.0
+        self.step = step
+        self._task = None
+        set_db_pool_limit(pool.limiter.limit)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.adjust()
+
+    def adjust(self):
+        window = self.pool.window
+        limiter = self.pool.limiter
+        mean_wait = window.wait_time / window.acquires if window.acquires else 0.0
+        mean_hold = window.hold_time / window.releases if window.releases else 0.0
+        limit = limiter.limit
+        if mean_hold > self.max_db_latency:
+            limit -= self.step
+        elif mean_wait > self.target_acquire_wait:
+            limit += self.step
+        elif window.peak_in_use <= limit - 2 * self.step:
+            limit -= self.step
+        limit = max(self.min_size, min(self.max_size, limit))
+        if limit != limiter.limit:
+            logging.info('Pool limit changed from %s to %s, mean acquire wait %.2fms, mean db latency %.2fms',
+                         limiter.limit, limit, mean_wait * 1000, mean_hold * 1000)
+            limiter.set_limit(limit)
+            set_db_pool_limit(limit)
+        window.reset()
@@ -1,3 +1,3 @@
 #!/bin/sh
-python3 ensure_partitions_created.py -c inventory_docker.yaml
-python3 main.py -c inventory_docker.yaml
+python3 ensure_partitions_created.py -c inventory_docker.yaml --maintain
+python3 main.py -c inventory_docker.yaml --workers ${INVENTORY_WORKERS:-1}
@@ -2,12 +2,18 @@ import argparse
 import logging
 import asyncio
 import datetime
-import calendar
+import re
 
 import yaml
 import asyncpg
 
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+GRANULARITIES = ('month', 'day')
+RETENTION_ACTIONS = ('detach', 'drop')
+PARENT_TABLE = 'log_player_event'
+# any constant works, it only has to be the same in all processes running maintenance
+MAINTENANCE_LOCK_ID = 7_203_001
+PARTITION_BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
 
 
 def load_config(config_path):
@@ -26,37 +32,140 @@ def get_database_settings(config):
     return database_settings
 
 
-def get_part_dates(target_date):
-    start_datetime = datetime.datetime(year=target_date.year, month=target_date.month,
-                                       day=1, hour=0, minute=0, second=0)
-    _, last_day = calendar.monthrange(target_date.year, target_date.month)
-    end_datetime = datetime.datetime(year=target_date.year, month=target_date.month, day=last_day,
-                                     hour=23, minute=59, second=59)
+def get_partition_settings(config):
+    partition_settings = config.get('partitions', {})
+    return partition_settings
 
+
+def get_period_start(target_date, granularity='month'):
+    if granularity == 'day':
+        return datetime.datetime(year=target_date.year, month=target_date.month, day=target_date.day)
+    return datetime.datetime(year=target_date.year, month=target_date.month, day=1)
+
+
+def get_next_period_start(period_start, granularity='month'):
+    if granularity == 'day':
+        return period_start + datetime.timedelta(days=1)
+    if period_start.month == 12:
+        return period_start.replace(year=period_start.year + 1, month=1)
+    return period_start.replace(month=period_start.month + 1)
+
+
+def get_part_dates(target_date, granularity='month'):
+    # upper bound of a range partition is exclusive, so the next period starts exactly where this one ends
+    start_datetime = get_period_start(target_date, granularity)
+    end_datetime = get_next_period_start(start_datetime, granularity)
     return start_datetime, end_datetime
 
 
-async def ensure_partitions_created(conn, target_date):
-    trx = conn.transaction()
-    try:
-        await trx.start()
-        await conn.execute("""
-            INSERT INTO log_player_event (player_id, event_type, event_value_int, event_time)
-            VALUES ($1, $2, $3, $4)
-        """, -1, 'inventory_granted', 0, target_date)
-        await trx.rollback()
-    except asyncpg.exceptions.PostgresError:
-        await trx.rollback()
-        start_datetime, end_datetime = get_part_dates(target_date)
-        year, month = start_datetime.year, start_datetime.month
-        table = f'log_player_event_{year}{month}'
-        create_table_sql = f"""
-            CREATE TABLE {table} PARTITION OF log_player_event
-            FOR VALUES FROM ('{start_datetime.strftime(DATETIME_FORMAT)}') TO
-            ('{end_datetime.strftime(DATETIME_FORMAT)}');
-        """
-        await conn.execute(create_table_sql)
-        logging.info(f'Created partition {table} for events in range [{start_datetime}..{end_datetime}]')
+def get_partition_name(start_datetime, granularity='month'):
+    if granularity == 'day':
+        return f'{PARENT_TABLE}_{start_datetime.strftime("%Y%m%d")}'
+    return f'{PARENT_TABLE}_{start_datetime.strftime("%Y%m")}'
+
+
+async def get_partitions(conn):
+    rows = await conn.fetch("""
+        SELECT child.relname AS name, pg_get_expr(child.relpartbound, child.oid) AS bound
+        FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = $1
+    """, PARENT_TABLE)
+    partitions = []
+    for row in rows:
+        match = PARTITION_BOUND_RE.search(row['bound'] or '')
+        if match is None:
+            # DEFAULT partition or MINVALUE/MAXVALUE bounds, not managed here
+            continue
+        start_datetime = datetime.datetime.fromisoformat(match.group(1))
+        end_datetime = datetime.datetime.fromisoformat(match.group(2))
+        partitions.append((row['name'], start_datetime, end_datetime))
+    return partitions
+
+
+def find_overlapping_partition(partitions, start_datetime, end_datetime):
+    for partition in partitions:
+        _, partition_start, partition_end = partition
+        if partition_start < end_datetime and start_datetime < partition_end:
+            return partition
+    return None
+
+
+async def create_partition(conn, start_datetime, end_datetime, granularity='month'):
+    table = get_partition_name(start_datetime, granularity)
+    create_table_sql = f"""
+        CREATE TABLE {table} PARTITION OF {PARENT_TABLE}
+        FOR VALUES FROM ('{start_datetime.strftime(DATETIME_FORMAT)}') TO
+        ('{end_datetime.strftime(DATETIME_FORMAT)}');
+    """
+    await conn.execute(create_table_sql)
+    logging.info(f'Created partition {table} for events in range [{start_datetime}..{end_datetime})')
+    return table
+
+
+async def ensure_partitions_created(conn, target_date, granularity='month'):
+    start_datetime, end_datetime = get_part_dates(target_date, granularity)
+    partitions = await get_partitions(conn)
+    if find_overlapping_partition(partitions, start_datetime, end_datetime) is None:
+        await create_partition(conn, start_datetime, end_datetime, granularity)
+
+
+# Creates partitions from the current period till `ahead` periods after it and detaches or drops
+# partitions that ended before the last `retention` periods (0 keeps all), in one pass over pg_inherits.
+# Returns False if another process holds the maintenance lock.
+async def maintain_partitions(conn, now, ahead=3, granularity='month', retention=0, retention_action='detach'):
+    async with conn.transaction():
+        is_locked = await conn.fetchval('SELECT pg_try_advisory_xact_lock($1)', MAINTENANCE_LOCK_ID)
+        if not is_locked:
+            logging.info('Partition maintenance is running in another process, skipped')
+            return False
+
+        partitions = await get_partitions(conn)
+        period_start = get_period_start(now, granularity)
+        for _ in range(ahead + 1):
+            period_end = get_next_period_start(period_start, granularity)
+            overlapping = find_overlapping_partition(partitions, period_start, period_end)
+            if overlapping is None:
+                table = await create_partition(conn, period_start, period_end, granularity)
+                partitions.append((table, period_start, period_end))
+            elif overlapping[1] > period_start or overlapping[2] < period_end:
+                logging.warning(f'Range [{period_start}..{period_end}) is only partially covered by partition '
+                                f'{overlapping[0]}, check partitions of {PARENT_TABLE}')
+            period_start = period_end
+
+        if retention > 0:
+            retention_start = get_period_start(now, granularity)
+            for _ in range(retention):
+                retention_start = get_period_start(retention_start - datetime.timedelta(days=1), granularity)
+            for table, _, partition_end in partitions:
+                if partition_end > retention_start:
+                    continue
+                if retention_action == 'drop':
+                    await conn.execute(f'DROP TABLE {table}')
+                    logging.info(f'Dropped partition {table}, it ended at {partition_end}')
+                else:
+                    await conn.execute(f'ALTER TABLE {PARENT_TABLE} DETACH PARTITION {table}')
+                    logging.info(f'Detached partition {table}, it ended at {partition_end}')
+    return True
+
+
+async def run_maintenance_loop(db_pool, partition_settings):
+    interval = partition_settings.get('maintenance_interval_seconds', 3600)
+    while True:
+        try:
+            async with db_pool.acquire() as conn:
+                await maintain_partitions(
+                    conn, datetime.datetime.utcnow(),
+                    ahead=partition_settings.get('ahead', 3),
+                    granularity=partition_settings.get('granularity', 'month'),
+                    retention=partition_settings.get('retention', 0),
+                    retention_action=partition_settings.get('retention_action', 'detach'),
+                )
+        except Exception:
+            # e.g. pool acquire timeout or a lost connection, the loop must keep running
+            logging.exception('Partition maintenance failed, will retry in %s seconds', interval)
+        await asyncio.sleep(interval)
 
 
 async def main():
@@ -76,6 +185,39 @@ async def main():
         '--target-date', '-t',
         help='Specify target date for creating partitions'
     )
+    parser.add_argument(
+        '--maintain', '-m',
+        default=False,
+        action='store_true',
+        help='Create partitions ahead and apply retention, settings are taken from partitions section of config'
+    )
+    parser.add_argument(
+        '--daemon', '-d',
+        default=False,
+        action='store_true',
+        help='Run maintenance every partitions.maintenance_interval_seconds until stopped'
+    )
+    parser.add_argument(
+        '--granularity', '-g',
+        choices=GRANULARITIES,
+        help='Partition size, overrides partitions.granularity (month by default)'
+    )
+    parser.add_argument(
+        '--ahead', '-a',
+        type=int,
+        help='Number of partitions created after the current one, overrides partitions.ahead (3 by default)'
+    )
+    parser.add_argument(
+        '--retention', '-r',
+        type=int,
+        help='Number of past partitions to keep, older are detached or dropped, 0 keeps all. '
+             'Overrides partitions.retention (0 by default)'
+    )
+    parser.add_argument(
+        '--retention-action',
+        choices=RETENTION_ACTIONS,
+        help='What to do with expired partitions, overrides partitions.retention_action (detach by default)'
+    )
     args = parser.parse_args()
 
     target_date = datetime.datetime.utcnow()
@@ -84,15 +226,37 @@ async def main():
 
     config = load_config(args.config)
     db_settings = get_database_settings(config)
+    partition_settings = dict(get_partition_settings(config))
+    for key in ('granularity', 'ahead', 'retention', 'retention_action'):
+        if getattr(args, key) is not None:
+            partition_settings[key] = getattr(args, key)
 
     log_format = '%(asctime)s; %(levelname)s; %(message)s'
     logging.basicConfig(level=args.log_level.upper(), format=log_format)
 
-    conn = await asyncpg.connect(database=db_settings['database'], user=db_settings['user'],
-                                 password=db_settings['password'], host=db_settings['host'],
-                                 port=db_settings['port'])
+    conn_settings = dict(database=db_settings['database'], user=db_settings['user'],
+                         password=db_settings['password'], host=db_settings['host'],
+                         port=db_settings['port'])
+    if args.daemon:
+        pool = await asyncpg.create_pool(**conn_settings, min_size=1, max_size=1)
+        try:
+            await run_maintenance_loop(pool, partition_settings)
+        finally:
+            await pool.close()
+        return
+
+    conn = await asyncpg.connect(**conn_settings)
     try:
-        await ensure_partitions_created(conn, target_date)
+        if args.maintain:
+            await maintain_partitions(
+                conn, target_date,
+                ahead=partition_settings.get('ahead', 3),
+                granularity=partition_settings.get('granularity', 'month'),
+                retention=partition_settings.get('retention', 0),
+                retention_action=partition_settings.get('retention_action', 'detach'),
+            )
+        else:
+            await ensure_partitions_created(conn, target_date, partition_settings.get('granularity', 'month'))
     finally:
         await conn.close()
 
@@ -8,6 +8,8 @@ from aiohttp.web_exceptions import (
 )
 from aiohttp_swagger3.swagger_route import RequestValidationFailed
 
+import serializer
+
 
 @enum.unique
 class ApiErrorCode(enum.Enum):
@@ -16,6 +18,9 @@ class ApiErrorCode(enum.Enum):
     db_error = 'db_error'
     server_error = 'server_error'
     logical_error = 'logical_error'
+    service_unavailable = 'service_unavailable'
+    overloaded = 'overloaded'
+    insufficient_amount = 'insufficient_amount'
 
 
 class ApiBaseError(Exception):
@@ -38,6 +43,13 @@ class ApiBaseError(Exception):
         return data
 
 
+def error_response(request: web.Request, err: ApiBaseError) -> web.Response:
+    response = serializer.response(request, err.as_dict(), status=err.http_status_code)
+    # read by monitoring_middleware, so it doesn't have to parse the body
+    response['error_code'] = err.error_code.name
+    return response
+
+
 @web.middleware
 async def error_middleware(request: web.Request, handler) -> web.StreamResponse:
     try:
@@ -48,15 +60,15 @@ async def error_middleware(request: web.Request, handler) -> web.StreamResponse:
             error_code=ApiErrorCode.schema_validation_error,
             context=e.errors
         )
-        return web.json_response(status=err.http_status_code, data=err.as_dict())
+        return error_response(request, err)
     except ApiBaseError as err:
-        return web.json_response(status=err.http_status_code, data=err.as_dict())
+        return error_response(request, err)
     except HTTPBadRequest as e:
         err = ApiValidationError(
             error_message=str(e),
             context={'reason': e.reason}
         )
-        return web.json_response(status=err.http_status_code, data=err.as_dict())
+        return error_response(request, err)
     except HTTPClientError:
         raise
 
@@ -66,7 +78,7 @@ async def error_middleware(request: web.Request, handler) -> web.StreamResponse:
             error_message='Internal server error',
             context={'Exception': str(e)}
         )
-        return web.json_response(status=err.http_status_code, data=err.as_dict())
+        return error_response(request, err)
 
 
 class ApiValidationError(ApiBaseError):
@@ -82,3 +94,8 @@ class ApiInternalError(ApiBaseError):
 class ApiLogicalError(ApiBaseError):
     def __init__(self, error_message: str, error_code: ApiErrorCode = ApiErrorCode.logical_error, context: dict=None):
         super(ApiLogicalError, self).__init__(error_code, error_message, context, 420)
+
+
+class ApiServiceUnavailableError(ApiBaseError):
+    def __init__(self, error_message: str, error_code: ApiErrorCode = ApiErrorCode.service_unavailable, context: dict=None):
+        super(ApiServiceUnavailableError, self).__init__(error_code, error_message, context, 503)
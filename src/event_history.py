@@ -0,0 +1,95 @@
+import base64
+import binascii
+import datetime
+
+import serializer
+from error import ApiErrorCode, ApiServiceUnavailableError, ApiValidationError
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+
+def parse_time(name, value):
+    # event_time is stored as UTC without time zone
+    try:
+        parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        raise ApiValidationError(error_message=f'Invalid {name}, ISO 8601 expected', context={name: value})
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+# cursor is opaque for clients, it is (event_time, id) of the last row sent
+def encode_cursor(event_time, event_id):
+    return base64.urlsafe_b64encode(f'{event_time.isoformat()}|{event_id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        event_time, event_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.datetime.fromisoformat(event_time), int(event_id)
+    except (AttributeError, binascii.Error, UnicodeError, ValueError):
+        raise ApiValidationError(error_message='Invalid cursor', context={'cursor': cursor})
+
+
+def format_event(row):
+    return serializer.dumps({
+        'id': row['id'],
+        'event_time': row['event_time'].isoformat(),
+        'event_type': row['event_type'],
+        'event_value_int': row['event_value_int'],
+        'ext_trx_id': row['ext_trx_id'],
+        'meta_data': row['meta_data'],
+    }) + b'\n'
+
+
+# Settings and concurrency limit of event history exports. An export holds a pool connection
+# for as long as the client reads the page, so only max_concurrent_exports run at a time and
+# the rest fail fast instead of taking connections from inventory requests.
+class EventHistory:
+    def __init__(self, max_range_days=93, max_page_size=10000, default_page_size=1000, prefetch=500,
+                 max_concurrent_exports=4):
+        self.max_range = datetime.timedelta(days=max_range_days)
+        self.max_page_size = max_page_size
+        self.default_page_size = default_page_size
+        self.prefetch = prefetch
+        self.max_concurrent_exports = max_concurrent_exports
+        self.active_exports = 0
+
+    def parse_page(self, data):
+        # arguments of GET_PLAYER_EVENTS except LIMIT, and the page size
+        player_id = data.get('player_id')
+        if player_id is None:
+            raise ApiValidationError(error_message='Missing player_id')
+        from_time = parse_time('from_time', data.get('from_time'))
+        to_time = parse_time('to_time', data.get('to_time'))
+        if to_time <= from_time or to_time - from_time > self.max_range:
+            raise ApiValidationError(
+                error_message=f'to_time must be after from_time, by {self.max_range.days} days at most',
+                context={'from_time': data.get('from_time'), 'to_time': data.get('to_time')}
+            )
+        page_size = data.get('limit') or self.default_page_size
+        if page_size > self.max_page_size:
+            raise ApiValidationError(
+                error_message=f'Page is too large, max is {self.max_page_size}',
+                context={'max_page_size': self.max_page_size, 'limit': page_size}
+            )
+        cursor = data.get('cursor')
+        if cursor is None:
+            # ids start from 1, so the first page includes rows at from_time
+            after_time, after_id = from_time, 0
+        else:
+            after_time, after_id = decode_cursor(cursor)
+        return (player_id, from_time, to_time, after_time, after_id), page_size
+
+    def acquire(self):
+        if self.active_exports >= self.max_concurrent_exports:
+            raise ApiServiceUnavailableError(
+                error_message='Too many event history exports',
+                error_code=ApiErrorCode.overloaded,
+                context={'max_concurrent_exports': self.max_concurrent_exports}
+            )
+        self.active_exports += 1
+
+    def release(self):
+        self.active_exports -= 1
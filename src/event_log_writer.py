@@ -0,0 +1,163 @@
+import asyncio
+import collections
+import datetime
+import logging
+import os
+import time
+
+import serializer
+from monitoring import (
+    inc_event_log_backpressure, inc_event_log_flush_failed, inc_event_log_written, set_event_log_queue_depth
+)
+
+EVENT_COLUMNS = ('player_id', 'event_type', 'event_value_int', 'meta_data', 'ext_trx_id', 'event_time')
+SPOOL_SEGMENT_SUFFIX = '.ndjson'
+
+
+def make_event(player_id, event_type, event_value_int, meta_data, ext_trx_id, event_time=None):
+    # event_time is fixed when the event happens, not when it is flushed
+    if event_time is None:
+        event_time = datetime.datetime.utcnow()
+    return (player_id, event_type, event_value_int, meta_data, ext_trx_id, event_time)
+
+
+# Writes log_player_event rows outside of grant transactions. Events are put on a bounded in-memory
+# buffer (put() waits when it is full) and flushed with COPY by a writer task. With spool_dir set every
+# event is also appended to a local spool segment, segments are deleted once their events are in DB
+# and replayed on start otherwise.
+class EventLogWriter:
+    def __init__(self, db_pool, max_buffer_size=100000, max_batch_size=5000, flush_interval_ms=100,
+                 spool_dir=None, spool_fsync=False):
+        self.db_pool = db_pool
+        self.max_buffer_size = max_buffer_size
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.spool_dir = spool_dir
+        self.spool_fsync = spool_fsync
+        self._buffer = collections.deque()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._batch_ready = asyncio.Event()
+        self._spool_file = None
+        self._closed_segments = []
+        self._task = None
+
+    async def start(self):
+        if self.spool_dir is not None:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            await self._replay_spool()
+            self._open_segment()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._flush()
+        if self._spool_file is not None:
+            self._spool_file.close()
+            # segments of not written events stay on disk and are replayed on the next start
+            if not self._buffer:
+                os.remove(self._spool_file.name)
+            self._spool_file = None
+
+    async def put(self, event):
+        while len(self._buffer) >= self.max_buffer_size:
+            inc_event_log_backpressure()
+            self._not_full.clear()
+            await self._not_full.wait()
+        if self._spool_file is not None:
+            self._write_to_spool([event])
+        self._buffer.append(event)
+        set_event_log_queue_depth(len(self._buffer))
+        if len(self._buffer) >= self.max_batch_size:
+            self._batch_ready.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await self._flush()
+
+    async def _flush(self):
+        if not self._buffer:
+            return
+        # everything buffered so far is in segments closed here, new events go to the next segment
+        if self._spool_file is not None:
+            self._spool_file.close()
+            self._closed_segments.append(self._spool_file.name)
+            self._open_segment()
+        events = list(self._buffer)
+        self._buffer.clear()
+        written = 0
+        try:
+            while written < len(events):
+                chunk = events[written:written + self.max_batch_size]
+                await self._copy(chunk)
+                written += len(chunk)
+        except (Exception, asyncio.CancelledError) as e:
+            # not written events go back to the buffer, spool segments are kept until all of them are in DB
+            self._buffer.extendleft(reversed(events[written:]))
+            set_event_log_queue_depth(len(self._buffer))
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            logging.exception('Failed to write %s events to log_player_event, will retry', len(events) - written)
+            inc_event_log_flush_failed()
+            return
+        self._delete_closed_segments()
+        set_event_log_queue_depth(len(self._buffer))
+        self._not_full.set()
+
+    async def _copy(self, events):
+        async with self.db_pool.acquire() as conn:
+            await conn.copy_records_to_table('log_player_event', records=events, columns=EVENT_COLUMNS)
+        inc_event_log_written(len(events))
+
+    def _open_segment(self):
+        name = os.path.join(self.spool_dir, f'{time.time_ns()}{SPOOL_SEGMENT_SUFFIX}')
+        self._spool_file = open(name, 'ab')
+
+    def _write_to_spool(self, events):
+        for event in events:
+            record = list(event)
+            record[-1] = record[-1].isoformat()
+            self._spool_file.write(serializer.dumps(record) + b'\n')
+        self._spool_file.flush()
+        if self.spool_fsync:
+            os.fsync(self._spool_file.fileno())
+
+    def _delete_closed_segments(self):
+        for name in self._closed_segments:
+            os.remove(name)
+        self._closed_segments = []
+
+    async def _replay_spool(self):
+        segments = sorted(name for name in os.listdir(self.spool_dir) if name.endswith(SPOOL_SEGMENT_SUFFIX))
+        if not segments:
+            return
+        events = []
+        for name in segments:
+            path = os.path.join(self.spool_dir, name)
+            with open(path, 'rb') as segment:
+                for line in segment:
+                    try:
+                        record = serializer.loads(line)
+                    except ValueError:
+                        # the last line can be torn if the process died in the middle of write
+                        logging.warning('Skipped broken line in event spool segment %s', path)
+                        continue
+                    record[-1] = datetime.datetime.fromisoformat(record[-1])
+                    events.append(tuple(record))
+            self._closed_segments.append(path)
+        logging.info('Replaying %s events from %s spool segments', len(events), len(segments))
+        self._buffer.extend(events)
+        await self._flush()
+        if self._buffer:
+            raise Exception(f'Failed to replay event spool from {self.spool_dir}')
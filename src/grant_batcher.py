@@ -0,0 +1,148 @@
+import asyncio
+import logging
+
+import asyncpg
+
+from grants import Grant, grant_event, grant_events, write_grant, write_grants
+from monitoring import record_grant_batch
+from replicas import read_lsn_token
+
+
+class GrantRequest(Grant):
+    def __init__(self, player_id, item_code, amount, ext_trx_id, inventory_type):
+        super().__init__(player_id, item_code, amount, ext_trx_id, inventory_type)
+        self.future = asyncio.get_running_loop().create_future()
+
+
+# Group-commit pipeline for /v1/inventory/grant: grants are queued and a flusher
+# coroutine writes them every flush_interval_ms or max_batch_size items in one
+# transaction built from multi-row statements. With read_tokens the primary LSN is read on
+# the flush connection after commit and returned to every grant of the batch. A batch failing
+# with DataError (e.g. an invalid inventory_type with request validation off) is written again
+# grant by grant with write_single, so only the bad grants fail.
+class GrantBatcher:
+    def __init__(self, db_pool, max_batch_size=100, flush_interval_ms=5, max_concurrent_flushes=None,
+                 event_log_writer=None, write_batch=write_grants, read_tokens=False, write_single=write_grant):
+        self.db_pool = db_pool
+        self.read_tokens = read_tokens
+        self.write_batch = write_batch
+        self.write_single = write_single
+        self.event_log_writer = event_log_writer
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        if max_concurrent_flushes is None:
+            max_concurrent_flushes = db_pool.get_max_size()
+        self._flush_slots = asyncio.Semaphore(max_concurrent_flushes)
+        self._queue = asyncio.Queue()
+        # set by submit() when the queue has the grants missing in the batch being collected
+        self._batch_full = asyncio.Event()
+        self._missing = 0
+        self._flusher_task = None
+        self._flush_tasks = set()
+
+    def start(self):
+        self._flusher_task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._flusher_task is not None:
+            self._flusher_task.cancel()
+            try:
+                await self._flusher_task
+            except asyncio.CancelledError:
+                pass
+            self._flusher_task = None
+        # flush what is still waiting in the queue, so no request hangs on shutdown
+        while not self._queue.empty():
+            batch = []
+            while not self._queue.empty() and len(batch) < self.max_batch_size:
+                batch.append(self._queue.get_nowait())
+            await self._flush(batch)
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+
+    async def submit(self, player_id, item_code, amount, ext_trx_id, inventory_type):
+        # returns True if the grant was detected as a duplicate, and the read token
+        grant = GrantRequest(player_id, item_code, amount, ext_trx_id, inventory_type)
+        self._queue.put_nowait(grant)
+        if 0 < self._missing <= self._queue.qsize():
+            self._batch_full.set()
+        return await grant.future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            started = loop.time()
+            self._take_queued(batch)
+            delay = started + self.flush_interval - loop.time()
+            if len(batch) < self.max_batch_size and delay > 0:
+                # flushed when flush_interval_ms passes or max_batch_size grants are queued, whichever is first
+                self._missing = self.max_batch_size - len(batch)
+                self._batch_full.clear()
+                timer = loop.call_later(delay, self._batch_full.set)
+                try:
+                    await self._batch_full.wait()
+                finally:
+                    timer.cancel()
+                    self._missing = 0
+                self._take_queued(batch)
+
+            record_grant_batch(len(batch), loop.time() - started)
+            await self._flush_slots.acquire()
+            task = loop.create_task(self._flush_in_slot(batch))
+            self._flush_tasks.add(task)
+            task.add_done_callback(self._flush_tasks.discard)
+
+    def _take_queued(self, batch):
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+
+    async def _flush_in_slot(self, batch):
+        try:
+            await self._flush(batch)
+        finally:
+            self._flush_slots.release()
+
+    async def _flush(self, batch):
+        events = []
+        try:
+            async with self.db_pool.acquire() as conn:
+                try:
+                    async with conn.transaction():
+                        duplicates = await self.write_batch(conn, batch, log_events=self.event_log_writer is None)
+                except asyncpg.exceptions.DataError as e:
+                    logging.warning('Grant batch of %s items failed, writing grants one by one: %s', len(batch), e)
+                    await self._write_one_by_one(conn, batch, events)
+                else:
+                    token = await read_lsn_token(conn) if self.read_tokens else None
+                    for grant, is_duplicate in zip(batch, duplicates):
+                        if not grant.future.done():
+                            grant.future.set_result((is_duplicate, token))
+                    if self.event_log_writer is not None:
+                        events = grant_events(batch, duplicates)
+        except Exception as e:
+            # grants already written one by one have their results, only the rest fail
+            logging.exception('Failed to flush grant batch of %s items', len(batch))
+            for grant in batch:
+                if not grant.future.done():
+                    grant.future.set_exception(e)
+
+        for event in events:
+            await self.event_log_writer.put(event)
+
+    async def _write_one_by_one(self, conn, batch, events):
+        # every grant commits alone and gets its result right away, events of written grants go to events
+        for grant in batch:
+            try:
+                is_duplicate = await self.write_single(conn, grant, log_events=self.event_log_writer is None)
+            except asyncpg.exceptions.DataError as e:
+                logging.warning('Failed to write grant player_id: %s, item_code: %s, ext_trx_id: %s: %s',
+                                grant.player_id, grant.item_code, grant.ext_trx_id, e)
+                if not grant.future.done():
+                    grant.future.set_exception(e)
+                continue
+            if not is_duplicate and self.event_log_writer is not None:
+                events.append(grant_event(grant))
+            token = await read_lsn_token(conn) if self.read_tokens else None
+            if not grant.future.done():
+                grant.future.set_result((is_duplicate, token))
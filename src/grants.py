@@ -0,0 +1,172 @@
+import logging
+
+import asyncpg
+
+import statements
+from event_log_writer import make_event
+
+# inline: statements sent from the service, stored_proc: grant_inventory() for single grants,
+# stored_proc_batch: grant_inventory() for single grants and grant_inventory_batch() for batches
+GRANT_ENGINES = ('inline', 'stored_proc', 'stored_proc_batch')
+
+
+class Grant:
+    def __init__(self, player_id, item_code, amount, ext_trx_id, inventory_type):
+        self.player_id = player_id
+        self.item_code = item_code
+        self.amount = amount
+        self.ext_trx_id = ext_trx_id
+        self.inventory_type = inventory_type
+
+
+def log_duplicate(grant):
+    logging.info('Duplicate request detected when trying to add_item player_id: %s, item_code: %s, '
+                 'inventory_type: %s, ext_trx_id: %s', grant.player_id, grant.item_code,
+                 grant.inventory_type, grant.ext_trx_id)
+
+
+def log_upsert(grant, inserted):
+    if inserted:
+        logging.info('A new inventory created for player_id: %s, item_code: %s, inventory_type: %s, '
+                     'ext_trx_id: %s', grant.player_id, grant.item_code, grant.inventory_type, grant.ext_trx_id)
+    else:
+        logging.info('An existing inventory updated for player_id: %s, item_code: %s, '
+                     'inventory_type: %s, ext_trx_id: %s', grant.player_id, grant.item_code,
+                     grant.inventory_type, grant.ext_trx_id)
+
+
+# Writes one grant in its own transaction, returns True if it is a duplicate
+async def write_grant(conn, grant, log_events=True):
+    async with conn.transaction():
+        try:
+            await conn.fetchrow(statements.INSERT_INVENTORY_TRX, grant.player_id, grant.ext_trx_id)
+        except asyncpg.exceptions.IntegrityConstraintViolationError:
+            log_duplicate(grant)
+            return True
+
+        # Perform an upsert operation to grant items to the player's inventory
+        res = await conn.fetchrow(statements.UPSERT_INVENTORY, grant.player_id, grant.inventory_type,
+                                  grant.item_code, grant.amount)
+        log_upsert(grant, res['inserted'])
+
+        if log_events:
+            await conn.execute(statements.INSERT_PLAYER_EVENT, grant.player_id, 'inventory_granted', grant.amount,
+                               {'inventory_type': grant.inventory_type, 'item_code': grant.item_code},
+                               grant.ext_trx_id)
+    return False
+
+
+# Same as write_grant() in one round-trip: the function is atomic on its own and reports
+# duplicates in the result, so no transaction is opened.
+async def write_grant_stored_proc(conn, grant, log_events=True):
+    status = await conn.fetchval(statements.GRANT_STORED_PROC, grant.player_id, grant.ext_trx_id,
+                                 grant.inventory_type, grant.item_code, grant.amount, log_events)
+    if status == 'duplicate':
+        log_duplicate(grant)
+        return True
+    log_upsert(grant, status == 'inserted')
+    return False
+
+
+# Writes many grants with a constant number of set-based statements, must be called in a transaction.
+# Returns a list of duplicate flags in the order of grants. With log_events=False the caller
+# is responsible for grant events, see grant_events().
+async def write_grants(conn, grants, log_events=True):
+    # Same idempotency key twice in one batch: only the first one goes to DB,
+    # the rest are duplicates just like in the per-request path.
+    # A missing ext_trx_id violates NOT NULL there and is reported as duplicate too.
+    duplicates = [True] * len(grants)
+    first_seen = {}
+    for i, grant in enumerate(grants):
+        if grant.ext_trx_id is None:
+            continue
+        first_seen.setdefault((grant.player_id, grant.ext_trx_id), i)
+
+    # sorted keys keep lock order stable between concurrent batches
+    trx_keys = sorted(first_seen)
+    inserted_keys = set()
+    if trx_keys:
+        rows = await conn.fetch(statements.BATCH_INSERT_INVENTORY_TRX,
+                                [key[0] for key in trx_keys], [key[1] for key in trx_keys])
+        inserted_keys = {(row['player_id'], row['ext_trx_id']) for row in rows}
+
+    granted = []
+    for key in trx_keys:
+        if key not in inserted_keys:
+            continue
+        i = first_seen[key]
+        duplicates[i] = False
+        granted.append(grants[i])
+
+    for i, grant in enumerate(grants):
+        if duplicates[i]:
+            log_duplicate(grant)
+
+    if not granted:
+        return duplicates
+
+    # ON CONFLICT DO UPDATE can't touch the same row twice in one statement, so sum amounts first
+    upserts = {}
+    for grant in granted:
+        key = (grant.player_id, grant.item_code)
+        if key in upserts:
+            upserts[key][1] += grant.amount
+        else:
+            upserts[key] = [grant.inventory_type, grant.amount]
+    upsert_keys = sorted(upserts)
+    rows = await conn.fetch(statements.BATCH_UPSERT_INVENTORY,
+                            [key[0] for key in upsert_keys], [upserts[key][0] for key in upsert_keys],
+                            [key[1] for key in upsert_keys], [upserts[key][1] for key in upsert_keys])
+    for row in rows:
+        if row['inserted']:
+            logging.info('A new inventory created for player_id: %s, item_code: %s, inventory_type: %s',
+                         row['player_id'], row['item_code'], row['inventory_type'])
+        else:
+            logging.info('An existing inventory updated for player_id: %s, item_code: %s, inventory_type: %s',
+                         row['player_id'], row['item_code'], row['inventory_type'])
+
+    if not log_events:
+        return duplicates
+
+    await conn.execute(statements.BATCH_INSERT_GRANT_EVENTS,
+                       [g.player_id for g in granted], [g.amount for g in granted],
+                       [g.inventory_type for g in granted], [g.item_code for g in granted],
+                       [g.ext_trx_id for g in granted])
+
+    return duplicates
+
+
+# Same as write_grants() with one call of grant_inventory_batch()
+async def write_grants_stored_proc(conn, grants, log_events=True):
+    rows = await conn.fetch(statements.BATCH_GRANT_STORED_PROC,
+                            [g.player_id for g in grants], [g.ext_trx_id for g in grants],
+                            [g.inventory_type for g in grants], [g.item_code for g in grants],
+                            [g.amount for g in grants], log_events)
+    duplicates = []
+    for grant, row in zip(grants, rows):
+        is_duplicate = row['status'] == 'duplicate'
+        if is_duplicate:
+            log_duplicate(grant)
+        duplicates.append(is_duplicate)
+    return duplicates
+
+
+SINGLE_GRANT_WRITERS = {
+    'inline': write_grant,
+    'stored_proc': write_grant_stored_proc,
+    'stored_proc_batch': write_grant_stored_proc,
+}
+BATCH_GRANT_WRITERS = {
+    'inline': write_grants,
+    'stored_proc': write_grants,
+    'stored_proc_batch': write_grants_stored_proc,
+}
+
+
+def grant_event(grant):
+    return make_event(grant.player_id, 'inventory_granted', grant.amount,
+                      {'inventory_type': grant.inventory_type, 'item_code': grant.item_code}, grant.ext_trx_id)
+
+
+def grant_events(grants, duplicates):
+    return [grant_event(grant) for grant, is_duplicate in zip(grants, duplicates) if not is_duplicate]
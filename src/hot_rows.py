@@ -0,0 +1,155 @@
+import asyncio
+import logging
+
+import statements
+from consumes import Consume, consume_event, insufficient_amount_error, log_consume, log_duplicate_consume
+from grants import grant_event, log_duplicate, log_upsert
+from monitoring import record_hot_row_merge
+from replicas import read_lsn_token
+
+
+# Applies grants and consumes of one (player_id, item_code) row in one transaction, in the order
+# they came. The row is locked once, amounts are checked in Python and the net change is written
+# with one upsert, so concurrent requests don't queue on the row lock one by one.
+# Returns results in the order of ops (is_duplicate for grants, inventory_type or None for
+# consumes, 420 error for consumes with not enough items) and events not written with log_events=False.
+async def write_row_ops(conn, player_id, item_code, ops, log_events=True):
+    # same ext_trx_id twice: only the first one is applied, like with separate requests
+    first_seen = {}
+    for i, op in enumerate(ops):
+        if op.ext_trx_id is not None:
+            first_seen.setdefault(op.ext_trx_id, i)
+    ext_trx_ids = sorted(first_seen)
+    inserted = set()
+    if ext_trx_ids:
+        rows = await conn.fetch(statements.BATCH_INSERT_INVENTORY_TRX, [player_id] * len(ext_trx_ids), ext_trx_ids)
+        inserted = {row['ext_trx_id'] for row in rows}
+
+    row = await conn.fetchrow(statements.LOCK_INVENTORY_ROW, player_id, item_code)
+    start_amount = amount = row['amount'] if row is not None else 0
+    inventory_type = row['inventory_type'] if row is not None else None
+    results = []
+    events = []
+    rejected_trx_ids = []
+    for i, op in enumerate(ops):
+        is_consume = isinstance(op, Consume)
+        if op.ext_trx_id not in inserted or first_seen[op.ext_trx_id] != i:
+            if is_consume:
+                log_duplicate_consume(op)
+                results.append(None)
+            else:
+                log_duplicate(op)
+                results.append(True)
+        elif is_consume:
+            if inventory_type is None or amount < op.amount:
+                # its ext_trx_id is deleted below, so it can be retried after a grant
+                results.append(insufficient_amount_error(op))
+                rejected_trx_ids.append(op.ext_trx_id)
+                continue
+            amount -= op.amount
+            log_consume(op)
+            results.append(inventory_type)
+            events.append(consume_event(op, inventory_type))
+        else:
+            log_upsert(op, inventory_type is None)
+            if inventory_type is None:
+                inventory_type = op.inventory_type
+            amount += op.amount
+            results.append(False)
+            events.append(grant_event(op))
+
+    if rejected_trx_ids:
+        await conn.execute(statements.DELETE_INVENTORY_TRX, player_id, rejected_trx_ids)
+    if events and (row is None or amount != start_amount):
+        await conn.fetchrow(statements.UPSERT_INVENTORY, player_id, inventory_type, item_code,
+                            amount - start_amount)
+    if log_events and events:
+        await conn.execute(statements.BATCH_INSERT_PLAYER_EVENTS,
+                           [e[0] for e in events], [e[1] for e in events], [e[2] for e in events],
+                           [e[3]['inventory_type'] for e in events], [e[3]['item_code'] for e in events],
+                           [e[4] for e in events])
+        events = []
+    return results, events
+
+
+# In-process serializer of writes to the same inventory row. A write to a row nobody in this process
+# is writing goes to DB alone, as without the serializer. Writes that come while the row is busy wait,
+# and when it is free all of them (up to max_merge_size) are applied by write_row_ops() in one
+# transaction, so a hot row takes one lock and one round of statements per batch, not per request.
+# run() returns what write_alone() returns: the result of the write and the read token, which for
+# merged writes is read on their connection after commit when read_tokens is set.
+class HotRowSerializer:
+    def __init__(self, db_pool, max_merge_size=100, event_log_writer=None, read_tokens=False):
+        self.db_pool = db_pool
+        self.read_tokens = read_tokens
+        self.max_merge_size = max_merge_size
+        self.event_log_writer = event_log_writer
+        # (player_id, item_code) -> writes waiting for the row, the key exists while the row is busy
+        self._rows = {}
+        self._write_tasks = set()
+
+    async def stop(self):
+        # merged writes start more merged writes of waiting requests, wait for all of them
+        while self._write_tasks:
+            await asyncio.gather(*self._write_tasks, return_exceptions=True)
+
+    async def run(self, op, write_alone):
+        key = (op.player_id, op.item_code)
+        waiting = self._rows.get(key)
+        if waiting is None:
+            self._rows[key] = []
+            try:
+                return await write_alone()
+            finally:
+                self._write_waiting(key)
+        future = asyncio.get_running_loop().create_future()
+        waiting.append((op, future))
+        return await future
+
+    def _write_waiting(self, key):
+        waiting = self._rows[key]
+        if not waiting:
+            del self._rows[key]
+            return
+        batch = waiting[:self.max_merge_size]
+        self._rows[key] = waiting[self.max_merge_size:]
+        task = asyncio.get_running_loop().create_task(self._write_merged(key, batch))
+        self._write_tasks.add(task)
+        task.add_done_callback(lambda done_task: self._on_write_done(done_task, key))
+
+    def _on_write_done(self, task, key):
+        self._write_tasks.discard(task)
+        self._write_waiting(key)
+
+    async def _write_merged(self, key, batch):
+        # requests which are gone don't get written
+        batch = [(op, future) for op, future in batch if not future.done()]
+        if not batch:
+            return
+        record_hot_row_merge(len(batch))
+        player_id, item_code = key
+        try:
+            async with self.db_pool.acquire() as conn:
+                async with conn.transaction():
+                    results, events = await write_row_ops(conn, player_id, item_code, [op for op, _ in batch],
+                                                          log_events=self.event_log_writer is None)
+                token = await read_lsn_token(conn) if self.read_tokens else None
+        except Exception as e:
+            logging.exception('Failed to write %s merged writes of player_id: %s, item_code: %s',
+                              len(batch), player_id, item_code)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result((result, token))
+
+        if self.event_log_writer is not None:
+            for event in events:
+                await self.event_log_writer.put(event)
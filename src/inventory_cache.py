@@ -0,0 +1,108 @@
+import collections
+import sys
+import time
+
+from monitoring import (
+    inc_inventory_cache_hit, inc_inventory_cache_miss, inc_inventory_cache_eviction, set_inventory_cache_size
+)
+
+
+def estimate_inventory_size(inventory_data):
+    size = sys.getsizeof(inventory_data)
+    for item in inventory_data:
+        size += sys.getsizeof(item)
+        for value in item.values():
+            size += sys.getsizeof(value)
+    return size
+
+
+# Bounded in-process LRU/TTL cache of formatted player inventories keyed by player_id.
+# A load that raced with an invalidation of the same player is not stored, so
+# a grant committed during a read can't leave a stale entry behind.
+class InventoryCache:
+    def __init__(self, ttl_seconds=5.0, max_memory_mb=64):
+        self.ttl = ttl_seconds
+        self.max_memory = int(max_memory_mb * 1024 * 1024)
+        self.memory_used = 0
+        self._entries = collections.OrderedDict()
+        self._loads = {}
+        self.suspended = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, player_id):
+        if self.suspended:
+            inc_inventory_cache_miss()
+            return None
+        entry = self._entries.get(player_id)
+        if entry is None:
+            inc_inventory_cache_miss()
+            return None
+        expires_at, size, inventory_data = entry
+        if expires_at < time.monotonic():
+            self._evict(player_id, 'ttl')
+            inc_inventory_cache_miss()
+            return None
+        self._entries.move_to_end(player_id)
+        inc_inventory_cache_hit()
+        return inventory_data
+
+    def begin_load(self, player_id):
+        load = self._loads.get(player_id)
+        if load is None:
+            self._loads[player_id] = [1, False]
+        else:
+            load[0] += 1
+
+    def end_load(self, player_id, inventory_data=None):
+        load = self._loads[player_id]
+        load[0] -= 1
+        invalidated = load[1]
+        if load[0] == 0:
+            del self._loads[player_id]
+        if inventory_data is not None and not invalidated and not self.suspended:
+            self._put(player_id, inventory_data)
+
+    def invalidate(self, player_id):
+        load = self._loads.get(player_id)
+        if load is not None:
+            load[1] = True
+        if player_id in self._entries:
+            self._evict(player_id, 'invalidate')
+
+    def clear(self):
+        for load in self._loads.values():
+            load[1] = True
+        self._entries.clear()
+        self.memory_used = 0
+        set_inventory_cache_size(0, 0)
+
+    # while suspended every read goes to DB, used when invalidations from other workers may be lost
+    def suspend(self):
+        self.suspended = True
+        self.clear()
+
+    def resume(self):
+        self.clear()
+        self.suspended = False
+
+    def _put(self, player_id, inventory_data):
+        if player_id in self._entries:
+            self._evict(player_id, 'replace')
+        size = estimate_inventory_size(inventory_data)
+        if size > self.max_memory:
+            return
+        while self.memory_used + size > self.max_memory:
+            oldest = next(iter(self._entries))
+            self._evict(oldest, 'memory')
+        self._entries[player_id] = (time.monotonic() + self.ttl, size, inventory_data)
+        self.memory_used += size
+        set_inventory_cache_size(len(self._entries), self.memory_used)
+
+    def _evict(self, player_id, reason):
+        _, size, _ = self._entries.pop(player_id)
+        self.memory_used -= size
+        if reason != 'replace':
+            inc_inventory_cache_eviction(reason)
+        set_inventory_cache_size(len(self._entries), self.memory_used)
@@ -0,0 +1,45 @@
+import asyncio
+import collections
+
+
+# Concurrency limit that can be changed at runtime, waiters are served in FIFO order
+class ConcurrencyLimiter:
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self._waiters = collections.deque()
+
+    async def acquire(self):
+        if self.in_use < self.limit and not self._waiters:
+            self.in_use += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over right before the cancellation
+                self.release()
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def release(self):
+        self.in_use -= 1
+        self._wake_up()
+
+    def set_limit(self, limit):
+        self.limit = limit
+        self._wake_up()
+
+    def _wake_up(self):
+        while self._waiters and self.in_use < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_use += 1
+                waiter.set_result(None)
@@ -0,0 +1,80 @@
+import asyncio
+import gc
+import logging
+import time
+
+from monitoring import inc_event_loop_slow_callback, record_event_loop_lag, record_gc_pause, set_event_loop_tasks
+
+
+# Always-on event loop metrics of a worker:
+# - lag: a timer fires every lag_interval_ms, how late it fires is how long ready callbacks waited;
+# - slow callbacks: every callback and task step is timed, the ones longer than slow_callback_ms
+#   are counted, like asyncio debug mode does, but without the rest of debug mode overhead;
+# - GC pauses: gc.callbacks are called at start and stop of every collection;
+# - live tasks, counted every tasks_interval_seconds, asyncio.all_tasks() copies a weak set.
+class LoopMonitor:
+    def __init__(self, lag_interval_ms=100, slow_callback_ms=100, tasks_interval_seconds=1.0):
+        self.lag_interval = lag_interval_ms / 1000.0
+        self.slow_callback = slow_callback_ms / 1000.0
+        self.tasks_interval = tasks_interval_seconds
+        self._task = None
+        self._gc_started = None
+        self._original_handle_run = None
+
+    def start(self):
+        gc.callbacks.append(self._on_gc)
+        if self.slow_callback > 0:
+            self._patch_handle_run()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+        if self._original_handle_run is not None:
+            asyncio.events.Handle._run = self._original_handle_run
+            self._original_handle_run = None
+
+    def _patch_handle_run(self):
+        # Handle._run runs every callback of the loop, task steps included, TimerHandle inherits it
+        original_run = asyncio.events.Handle._run
+        slow_callback = self.slow_callback
+        perf_counter = time.perf_counter
+
+        def _run(handle):
+            started = perf_counter()
+            original_run(handle)
+            if perf_counter() - started > slow_callback:
+                inc_event_loop_slow_callback()
+
+        self._original_handle_run = original_run
+        asyncio.events.Handle._run = _run
+
+    def _on_gc(self, phase, info):
+        if phase == 'start':
+            self._gc_started = time.perf_counter()
+        elif self._gc_started is not None:
+            record_gc_pause(info['generation'], time.perf_counter() - self._gc_started)
+            self._gc_started = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        tasks_counted_at = 0.0
+        while True:
+            expected = loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            now = loop.time()
+            record_event_loop_lag(max(0.0, now - expected))
+            if now - tasks_counted_at >= self.tasks_interval:
+                tasks_counted_at = now
+                try:
+                    set_event_loop_tasks(len(asyncio.all_tasks(loop)))
+                except RuntimeError:
+                    # the weak set of tasks changed while it was copied, counted next time
+                    logging.debug('Failed to count tasks, will retry')
@@ -2,16 +2,45 @@ import argparse
 import asyncio
 import pathlib
 import logging
-import json
+import os
+import time
 
 import asyncpg
 from aiohttp_swagger3 import SwaggerFile, SwaggerUiSettings, ReDocUiSettings
 from aiohttp import web
 import yaml
 
-from monitoring import metrics_view, monitoring_middleware
+import serializer
+from admission import create_limits, make_admission_middleware
+from monitoring import configure_monitoring, metrics_view, monitoring_middleware, set_startup_time
 from error import error_middleware
-from view import get_inventory, grant_item, grant_item_stored_trx
+from db_pool import AdaptivePoolController, InstrumentedPool
+from event_log_writer import EventLogWriter
+from grant_batcher import GrantBatcher
+from grants import BATCH_GRANT_WRITERS, GRANT_ENGINES, SINGLE_GRANT_WRITERS
+from hot_rows import HotRowSerializer
+from inventory_cache import InventoryCache
+from limiter import ConcurrencyLimiter
+from loop_monitor import LoopMonitor
+from recent_trx_filter import RecentTrxFilter
+from replicas import Replica, ReplicaRouter
+from request_validation import (
+    VALIDATION_MODES, compile_request_validators, make_validation_middleware, msgpack_media_type_handler
+)
+from cache_invalidation import CacheInvalidationChannel
+from catalog import Catalog
+from event_history import EventHistory
+from ensure_partitions_created import get_partition_settings, run_maintenance_loop
+from statements import REPLICA_STATEMENT_REGISTRY, prepare_statements, warm_up_pool
+from profiler import SamplingProfiler, profile_view
+from supervisor import WorkerSupervisor, prepare_multiprocess_metrics_dir
+from view import (
+    consume_item, create_catalog_item, delete_catalog_item, get_catalog, get_event_history, get_inventory,
+    get_inventory_batch, grant_item, grant_item_batch, grant_item_stored_trx, update_catalog_item
+)
+
+ASYNCPG_DEFAULT_MIN_SIZE = 10
+ASYNCPG_DEFAULT_MAX_SIZE = 10
 
 
 def load_config(config_path):
@@ -30,16 +59,192 @@ def get_database_settings(config):
     return database_settings
 
 
-async def init_dbconn_callback(conn):
+async def set_type_codecs(conn):
     await conn.set_type_codec(
         'jsonb',
-        encoder=json.dumps,
-        decoder=json.loads,
-        schema='pg_catalog'
+        encoder=serializer.encode_jsonb,
+        decoder=serializer.decode_jsonb,
+        schema='pg_catalog',
+        format='binary'
     )
 
 
-async def main():
+async def init_dbconn_callback(conn):
+    await set_type_codecs(conn)
+    await prepare_statements(conn)
+
+
+async def init_replica_conn_callback(conn):
+    await set_type_codecs(conn)
+    await prepare_statements(conn, REPLICA_STATEMENT_REGISTRY)
+
+
+def get_replica_settings(config):
+    replica_settings = config.get('database_replicas', {})
+    return replica_settings
+
+
+def get_db_pool_settings(config):
+    db_pool_settings = config.get('db_pool', {})
+    return db_pool_settings
+
+
+def get_admission_control_settings(config):
+    admission_settings = config.get('admission_control', {})
+    return admission_settings
+
+
+def get_grant_settings(config):
+    grant_settings = config.get('grants', {})
+    return grant_settings
+
+
+def get_grant_batching_settings(config):
+    batching_settings = config.get('grant_batching', {})
+    return batching_settings
+
+
+def get_catalog_settings(config):
+    catalog_settings = config.get('catalog', {})
+    return catalog_settings
+
+
+def get_event_history_settings(config):
+    event_history_settings = config.get('event_history', {})
+    return event_history_settings
+
+
+def get_loop_monitor_settings(config):
+    loop_monitor_settings = config.get('loop_monitor', {})
+    return loop_monitor_settings
+
+
+def get_profiler_settings(config):
+    profiler_settings = config.get('profiler', {})
+    return profiler_settings
+
+
+def get_hot_rows_settings(config):
+    hot_rows_settings = config.get('hot_rows', {})
+    return hot_rows_settings
+
+
+def get_event_log_settings(config):
+    event_log_settings = config.get('event_log', {})
+    return event_log_settings
+
+
+def get_recent_trx_filter_settings(config):
+    filter_settings = config.get('recent_trx_filter', {})
+    return filter_settings
+
+
+def get_inventory_cache_settings(config):
+    cache_settings = config.get('inventory_cache', {})
+    return cache_settings
+
+
+def get_json_settings(config):
+    json_settings = config.get('json', {})
+    return json_settings
+
+
+def get_monitoring_settings(config):
+    monitoring_settings = config.get('monitoring', {})
+    return monitoring_settings
+
+
+def get_pool_warm_up_settings(config):
+    warm_up_settings = config.get('pool_warm_up', {})
+    return warm_up_settings
+
+
+def get_cache_invalidation_settings(config):
+    invalidation_settings = config.get('cache_invalidation', {})
+    return invalidation_settings
+
+
+def get_connection_settings(db_settings):
+    # pool-only options are not accepted by asyncpg.connect
+    pool_options = ('min_size', 'max_size', 'max_queries', 'max_inactive_connection_lifetime')
+    return {key: value for key, value in db_settings.items() if key not in pool_options}
+
+
+async def start_catalog(app):
+    await app.catalog.start()
+
+
+async def stop_catalog(app):
+    await app.catalog.stop()
+
+
+async def start_loop_monitor(app):
+    app.loop_monitor.start()
+
+
+async def stop_loop_monitor(app):
+    await app.loop_monitor.stop()
+
+
+async def stop_hot_rows(app):
+    await app.hot_rows.stop()
+
+
+async def start_event_log_writer(app):
+    await app.event_log_writer.start()
+
+
+async def stop_event_log_writer(app):
+    await app.event_log_writer.stop()
+
+
+async def start_grant_batcher(app):
+    app.grant_batcher.start()
+
+
+async def stop_grant_batcher(app):
+    await app.grant_batcher.stop()
+
+
+async def start_pool_controller(app):
+    app.pool_controller.start()
+
+
+async def stop_pool_controller(app):
+    await app.pool_controller.stop()
+
+
+async def start_replica_router(app):
+    await app.replica_router.start()
+
+
+async def stop_replica_router(app):
+    await app.replica_router.stop()
+
+
+async def start_partition_maintenance(app):
+    app.partition_maintenance_task = asyncio.get_running_loop().create_task(
+        run_maintenance_loop(app.db_pool, get_partition_settings(app.config))
+    )
+
+
+async def stop_partition_maintenance(app):
+    app.partition_maintenance_task.cancel()
+    try:
+        await app.partition_maintenance_task
+    except asyncio.CancelledError:
+        pass
+
+
+async def start_cache_invalidation(app):
+    app.cache_invalidation.start()
+
+
+async def stop_cache_invalidation(app):
+    await app.cache_invalidation.stop()
+
+
+def parse_args():
     parser = argparse.ArgumentParser(description='Inventory Service')
     parser.add_argument(
         '--config', '-c', 
@@ -56,48 +261,323 @@ async def main():
         '--disable-request-validation',
         default=False,
         action='store_true',
-        help='Disable request validation using openapi schema(for perf testing).'
+        help='Disable request validation using openapi schema(for perf testing), same as --request-validation none.'
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        '--request-validation',
+        choices=VALIDATION_MODES,
+        default='swagger',
+        help='How requests are validated against openapi schema: swagger (aiohttp_swagger3, default), '
+             'compiled (schemas compiled to python functions at startup) or none'
+    )
+    parser.add_argument(
+        '--host',
+        default='0.0.0.0',
+        help='Host to listen on, 0.0.0.0 by default'
+    )
+    parser.add_argument(
+        '--port', '-p',
+        type=int,
+        default=8080,
+        help='Port to listen on, 8080 by default'
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        default=1,
+        help='Number of worker processes sharing the port with SO_REUSEPORT, 1 by default'
+    )
+    return parser.parse_args()
 
-    config = load_config(args.config)
-    db_settings = get_database_settings(config)
 
+def setup_logging(args, worker_id=None):
     log_format = '%(asctime)s; %(levelname)s; %(message)s'
+    if worker_id is not None:
+        log_format = f'%(asctime)s; %(levelname)s; worker {worker_id}; %(message)s'
     logging.basicConfig(level=args.log_level.upper(), format=log_format)
 
-    pool = await asyncpg.create_pool(**db_settings, init=init_dbconn_callback)
+
+def get_worker_database_settings(db_settings, workers):
+    # the configured pool size is shared between all workers
+    if workers <= 1:
+        return db_settings
+    worker_db_settings = dict(db_settings)
+    max_size = max(1, db_settings.get('max_size', ASYNCPG_DEFAULT_MAX_SIZE) // workers)
+    worker_db_settings['max_size'] = max_size
+    worker_db_settings['min_size'] = min(db_settings.get('min_size', ASYNCPG_DEFAULT_MIN_SIZE), max_size)
+    return worker_db_settings
+
+
+async def main():
+    args = parse_args()
+    config = load_config(args.config)
+    setup_logging(args)
+    return await create_app(args, config)
+
+
+async def create_app(args, config, workers=1, worker_id=None):
+    startup_started = time.monotonic()
+    serializer.configure(get_json_settings(config).get('backend', 'auto'))
+    configure_monitoring(
+        histogram_sample_rate=get_monitoring_settings(config).get('histogram_sample_rate', 1.0)
+    )
+    db_settings = get_database_settings(config)
+
+    worker_db_settings = get_worker_database_settings(db_settings, workers)
+    pool_settings = get_db_pool_settings(config)
+    max_size = worker_db_settings.get('max_size', ASYNCPG_DEFAULT_MAX_SIZE)
+    limiter = None
+    if pool_settings.get('adaptive_sizing', False):
+        # starts from the upper bound, so enabling it never makes the pool smaller than before
+        limiter = ConcurrencyLimiter(max_size)
+    pool = InstrumentedPool(
+        await asyncpg.create_pool(**worker_db_settings, init=init_dbconn_callback),
+        acquire_timeout=pool_settings.get('acquire_timeout_seconds'),
+        limiter=limiter,
+    )
+    if get_pool_warm_up_settings(config).get('enabled', False):
+        await warm_up_pool(pool, worker_db_settings.get('min_size', ASYNCPG_DEFAULT_MIN_SIZE))
     middlewares = [
         monitoring_middleware,
         error_middleware,
     ]
+    admission_settings = get_admission_control_settings(config)
+    if admission_settings.get('enabled', False):
+        # before validation, so shed requests cost as little as possible
+        middlewares.append(make_admission_middleware(
+            create_limits(admission_settings),
+            max_queue_ms=admission_settings.get('max_queue_ms', 50),
+            max_queue_size=admission_settings.get('max_queue_size', 1000),
+        ))
+    request_validation = args.request_validation
+    if args.disable_request_validation:
+        request_validation = 'none'
+    spec_path = str(pathlib.Path(__file__).parent / 'openapi_spec.yaml')
+    if request_validation == 'compiled':
+        # swagger docs stay, only validation is done by the middleware
+        middlewares.append(make_validation_middleware(compile_request_validators(spec_path)))
 
     app = web.Application(middlewares=middlewares)
     app.db_pool = pool
     app.config = config
-    need_request_validation = True
-    if args.disable_request_validation:
-        need_request_validation = False
+
+    app.loop_monitor = None
+    loop_monitor_settings = get_loop_monitor_settings(config)
+    if loop_monitor_settings.get('enabled', True):
+        app.loop_monitor = LoopMonitor(
+            lag_interval_ms=loop_monitor_settings.get('lag_interval_ms', 100),
+            slow_callback_ms=loop_monitor_settings.get('slow_callback_ms', 100),
+            tasks_interval_seconds=loop_monitor_settings.get('tasks_interval_seconds', 1),
+        )
+        app.on_startup.append(start_loop_monitor)
+        app.on_cleanup.append(stop_loop_monitor)
+
+    app.profiler = None
+    profiler_settings = get_profiler_settings(config)
+    if profiler_settings.get('enabled', False):
+        app.profiler = SamplingProfiler(max_seconds=profiler_settings.get('max_seconds', 60))
+
+    app.replica_router = None
+    replica_settings = get_replica_settings(config)
+    if replica_settings.get('enabled', False):
+        replicas = []
+        for replica_db_settings in replica_settings.get('replicas', []):
+            # connection settings not given for a replica are taken from database section
+            replica_db_settings = {**db_settings, **replica_db_settings}
+            name = replica_db_settings.pop('name', None)
+            if name is None:
+                name = f"{replica_db_settings.get('host')}:{replica_db_settings.get('port')}"
+            replicas.append(Replica(name, get_worker_database_settings(replica_db_settings, workers)))
+
+        async def create_replica_pool(replica_pool_settings):
+            return await asyncpg.create_pool(**replica_pool_settings, init=init_replica_conn_callback)
+
+        app.replica_router = ReplicaRouter(
+            pool,
+            replicas,
+            create_replica_pool,
+            healthcheck_interval_seconds=replica_settings.get('healthcheck_interval_seconds', 1),
+            max_lag_bytes=replica_settings.get('max_lag_bytes', 16 * 1024 * 1024),
+            acquire_timeout_seconds=replica_settings.get('acquire_timeout_seconds', 0.1),
+            read_your_writes_wait_ms=replica_settings.get('read_your_writes_wait_ms', 20),
+            lsn_poll_interval_ms=replica_settings.get('lsn_poll_interval_ms', 2),
+        )
+        app.on_startup.append(start_replica_router)
+        app.on_cleanup.append(stop_replica_router)
+
+    app.pool_controller = None
+    if limiter is not None:
+        app.pool_controller = AdaptivePoolController(
+            pool,
+            min_size=min(pool_settings.get('adaptive_min_size', 1), max_size),
+            max_size=max_size,
+            interval_seconds=pool_settings.get('adaptive_interval_seconds', 1),
+            target_acquire_wait_ms=pool_settings.get('target_acquire_wait_ms', 5),
+            max_db_latency_ms=pool_settings.get('max_db_latency_ms', 20),
+        )
+        app.on_startup.append(start_pool_controller)
+        app.on_cleanup.append(stop_pool_controller)
+
+    # catalog reads and ?enrich=true are served from the in-memory snapshot
+    app.catalog = Catalog(
+        pool,
+        refresh_interval_seconds=get_catalog_settings(config).get('refresh_interval_seconds', 30),
+    )
+    app.on_startup.append(start_catalog)
+    app.on_cleanup.append(stop_catalog)
+
+    history_settings = get_event_history_settings(config)
+    app.event_history = EventHistory(
+        max_range_days=history_settings.get('max_range_days', 93),
+        max_page_size=history_settings.get('max_page_size', 10000),
+        default_page_size=history_settings.get('default_page_size', 1000),
+        prefetch=history_settings.get('prefetch', 500),
+        max_concurrent_exports=history_settings.get('max_concurrent_exports', 4),
+    )
+
+    app.inventory_cache = None
+    cache_settings = get_inventory_cache_settings(config)
+    if cache_settings.get('enabled', False):
+        app.inventory_cache = InventoryCache(
+            ttl_seconds=cache_settings.get('ttl_seconds', 5),
+            max_memory_mb=cache_settings.get('max_memory_mb', 64),
+        )
+
+    app.cache_invalidation = None
+    invalidation_settings = get_cache_invalidation_settings(config)
+    if app.inventory_cache is not None and invalidation_settings.get('enabled', False):
+        app.cache_invalidation = CacheInvalidationChannel(
+            app.inventory_cache,
+            get_connection_settings(db_settings),
+            channel=invalidation_settings.get('channel', 'inventory_cache_invalidation'),
+            notify_interval_ms=invalidation_settings.get('notify_interval_ms', 20),
+            reconnect_interval_seconds=invalidation_settings.get('reconnect_interval_seconds', 1),
+            healthcheck_interval_seconds=invalidation_settings.get('healthcheck_interval_seconds', 5),
+        )
+        app.on_startup.append(start_cache_invalidation)
+        app.on_cleanup.append(stop_cache_invalidation)
+
+    app.recent_trx_filter = None
+    filter_settings = get_recent_trx_filter_settings(config)
+    if filter_settings.get('enabled', False):
+        app.recent_trx_filter = RecentTrxFilter(
+            window_seconds=filter_settings.get('window_seconds', 300),
+            max_keys=filter_settings.get('max_keys', 100000),
+            verify_sample_rate=filter_settings.get('verify_sample_rate', 0.01),
+        )
+
+    app.event_log_writer = None
+    event_log_settings = get_event_log_settings(config)
+    if event_log_settings.get('enabled', False):
+        spool_dir = event_log_settings.get('spool_dir')
+        if spool_dir is not None and worker_id is not None:
+            # every worker replays only its own spool
+            spool_dir = os.path.join(spool_dir, f'worker_{worker_id}')
+        app.event_log_writer = EventLogWriter(
+            pool,
+            max_buffer_size=event_log_settings.get('max_buffer_size', 100000),
+            max_batch_size=event_log_settings.get('max_batch_size', 5000),
+            flush_interval_ms=event_log_settings.get('flush_interval_ms', 100),
+            spool_dir=spool_dir,
+            spool_fsync=event_log_settings.get('spool_fsync', False),
+        )
+        app.on_startup.append(start_event_log_writer)
+
+    app.grant_engine = get_grant_settings(config).get('engine', 'inline')
+    if app.grant_engine not in GRANT_ENGINES:
+        raise Exception(f"Unknown grant engine '{app.grant_engine}', possible values: {', '.join(GRANT_ENGINES)}")
+
+    app.grant_batcher = None
+    batching_settings = get_grant_batching_settings(config)
+    if batching_settings.get('enabled', False):
+        app.grant_batcher = GrantBatcher(
+            pool,
+            max_batch_size=batching_settings.get('max_batch_size', 100),
+            flush_interval_ms=batching_settings.get('flush_interval_ms', 5),
+            max_concurrent_flushes=batching_settings.get('max_concurrent_flushes'),
+            event_log_writer=app.event_log_writer,
+            write_batch=BATCH_GRANT_WRITERS[app.grant_engine],
+            write_single=SINGLE_GRANT_WRITERS[app.grant_engine],
+            read_tokens=app.replica_router is not None,
+        )
+        app.on_startup.append(start_grant_batcher)
+        app.on_cleanup.append(stop_grant_batcher)
+
+    app.hot_rows = None
+    hot_rows_settings = get_hot_rows_settings(config)
+    if hot_rows_settings.get('enabled', False):
+        app.hot_rows = HotRowSerializer(
+            pool,
+            max_merge_size=hot_rows_settings.get('max_merge_size', 100),
+            event_log_writer=app.event_log_writer,
+            read_tokens=app.replica_router is not None,
+        )
+        app.on_cleanup.append(stop_hot_rows)
+
+    if app.event_log_writer is not None:
+        # after grant batcher and hot rows, so events of the last flushed writes are written too
+        app.on_cleanup.append(stop_event_log_writer)
+
+    if get_partition_settings(config).get('in_app_maintenance', False):
+        # runs in every worker, an advisory lock makes sure only one of them does the work at a time
+        app.on_startup.append(start_partition_maintenance)
+        app.on_cleanup.append(stop_partition_maintenance)
 
     swagger = SwaggerFile(
         app,
         redoc_ui_settings=ReDocUiSettings(path='/docs'),
         swagger_ui_settings=SwaggerUiSettings(path='/swagger'),
-        spec_file=str(pathlib.Path(__file__).parent / 'openapi_spec.yaml'),
-        validate=need_request_validation
+        spec_file=spec_path,
+        validate=request_validation == 'swagger'
     )
-    swagger.add_routes([
+    if request_validation == 'swagger':
+        # requestBody of /v1/inventory/* routes lists application/msgpack next to application/json
+        swagger.register_media_type_handler(serializer.MSGPACK_CONTENT_TYPE, msgpack_media_type_handler)
+    routes = [
          web.get('/metrics', metrics_view),
          web.post('/v1/inventory/get', get_inventory),
+         web.post('/v1/inventory/get_batch', get_inventory_batch),
          web.post('/v1/inventory/grant', grant_item),
+         web.post('/v1/inventory/grant_batch', grant_item_batch),
+         web.post('/v1/inventory/consume', consume_item),
+         web.post('/v1/inventory/catalog/get', get_catalog),
+         web.post('/v1/inventory/catalog/create', create_catalog_item),
+         web.post('/v1/inventory/catalog/update', update_catalog_item),
+         web.post('/v1/inventory/catalog/delete', delete_catalog_item),
+         web.post('/v1/inventory/events/history', get_event_history),
         web.post('/internal/inventory/grant_stored_trx', grant_item_stored_trx),
-    ])
+    ]
+    if app.profiler is not None:
+        routes.append(web.get('/internal/profile', profile_view))
+    swagger.add_routes(routes)
 
     # Add other routes for the remaining API endpoints
+
+    async def record_startup_time(_app):
+        set_startup_time(time.monotonic() - startup_started)
+
+    # appended last, so it runs after all other startup hooks
+    app.on_startup.append(record_startup_time)
     return app
 
+
+def run_worker(worker_id, args, config):
+    setup_logging(args, worker_id)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app = loop.run_until_complete(create_app(args, config, workers=args.workers, worker_id=worker_id))
+    web.run_app(app, host=args.host, port=args.port, reuse_port=True, loop=loop)
+
+
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    app = loop.run_until_complete(main())
-    web.run_app(app, loop=loop)
+    args = parse_args()
+    if args.workers > 1:
+        config = load_config(args.config)
+        setup_logging(args)
+        prepare_multiprocess_metrics_dir()
+        WorkerSupervisor(run_worker, args.workers, args=(args, config)).run()
+    else:
+        loop = asyncio.get_event_loop()
+        app = loop.run_until_complete(main())
+        web.run_app(app, host=args.host, port=args.port, loop=loop)
 
@@ -1,9 +1,16 @@
+import os
+import random
 import time
-import json
 
-from prometheus_client import Counter, Histogram, CollectorRegistry, generate_latest
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, generate_latest, multiprocess
 from aiohttp import web
 
+# requests after start tracked separately to see the latency of a cold process
+FIRST_REQUESTS_WINDOW = 1000
+# requests that matched no route are labeled with one path, so random URLs don't create new label sets
+UNKNOWN_ROUTE_LABEL = 'unknown'
+KNOWN_METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'))
+
 metric_registry = CollectorRegistry()
 api_request_counter = Counter(
     'api_request_count', 'Inventory API request count',
@@ -15,63 +22,497 @@ api_response_time_hist = Histogram(
     ['path', 'method', 'status', 'http_code'],
     registry=metric_registry
 )
+grant_batch_size_hist = Histogram(
+    'grant_batch_size', 'Number of grants written in one group-commit batch',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+    registry=metric_registry
+)
+grant_batch_flush_interval_hist = Histogram(
+    'grant_batch_flush_interval_seconds', 'Time a grant batch was collected before flush',
+    buckets=(.0005, .001, .002, .005, .01, .025, .05, .1, .25),
+    registry=metric_registry
+)
+inventory_consume_counter = Counter(
+    'inventory_consume_count', 'Results of /v1/inventory/consume',
+    ['result'],
+    registry=metric_registry
+)
+hot_row_merge_size_hist = Histogram(
+    'hot_row_merge_size', 'Consumes and grants of one inventory row written by one merged transaction',
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100, 200),
+    registry=metric_registry
+)
+catalog_reload_counter = Counter(
+    'catalog_reload_count', 'Catalog reloads from DB',
+    ['result'],
+    registry=metric_registry
+)
+catalog_items_gauge = Gauge(
+    'catalog_items', 'Items in the current catalog snapshot',
+    multiprocess_mode='livemax',
+    registry=metric_registry
+)
+event_history_export_counter = Counter(
+    'event_history_export_count', 'Event history pages streamed by result',
+    ['result'],
+    registry=metric_registry
+)
+event_history_rows_counter = Counter(
+    'event_history_rows_count', 'Event history rows streamed',
+    registry=metric_registry
+)
+event_loop_lag_hist = Histogram(
+    'event_loop_lag_seconds', 'Delay of a periodic event loop timer behind its schedule',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+    registry=metric_registry
+)
+event_loop_slow_callback_counter = Counter(
+    'event_loop_slow_callback_count', 'Event loop callbacks and task steps longer than slow_callback_ms',
+    registry=metric_registry
+)
+event_loop_tasks_gauge = Gauge(
+    'event_loop_tasks', 'Live asyncio tasks',
+    multiprocess_mode='livesum',
+    registry=metric_registry
+)
+gc_pause_hist = Histogram(
+    'gc_pause_seconds', 'Duration of garbage collections, the event loop is stopped while they run',
+    ['generation'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+    registry=metric_registry
+)
+inventory_cache_hit_counter = Counter(
+    'inventory_cache_hit_count', 'Inventory cache hits',
+    registry=metric_registry
+)
+inventory_cache_miss_counter = Counter(
+    'inventory_cache_miss_count', 'Inventory cache misses',
+    registry=metric_registry
+)
+inventory_cache_eviction_counter = Counter(
+    'inventory_cache_eviction_count', 'Inventory cache evictions',
+    ['reason'],
+    registry=metric_registry
+)
+inventory_cache_entries_gauge = Gauge(
+    'inventory_cache_entries', 'Number of players in inventory cache',
+    multiprocess_mode='livesum',
+    registry=metric_registry
+)
+inventory_cache_memory_gauge = Gauge(
+    'inventory_cache_memory_bytes', 'Estimated memory used by inventory cache',
+    multiprocess_mode='livesum',
+    registry=metric_registry
+)
+cache_invalidation_notify_counter = Counter(
+    'cache_invalidation_notify_count', 'pg_notify messages sent with cache invalidations',
+    registry=metric_registry
+)
+cache_invalidation_published_counter = Counter(
+    'cache_invalidation_published_count', 'Player ids published for cache invalidation',
+    registry=metric_registry
+)
+cache_invalidation_received_counter = Counter(
+    'cache_invalidation_received_count', 'Player ids received for cache invalidation from other workers',
+    registry=metric_registry
+)
+cache_invalidation_reconnect_counter = Counter(
+    'cache_invalidation_reconnect_count', 'Cache invalidation listener reconnects',
+    registry=metric_registry
+)
+startup_time_gauge = Gauge(
+    'app_startup_seconds', 'Time from app creation till it is ready to accept traffic, pool warm-up included',
+    multiprocess_mode='max',
+    registry=metric_registry
+)
+first_requests_response_time_hist = Histogram(
+    'api_first_requests_response_time_seconds',
+    f'Inventory API request time of the first {FIRST_REQUESTS_WINDOW} requests after start',
+    ['path'],
+    registry=metric_registry
+)
+event_log_queue_depth_gauge = Gauge(
+    'event_log_queue_depth', 'Events waiting to be written to log_player_event',
+    multiprocess_mode='livesum',
+    registry=metric_registry
+)
+event_log_written_counter = Counter(
+    'event_log_written_count', 'Events written to log_player_event by the async writer',
+    registry=metric_registry
+)
+event_log_flush_failed_counter = Counter(
+    'event_log_flush_failed_count', 'Failed attempts to write events to log_player_event',
+    registry=metric_registry
+)
+event_log_backpressure_counter = Counter(
+    'event_log_backpressure_count', 'Times a request waited for free space in the event buffer',
+    registry=metric_registry
+)
+recent_trx_filter_lookup_counter = Counter(
+    'recent_trx_filter_lookup_count', 'Lookups of grants in recent ext_trx_id filter',
+    ['result'],
+    registry=metric_registry
+)
+recent_trx_filter_verified_counter = Counter(
+    'recent_trx_filter_verified_count', 'Filter hits checked against DB',
+    registry=metric_registry
+)
+recent_trx_filter_false_positive_counter = Counter(
+    'recent_trx_filter_false_positive_count', 'Filter hits that DB did not confirm as duplicates',
+    registry=metric_registry
+)
+recent_trx_filter_keys_gauge = Gauge(
+    'recent_trx_filter_keys', 'Number of keys in recent ext_trx_id filter',
+    multiprocess_mode='livesum',
+    registry=metric_registry
+)
+db_pool_acquire_time_hist = Histogram(
+    'db_pool_acquire_seconds', 'Time waited for a connection from the pool',
+    buckets=(.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0),
+    registry=metric_registry
+)
+db_pool_hold_time_hist = Histogram(
+    'db_pool_hold_seconds', 'Time a connection was used between acquire and release',
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0),
+    registry=metric_registry
+)
+db_pool_queries_hist = Histogram(
+    'db_pool_queries_per_acquire', 'Queries run on a connection between acquire and release',
+    buckets=(1, 2, 3, 4, 5, 10, 20, 50),
+    registry=metric_registry
+)
+db_pool_acquire_timeout_counter = Counter(
+    'db_pool_acquire_timeout_count', 'Acquires failed with 503 after acquire_timeout_seconds',
+    registry=metric_registry
+)
+db_pool_in_use_gauge = Gauge(
+    'db_pool_connections_in_use', 'Connections acquired from the pool',
+    multiprocess_mode='livesum',
+    registry=metric_registry
+)
+db_pool_size_gauge = Gauge(
+    'db_pool_connections', 'Open connections of the pool',
+    multiprocess_mode='livesum',
+    registry=metric_registry
+)
+db_pool_limit_gauge = Gauge(
+    'db_pool_limit', 'Limit of connections in use set by adaptive pool sizing',
+    multiprocess_mode='livesum',
+    registry=metric_registry
+)
+admission_shed_counter = Counter(
+    'admission_shed_count', 'Requests rejected with 503 by admission control',
+    ['route_class', 'reason'],
+    registry=metric_registry
+)
+admission_limit_gauge = Gauge(
+    'admission_limit', 'Concurrency limit of a route class set by admission control',
+    ['route_class'],
+    multiprocess_mode='livesum',
+    registry=metric_registry
+)
+admission_in_flight_gauge = Gauge(
+    'admission_in_flight', 'Requests of a route class admitted and not finished',
+    ['route_class'],
+    multiprocess_mode='livesum',
+    registry=metric_registry
+)
+replica_read_counter = Counter(
+    'replica_read_count', 'Reads routed by replica router',
+    ['target', 'reason'],
+    registry=metric_registry
+)
+replica_healthy_gauge = Gauge(
+    'replica_healthy', 'Replica passed the last health check (1) or not (0)',
+    ['replica'],
+    multiprocess_mode='livemin',
+    registry=metric_registry
+)
+replica_lag_gauge = Gauge(
+    'replica_lag_bytes', 'WAL bytes the replica has not replayed yet',
+    ['replica'],
+    multiprocess_mode='livemax',
+    registry=metric_registry
+)
+metrics_scrape_time_hist = Histogram(
+    'metrics_scrape_seconds', 'Time spent in generate_latest for /metrics',
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0),
+    registry=metric_registry
+)
+metrics_scrape_size_gauge = Gauge(
+    'metrics_scrape_size_bytes', 'Size of the last /metrics response',
+    multiprocess_mode='max',
+    registry=metric_registry
+)
+served_requests = 0
+api_metrics_cache = {}
+recent_trx_filter_lookup_children = {}
+admission_in_flight_children = {}
+replica_read_children = {}
+inventory_consume_children = {}
+gc_pause_children = {}
+# share of requests observed in api_response_time_hist, counters always see every request
+response_time_sample_rate = 1.0
+
+
+def get_api_metrics(path, method, status, http_code, error_code=None):
+    # .labels() hashes and validates label values on every call, children are cached instead
+    key = (path, method, status, http_code, error_code)
+    metrics = api_metrics_cache.get(key)
+    if metrics is None:
+        metrics = (
+            api_request_counter.labels(
+                path=path,
+                method=method,
+                status=status,
+                http_code=http_code,
+                error_code=error_code
+            ),
+            api_response_time_hist.labels(
+                path=path,
+                method=method,
+                status=status,
+                http_code=http_code
+            )
+        )
+        api_metrics_cache[key] = metrics
+    return metrics
+
+
+def configure_monitoring(histogram_sample_rate=1.0):
+    global response_time_sample_rate
+    response_time_sample_rate = histogram_sample_rate
+
+
+def set_startup_time(startup_time):
+    startup_time_gauge.set(startup_time)
+
+
+def record_grant_batch(batch_size, flush_interval):
+    grant_batch_size_hist.observe(batch_size)
+    grant_batch_flush_interval_hist.observe(flush_interval)
+
+
+def inc_inventory_consume(result):
+    counter = inventory_consume_children.get(result)
+    if counter is None:
+        counter = inventory_consume_children[result] = inventory_consume_counter.labels(result=result)
+    counter.inc()
+
+
+def record_hot_row_merge(size):
+    hot_row_merge_size_hist.observe(size)
+
+
+def inc_catalog_reload(result):
+    catalog_reload_counter.labels(result=result).inc()
+
+
+def set_catalog_items(items):
+    catalog_items_gauge.set(items)
+
+
+def inc_event_history_export(result, rows=0):
+    event_history_export_counter.labels(result=result).inc()
+    if rows:
+        event_history_rows_counter.inc(rows)
+
+
+def record_event_loop_lag(lag):
+    event_loop_lag_hist.observe(lag)
+
+
+def inc_event_loop_slow_callback():
+    event_loop_slow_callback_counter.inc()
+
+
+def set_event_loop_tasks(tasks):
+    event_loop_tasks_gauge.set(tasks)
+
+
+def record_gc_pause(generation, duration):
+    hist = gc_pause_children.get(generation)
+    if hist is None:
+        hist = gc_pause_children[generation] = gc_pause_hist.labels(generation=generation)
+    hist.observe(duration)
+
+
+def inc_inventory_cache_hit():
+    inventory_cache_hit_counter.inc()
+
+
+def inc_inventory_cache_miss():
+    inventory_cache_miss_counter.inc()
+
+
+def inc_inventory_cache_eviction(reason):
+    inventory_cache_eviction_counter.labels(reason=reason).inc()
+
+
+def set_inventory_cache_size(entries, memory_bytes):
+    inventory_cache_entries_gauge.set(entries)
+    inventory_cache_memory_gauge.set(memory_bytes)
+
+
+def inc_cache_invalidation_published(notifications, player_ids):
+    cache_invalidation_notify_counter.inc(notifications)
+    cache_invalidation_published_counter.inc(player_ids)
 
 
-def inc_api_request_counter(path, method, status, http_code, error_code=None):
-    api_request_counter.labels(
-        path=path,
-        method=method,
-        status=status,
-        http_code=http_code,
-        error_code=error_code
-    ).inc()
+def inc_cache_invalidation_received(player_ids):
+    cache_invalidation_received_counter.inc(player_ids)
 
 
-def record_api_response_time(latency, path, method, status, http_code):
-    api_response_time_hist.labels(
-        path=path,
-        method=method,
-        status=status,
-        http_code=http_code
-    ).observe(latency)
+def inc_cache_invalidation_reconnect():
+    cache_invalidation_reconnect_counter.inc()
+
+
+def set_event_log_queue_depth(depth):
+    event_log_queue_depth_gauge.set(depth)
+
+
+def inc_event_log_written(events):
+    event_log_written_counter.inc(events)
+
+
+def inc_event_log_flush_failed():
+    event_log_flush_failed_counter.inc()
+
+
+def inc_event_log_backpressure():
+    event_log_backpressure_counter.inc()
+
+
+def inc_recent_trx_filter_lookup(result):
+    # called for every grant, label children are created once
+    counter = recent_trx_filter_lookup_children.get(result)
+    if counter is None:
+        counter = recent_trx_filter_lookup_children[result] = recent_trx_filter_lookup_counter.labels(result=result)
+    counter.inc()
+
+
+def inc_recent_trx_filter_verified():
+    recent_trx_filter_verified_counter.inc()
+
+
+def inc_recent_trx_filter_false_positive():
+    recent_trx_filter_false_positive_counter.inc()
+
+
+def set_recent_trx_filter_size(keys):
+    recent_trx_filter_keys_gauge.set(keys)
+
+
+def record_db_pool_acquire(wait_time, in_use, size):
+    db_pool_acquire_time_hist.observe(wait_time)
+    db_pool_in_use_gauge.set(in_use)
+    db_pool_size_gauge.set(size)
+
+
+def record_db_pool_release(hold_time, queries, in_use, size):
+    db_pool_hold_time_hist.observe(hold_time)
+    if queries is not None:
+        db_pool_queries_hist.observe(queries)
+    db_pool_in_use_gauge.set(in_use)
+    db_pool_size_gauge.set(size)
+
+
+def inc_db_pool_acquire_timeout():
+    db_pool_acquire_timeout_counter.inc()
+
+
+def set_db_pool_limit(limit):
+    db_pool_limit_gauge.set(limit)
+
+
+def inc_admission_shed(route_class, reason):
+    admission_shed_counter.labels(route_class=route_class, reason=reason).inc()
+
+
+def set_admission_limit(route_class, limit):
+    admission_limit_gauge.labels(route_class=route_class).set(limit)
+
+
+def set_admission_in_flight(route_class, in_flight):
+    # called twice for every admitted request, label children are created once
+    gauge = admission_in_flight_children.get(route_class)
+    if gauge is None:
+        gauge = admission_in_flight_children[route_class] = admission_in_flight_gauge.labels(route_class=route_class)
+    gauge.set(in_flight)
+
+
+def inc_replica_read(target, reason):
+    # called for every read, label children are created once
+    counter = replica_read_children.get((target, reason))
+    if counter is None:
+        counter = replica_read_children[(target, reason)] = replica_read_counter.labels(target=target, reason=reason)
+    counter.inc()
+
+
+def set_replica_state(replica, healthy, lag_bytes):
+    replica_healthy_gauge.labels(replica=replica).set(1 if healthy else 0)
+    if lag_bytes is not None:
+        replica_lag_gauge.labels(replica=replica).set(lag_bytes)
 
 
 @web.middleware
 async def monitoring_middleware(request: web.Request, handler) -> web.StreamResponse:
-    start_time = time.time()
-    response = await handler(request)
-    finish_time = time.time()
-    response_time = finish_time - start_time
+    start_time = time.perf_counter()
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        # not found, method not allowed etc. are raised by router, not returned
+        record_request(request, e.status, 'http_error', time.perf_counter() - start_time)
+        raise
+    record_request(request, response.status, response.get('error_code'), time.perf_counter() - start_time)
+    return response
+
+
+def get_route_label(request):
+    resource = request.match_info.route.resource
+    if resource is None:
+        return UNKNOWN_ROUTE_LABEL
+    return resource.canonical
+
 
-    if response.status == 200:
+def record_request(request, http_code, error_code, response_time):
+    if http_code == 200:
         status = 'ok'
         error_code = None
     else:
         status = 'error'
-        try:
-            error_code = json.loads(response.text)['error_code']
-        except ValueError:
+        if error_code is None:
             error_code = 'unknown_code'
 
-    inc_api_request_counter(
-        path=request.path,
-        method=request.method,
-        status=status,
-        http_code=response.status,
-        error_code=error_code
-    )
-    record_api_response_time(
-        response_time,
-        path=request.path,
-        method=request.method,
-        status=status,
-        http_code=response.status
-    )
-    return response
+    path = get_route_label(request)
+    method = request.method
+    if method not in KNOWN_METHODS:
+        method = 'other'
+    request_counter, response_time_hist = get_api_metrics(path, method, status, http_code, error_code)
+    request_counter.inc()
+    if response_time_sample_rate >= 1.0 or random.random() < response_time_sample_rate:
+        response_time_hist.observe(response_time)
+
+    global served_requests
+    if served_requests < FIRST_REQUESTS_WINDOW:
+        served_requests += 1
+        first_requests_response_time_hist.labels(path=path).observe(response_time)
+
+
+def get_metrics_registry():
+    # with several worker processes metrics are aggregated from PROMETHEUS_MULTIPROC_DIR
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return metric_registry
+
 
 async def metrics_view(_request: web.Request):
-    latest_metrics = generate_latest(metric_registry)
-    data = latest_metrics.decode('utf-8')
-    return web.Response(text=data, status=200, content_type="text/plain")
+    start_time = time.perf_counter()
+    latest_metrics = generate_latest(get_metrics_registry())
+    metrics_scrape_time_hist.observe(time.perf_counter() - start_time)
+    metrics_scrape_size_gauge.set(len(latest_metrics))
+    return web.Response(body=latest_metrics, status=200, content_type="text/plain", charset='utf-8')
 
 
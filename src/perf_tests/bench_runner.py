@@ -0,0 +1,317 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import pathlib
+import re
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import asyncpg
+import yaml
+
+from wrk_compare import run_wrk
+
+# Runs wrk scenarios against inventory_service and a local PostgreSQL, stores a versioned JSON result
+# and optionally fails when it regressed against a baseline result:
+# $ python3 bench_runner.py run -c ../inventory.yaml --start-service --python python3.12 \
+#       --baseline results/baseline.json --threshold 5
+# $ python3 bench_runner.py compare results/baseline.json results/<result>.json --threshold 5
+# Docker is not needed: --prepare-db applies db_migrations missing in the database, see README.
+
+SRC_DIR = pathlib.Path(__file__).parent.parent
+sys.path.insert(0, str(SRC_DIR))
+
+from ensure_partitions_created import maintain_partitions  # noqa: E402
+from main import get_connection_settings, get_database_settings  # noqa: E402
+
+RESULT_SCHEMA_VERSION = 1
+DEFAULT_SCENARIOS = ('read', 'write', 'mix', 'write_stored_trx')
+DEFAULT_RESULTS_DIR = pathlib.Path(__file__).parent / 'results'
+MIGRATION_RE = re.compile(r'^V(\d+)__.*\.sql$')
+# version: query telling if the migration is applied. Databases migrated by sdbmigrate or an older
+# bench_runner have no record of versions applied here, so objects created by each migration are looked up
+MIGRATION_CHECKS = {
+    0: "SELECT to_regclass('player_inventory') IS NOT NULL",
+    1: "SELECT to_regclass('player_inventory_trx') IS NOT NULL",
+    2: "SELECT to_regproc('insert_inventory') IS NOT NULL",
+    3: "SELECT to_regtype('grant_status') IS NOT NULL",
+    4: "SELECT to_regclass('idx_log_player_event_player_id_event_time') IS NOT NULL",
+}
+WRK_JSON_PREFIX = 'WRK_JSON '
+TOP_STATEMENTS = 10
+SERVICE_START_TIMEOUT = 30
+# metric: (path in scenario result, True if higher is better)
+COMPARED_METRICS = {
+    'rps': (('rps',), True),
+    'p50': (('latency_ms', 'p50'), False),
+    'p99': (('latency_ms', 'p99'), False),
+    'p999': (('latency_ms', 'p999'), False),
+}
+
+
+def load_config(config_path):
+    with open(config_path, 'r') as config_file:
+        return yaml.safe_load(config_file)
+
+
+def get_git_commit():
+    try:
+        completed = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SRC_DIR, capture_output=True,
+                                   text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return completed.stdout.strip()
+
+
+def get_python_info(python):
+    code = 'import json, platform, sys; print(json.dumps({"version": platform.python_version(), ' \
+           '"implementation": platform.python_implementation(), "build": sys.version}))'
+    completed = subprocess.run([python, '-c', code], capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout)
+
+
+async def apply_migrations(conn):
+    migrations = sorted((int(MIGRATION_RE.match(path.name).group(1)), path)
+                        for path in (SRC_DIR / 'db_migrations').iterdir() if MIGRATION_RE.match(path.name))
+    unknown = [path.name for version, path in migrations if version not in MIGRATION_CHECKS]
+    if unknown:
+        raise SystemExit(f"Don't know how to check if {', '.join(unknown)} is applied, "
+                         f'add it to MIGRATION_CHECKS in bench_runner.py')
+    for version, path in migrations:
+        if await conn.fetchval(MIGRATION_CHECKS[version]):
+            continue
+        print(f'Applying {path.name}')
+        await conn.execute(path.read_text())
+
+
+async def prepare_db(conn, seed_players):
+    # a database created before the latest migrations gets only the missing ones
+    await apply_migrations(conn)
+    await maintain_partitions(conn, datetime.datetime.utcnow())
+    if seed_players:
+        await conn.execute("""
+            INSERT INTO player_inventory (player_id, inventory_type, item_code, amount)
+            SELECT player_id, 'consumable', item_code, 1
+            FROM generate_series(1, $1::bigint) AS player_id, unnest(ARRAY['item123', 'item456']) AS item_code
+            ON CONFLICT (player_id, item_code) DO NOTHING
+        """, seed_players)
+        await conn.execute('ANALYZE player_inventory')
+
+
+async def reset_pg_stat_statements(conn):
+    # the extension needs shared_preload_libraries = 'pg_stat_statements', the run goes on without it
+    try:
+        await conn.execute('CREATE EXTENSION IF NOT EXISTS pg_stat_statements')
+        await conn.execute('SELECT pg_stat_statements_reset()')
+    except asyncpg.exceptions.PostgresError as e:
+        print(f'pg_stat_statements is not available, DB stats are not collected: {e}')
+        return False
+    return True
+
+
+async def read_pg_stat_statements(conn):
+    rows = await conn.fetch("""
+        SELECT query, calls, total_exec_time, mean_exec_time, rows, shared_blks_hit, shared_blks_read
+        FROM pg_stat_statements
+        WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+            AND query NOT LIKE '%pg_stat_statements%'
+        ORDER BY total_exec_time DESC
+    """)
+    statements = [dict(row) for row in rows]
+    return {
+        'calls': sum(row['calls'] for row in statements),
+        'total_exec_time_ms': sum(row['total_exec_time'] for row in statements),
+        'top_statements': [dict(row, query=' '.join(row['query'].split())) for row in statements[:TOP_STATEMENTS]],
+    }
+
+
+def start_service(args):
+    command = [args.python, 'main.py', '-c', os.path.abspath(args.config), '--port', str(args.port),
+               '--log-level', 'warning']
+    if args.workers > 1:
+        command += ['--workers', str(args.workers)]
+    process = subprocess.Popen(command, cwd=SRC_DIR)
+    deadline = time.monotonic() + SERVICE_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception(f'inventory_service exited with code {process.returncode}')
+        try:
+            urllib.request.urlopen(f'{args.url}/metrics', timeout=1).read()
+            return process
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    process.terminate()
+    raise Exception(f'inventory_service is not ready after {SERVICE_START_TIMEOUT} seconds')
+
+
+def parse_wrk_json(output):
+    for line in output.splitlines():
+        if line.startswith(WRK_JSON_PREFIX):
+            summary = json.loads(line[len(WRK_JSON_PREFIX):])
+            break
+    else:
+        raise Exception('No WRK_JSON line in wrk output, is done() missing in inventory_bench_wrk.lua?')
+    return {
+        'rps': summary['requests'] / (summary['duration_us'] / 10**6),
+        'requests': summary['requests'],
+        'non_2xx': summary['non_2xx'],
+        'socket_errors': summary['socket_errors'],
+        # bytes read by wrk per response, headers included
+        'response_bytes': summary.get('bytes', 0) / summary['requests'] if summary['requests'] else 0,
+        'latency_ms': {
+            key[:-3]: summary[key] / 1000.0
+            for key in ('mean_us', 'p50_us', 'p90_us', 'p99_us', 'p999_us', 'max_us')
+        },
+    }
+
+
+async def run_scenarios(args, conn):
+    env = {'WRK_TEST_FORMAT': args.format}
+    if args.seed_players:
+        env['WRK_TEST_MAX_PLAYER_ID'] = str(args.seed_players)
+    results = {}
+    for scenario in args.scenarios:
+        has_db_stats = await reset_pg_stat_statements(conn)
+        if args.warm_up:
+            run_wrk(args.url, scenario, args.threads, args.connections, args.warm_up, env)
+            if has_db_stats:
+                await conn.execute('SELECT pg_stat_statements_reset()')
+        print(f'Running {scenario} for {args.duration}...')
+        output = run_wrk(args.url, scenario, args.threads, args.connections, args.duration, env)
+        results[scenario] = parse_wrk_json(output)
+        results[scenario]['db'] = await read_pg_stat_statements(conn) if has_db_stats else None
+        print(f"  {results[scenario]['rps']:.1f} rps, p99 {results[scenario]['latency_ms']['p99']:.2f} ms")
+    return results
+
+
+async def run(args):
+    config = load_config(args.config)
+    conn = await asyncpg.connect(**get_connection_settings(get_database_settings(config)))
+    service = None
+    try:
+        if args.prepare_db:
+            await prepare_db(conn, args.seed_players)
+        if args.start_service:
+            service = start_service(args)
+        scenarios = await run_scenarios(args, conn)
+        postgres_version = await conn.fetchval('SHOW server_version')
+    finally:
+        if service is not None:
+            service.terminate()
+            service.wait()
+        await conn.close()
+
+    python_info = get_python_info(args.python)
+    created_at = datetime.datetime.utcnow()
+    result = {
+        'schema_version': RESULT_SCHEMA_VERSION,
+        'label': args.label or f"python-{python_info['version']}",
+        'created': created_at.isoformat(timespec='seconds') + 'Z',
+        'git_commit': get_git_commit(),
+        'python': python_info,
+        'postgres_version': postgres_version,
+        'service': {'workers': args.workers, 'grant_engine': config.get('grants', {}).get('engine', 'inline'),
+                    'started_by_runner': args.start_service},
+        'wrk': {'threads': args.threads, 'connections': args.connections, 'duration': args.duration,
+                'seed_players': args.seed_players, 'format': args.format},
+        'scenarios': scenarios,
+    }
+    os.makedirs(args.results_dir, exist_ok=True)
+    result_path = os.path.join(args.results_dir, f"{result['label']}_{created_at.strftime('%Y%m%dT%H%M%S')}.json")
+    with open(result_path, 'w') as result_file:
+        json.dump(result, result_file, indent=2)
+    print(f'Result saved to {result_path}')
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        return compare_results(baseline, result, args.threshold)
+    return 0
+
+
+def get_metric(scenario_result, path):
+    value = scenario_result
+    for key in path:
+        value = value[key]
+    return value
+
+
+# Prints both results side by side and returns 1 if any metric got worse by more than threshold percent
+def compare_results(baseline, result, threshold):
+    for name, data in (('baseline', baseline), ('result', result)):
+        if data.get('schema_version') != RESULT_SCHEMA_VERSION:
+            raise Exception(f"Unsupported schema_version of {name}: {data.get('schema_version')}")
+
+    regressions = []
+    print(f"{'scenario':18} {'metric':6} {baseline['label'][:14]:>14} {result['label'][:14]:>14} {'change':>9}")
+    for scenario, scenario_result in result['scenarios'].items():
+        if scenario not in baseline['scenarios']:
+            print(f'{scenario:18} not in baseline, skipped')
+            continue
+        for metric, (path, higher_is_better) in COMPARED_METRICS.items():
+            old = get_metric(baseline['scenarios'][scenario], path)
+            new = get_metric(scenario_result, path)
+            change = (new - old) / old * 100 if old else 0.0
+            is_regression = (-change if higher_is_better else change) > threshold
+            if is_regression:
+                regressions.append(f'{scenario} {metric}')
+            print(f"{scenario:18} {metric:6} {old:14.2f} {new:14.2f} {change:+8.1f}%"
+                  f"{'  REGRESSION' if is_regression else ''}")
+
+    if regressions:
+        print(f"Regressions over {threshold}%: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark runner for inventory_service')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run wrk scenarios and save the result')
+    run_parser.add_argument('--config', '-c', default=str(SRC_DIR / 'inventory.yaml'),
+                            help='Config of inventory_service, its database section is used for DB stats')
+    run_parser.add_argument('--url', default='http://localhost:8080', help='Base URL of inventory_service')
+    run_parser.add_argument('--scenarios', nargs='+', default=list(DEFAULT_SCENARIOS), help='wrk scenarios')
+    run_parser.add_argument('--format', default='json', choices=('json', 'msgpack'),
+                            help='Wire format of requests and responses')
+    run_parser.add_argument('--threads', '-t', type=int, default=4, help='wrk threads')
+    run_parser.add_argument('--connections', type=int, default=64, help='wrk connections')
+    run_parser.add_argument('--duration', '-d', default='30s', help='wrk duration of every scenario')
+    run_parser.add_argument('--warm-up', default='5s', help='wrk run before every scenario, not measured, '
+                                                            'empty string disables it')
+    run_parser.add_argument('--prepare-db', action='store_true',
+                            help='Apply db_migrations missing in the database and create partitions')
+    run_parser.add_argument('--seed-players', type=int, default=0,
+                            help='Create inventories for players 1..N and limit wrk player ids to them')
+    run_parser.add_argument('--start-service', action='store_true',
+                            help='Start main.py with --python for the run, otherwise --url must be up')
+    run_parser.add_argument('--python', default=sys.executable, help='Python used to start the service')
+    run_parser.add_argument('--port', type=int, default=8080, help='Port of the started service')
+    run_parser.add_argument('--workers', type=int, default=1, help='Workers of the started service')
+    run_parser.add_argument('--label', help='Name of the result, python version by default')
+    run_parser.add_argument('--results-dir', default=str(DEFAULT_RESULTS_DIR), help='Where results are saved')
+    run_parser.add_argument('--baseline', help='Result file to compare with')
+    run_parser.add_argument('--threshold', type=float, default=5.0,
+                            help='Allowed regression of rps and latency percentiles, percent')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two result files')
+    compare_parser.add_argument('baseline', help='Baseline result file')
+    compare_parser.add_argument('result', help='Result file to check')
+    compare_parser.add_argument('--threshold', type=float, default=5.0,
+                                help='Allowed regression of rps and latency percentiles, percent')
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        with open(args.baseline) as baseline_file, open(args.result) as result_file:
+            sys.exit(compare_results(json.load(baseline_file), json.load(result_file), args.threshold))
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import collections
+import json
+import random
+import time
+import uuid
+
+import aiohttp
+
+# Many clients granting and consuming one item of one player, all requests compete for one
+# player_inventory row. Run it against the service with hot_rows disabled and enabled and compare:
+# $ python3 contention_bench.py --url http://localhost:8080 --clients 200 --duration 30
+# At the end the amount in DB is checked against grants and consumes acknowledged by the service.
+
+GRANT_AMOUNT = 2
+CONSUME_AMOUNT = 1
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+async def post(session, url, path, payload):
+    async with session.post(url + path, json=payload) as response:
+        body = await response.json(content_type=None)
+        return response.status, body
+
+
+async def get_amount(session, url, player_id, item_code):
+    _, body = await post(session, url, '/v1/inventory/get', {'player_id': player_id})
+    for item in body['data']['inventory']:
+        if item['item_code'] == item_code:
+            return item['amount']
+    return 0
+
+
+async def run_client(session, args, stats, deadline):
+    while time.monotonic() < deadline:
+        if random.random() < args.consume_ratio:
+            operation, path, amount = 'consume', '/v1/inventory/consume', CONSUME_AMOUNT
+        else:
+            operation, path, amount = 'grant', '/v1/inventory/grant', GRANT_AMOUNT
+        payload = {'player_id': args.player_id, 'item_code': args.item_code, 'amount': amount,
+                   'ext_trx_id': uuid.uuid4().hex}
+        started = time.perf_counter()
+        try:
+            status, body = await post(session, args.url, path, payload)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            stats[operation]['errors'][type(e).__name__] += 1
+            continue
+        stats[operation]['latencies'].append(time.perf_counter() - started)
+        stats[operation]['errors'][body.get('error_code') or str(status)] += 1
+        if status == 200:
+            stats[operation]['amount'] += amount
+
+
+async def run(args):
+    connector = aiohttp.TCPConnector(limit=args.clients)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30)) as session:
+        if args.initial_amount:
+            await post(session, args.url, '/v1/inventory/grant', {
+                'player_id': args.player_id, 'item_code': args.item_code, 'amount': args.initial_amount,
+                'ext_trx_id': uuid.uuid4().hex,
+            })
+        amount_before = await get_amount(session, args.url, args.player_id, args.item_code)
+
+        stats = {operation: {'latencies': [], 'errors': collections.Counter(), 'amount': 0}
+                 for operation in ('grant', 'consume')}
+        print(f'Running {args.clients} clients for {args.duration}s on player {args.player_id}, '
+              f'item {args.item_code}...')
+        started = time.monotonic()
+        deadline = started + args.duration
+        await asyncio.gather(*[run_client(session, args, stats, deadline) for _ in range(args.clients)])
+        elapsed = time.monotonic() - started
+
+        amount_after = await get_amount(session, args.url, args.player_id, args.item_code)
+
+    expected = amount_before + stats['grant']['amount'] - stats['consume']['amount']
+    results = {'clients': args.clients, 'duration': elapsed, 'amount_before': amount_before,
+               'amount_after': amount_after, 'amount_expected': expected, 'operations': {}}
+    print(f"{'operation':10} {'rps':>9} {'p50, ms':>9} {'p99, ms':>9} {'p99.9, ms':>10}  results")
+    for operation, operation_stats in stats.items():
+        latencies = sorted(operation_stats['latencies'])
+        result = {
+            'rps': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'p999_ms': percentile(latencies, 99.9) * 1000,
+            'results': dict(operation_stats['errors']),
+        }
+        results['operations'][operation] = result
+        print(f"{operation:10} {result['rps']:9.1f} {result['p50_ms']:9.2f} {result['p99_ms']:9.2f} "
+              f"{result['p999_ms']:10.2f}  {result['results']}")
+    # acknowledged writes must all be in DB, no more and no less
+    print(f"amount {amount_before} -> {amount_after}, expected {expected}: "
+          f"{'OK' if amount_after == expected else 'MISMATCH'}")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    return amount_after == expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Grants and consumes of one hot inventory row')
+    parser.add_argument('--url', default='http://localhost:8080', help='URL of inventory_service')
+    parser.add_argument('--clients', '-c', type=int, default=100, help='Concurrent clients')
+    parser.add_argument('--duration', '-d', type=float, default=30, help='Duration in seconds')
+    parser.add_argument('--player-id', type=int, default=424242, help='The hot player')
+    parser.add_argument('--item-code', default='item123', help='The hot item')
+    parser.add_argument('--consume-ratio', type=float, default=0.5,
+                        help='Share of consumes, 1.0 sends only consumes')
+    parser.add_argument('--initial-amount', type=int, default=1000000,
+                        help='Granted before the run, so consumes have something to consume')
+    parser.add_argument('--output', '-o', help='Save results as JSON')
+    args = parser.parse_args()
+    if not asyncio.run(run(args)):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
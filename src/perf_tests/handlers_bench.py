@@ -0,0 +1,271 @@
+import argparse
+import asyncio
+import json
+import pathlib
+import platform
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+# Measures Python-side cost of handlers and middlewares per request, no network and no DB:
+# handlers run against an in-memory db_pool returning canned records.
+# $ python3 handlers_bench.py --requests 10000 --output handlers_py312.json
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import main  # noqa: E402
+import serializer  # noqa: E402
+import statements  # noqa: E402
+import view  # noqa: E402
+from error import error_middleware  # noqa: E402
+from monitoring import monitoring_middleware  # noqa: E402
+
+PLAYER_ID = 123456
+INVENTORY_ROWS = [
+    (PLAYER_ID * 100 + i, PLAYER_ID, 'consumable', f'item{i:03d}', i + 1, None, None)
+    for i in range(10)
+]
+CANNED_RESULTS = {
+    statements.GET_INVENTORY: INVENTORY_ROWS,
+    statements.INSERT_INVENTORY_TRX: None,
+    statements.UPSERT_INVENTORY: {'inserted': False},
+    statements.GRANT_STORED_PROC: 'updated',
+}
+GET_DATA = {'player_id': PLAYER_ID}
+GRANT_DATA = {'player_id': PLAYER_ID, 'item_code': 'item001', 'amount': 5,
+              'ext_trx_id': '01HM6Z7VKQ0D8Y4W3ZB5T3XJ2N', 'inventory_type': 'consumable'}
+GET_BODY = json.dumps(GET_DATA).encode('utf-8')
+GRANT_BODY = json.dumps(GRANT_DATA).encode('utf-8')
+JSON_HEADERS = {'Content-Type': serializer.JSON_CONTENT_TYPE}
+MSGPACK_HEADERS = {'Content-Type': serializer.MSGPACK_CONTENT_TYPE, 'Accept': serializer.MSGPACK_CONTENT_TYPE}
+GET_RESPONSE = {'status': 'OK', 'data': {'player_id': PLAYER_ID,
+                                         'inventory': [view.format_inventory_item(row) for row in INVENTORY_ROWS]}}
+# requests are created before every measured chunk, creating them is not measured
+CHUNK_SIZE = 1000
+
+
+class FakeTransaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeConnection:
+    async def fetch(self, sql, *args):
+        return CANNED_RESULTS.get(sql, [])
+
+    async def fetchrow(self, sql, *args):
+        return CANNED_RESULTS.get(sql)
+
+    async def fetchval(self, sql, *args):
+        return CANNED_RESULTS.get(sql)
+
+    async def execute(self, sql, *args):
+        return 'INSERT 0 1'
+
+    def transaction(self):
+        return FakeTransaction()
+
+
+# wrapped by db_pool.InstrumentedPool in create_app(), like the asyncpg pool
+class FakePool:
+    def __init__(self):
+        self.conn = FakeConnection()
+
+    async def acquire(self, timeout=None):
+        return self.conn
+
+    async def release(self, conn):
+        pass
+
+    def get_size(self):
+        return 1
+
+    def get_max_size(self):
+        return 10
+
+
+class BodyPayload:
+    # enough of StreamReader for Request.read()
+    def __init__(self, body):
+        self._chunks = [body]
+
+    def set_read_chunk_size(self, size):
+        pass
+
+    async def readany(self):
+        return self._chunks.pop() if self._chunks else b''
+
+
+async def create_app(config, request_validation='swagger'):
+    args = mock.Mock(disable_request_validation=False, request_validation=request_validation)
+
+    async def create_pool(**_kwargs):
+        return FakePool()
+
+    with mock.patch.object(main.asyncpg, 'create_pool', create_pool):
+        return await main.create_app(args, config)
+
+
+async def make_request_factory(app, path, body, headers=JSON_HEADERS):
+    match_info = await app.router.resolve(make_mocked_request('POST', path, app=app))
+    match_info.add_app(app)
+
+    def make_request():
+        request = make_mocked_request('POST', path, headers=headers, app=app, payload=BodyPayload(body))
+        request._match_info = match_info
+        return request
+
+    return make_request, match_info.handler
+
+
+def with_middlewares(middlewares, handler):
+    for middleware in reversed(middlewares):
+        handler = (lambda m, h: lambda request: m(request, h))(middleware, handler)
+    return handler
+
+
+def in_task(handler):
+    # aiohttp runs every request in its own task, this adds the same scheduling cost
+    async def run_in_task(request):
+        return await asyncio.get_running_loop().create_task(handler(request))
+    return run_in_task
+
+
+async def measure(call, make_request, requests):
+    wall_time = cpu_time = 0.0
+    for started in range(0, requests, CHUNK_SIZE):
+        chunk = [make_request() for _ in range(min(CHUNK_SIZE, requests - started))]
+        wall_started, cpu_started = time.perf_counter(), time.process_time()
+        for request in chunk:
+            await call(request)
+        wall_time += time.perf_counter() - wall_started
+        cpu_time += time.process_time() - cpu_started
+    return wall_time / requests, cpu_time / requests
+
+
+async def measure_memory(call, make_request, requests):
+    # peak is memory a request needs while it runs, retained is what stays allocated after it
+    chunk = [make_request() for _ in range(requests)]
+    await call(make_request())
+    tracemalloc.start()
+    try:
+        peak = 0
+        retained_started, _ = tracemalloc.get_traced_memory()
+        while chunk:
+            # the request is released after the call, so its own state isn't counted as retained
+            request = chunk.pop()
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            await call(request)
+            del request
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+        retained = tracemalloc.get_traced_memory()[0] - retained_started
+    finally:
+        tracemalloc.stop()
+    return peak, retained / requests
+
+
+async def run(args):
+    config = {'database': {}, 'json': {'backend': args.json_backend}}
+    app = await create_app(config)
+    make_get_request, swagger_get_inventory = await make_request_factory(app, '/v1/inventory/get', GET_BODY)
+    make_grant_request, swagger_grant_item = await make_request_factory(app, '/v1/inventory/grant', GRANT_BODY)
+    prebuilt_response = serializer.json_response(GET_RESPONSE)
+
+    async def noop(_request):
+        return prebuilt_response
+
+    async def read_json(request):
+        return await serializer.read_json(request)
+
+    async def request_json(request):
+        return await request.json()
+
+    async def serializer_json_response(_request):
+        return serializer.json_response(GET_RESPONSE)
+
+    async def aiohttp_json_response(_request):
+        return web.json_response(GET_RESPONSE)
+
+    middlewares = list(app.middlewares)
+    scenarios = [
+        ('noop handler', noop, make_get_request),
+        ('serializer.read_json', read_json, make_get_request),
+        ('request.json()', request_json, make_get_request),
+        ('serializer.json_response', serializer_json_response, make_get_request),
+        ('web.json_response', aiohttp_json_response, make_get_request),
+        ('monitoring_middleware + noop', with_middlewares([monitoring_middleware], noop), make_get_request),
+        ('error_middleware + noop', with_middlewares([error_middleware], noop), make_get_request),
+        ('get_inventory', view.get_inventory, make_get_request),
+        ('get_inventory + swagger', swagger_get_inventory, make_get_request),
+        ('get_inventory full stack', with_middlewares(middlewares, swagger_get_inventory), make_get_request),
+        ('get_inventory full stack, task',
+         in_task(with_middlewares(middlewares, swagger_get_inventory)), make_get_request),
+        ('grant_item', view.grant_item, make_grant_request),
+        ('grant_item + swagger', swagger_grant_item, make_grant_request),
+        ('grant_item full stack', with_middlewares(middlewares, swagger_grant_item), make_grant_request),
+        ('grant_item full stack, task',
+         in_task(with_middlewares(middlewares, swagger_grant_item)), make_grant_request),
+    ]
+    if serializer.msgpack is not None:
+        # the same requests with msgpack bodies and responses
+        make_msgpack_get_request, _ = await make_request_factory(
+            app, '/v1/inventory/get', serializer.msgpack_dumps(GET_DATA), MSGPACK_HEADERS)
+        make_msgpack_grant_request, _ = await make_request_factory(
+            app, '/v1/inventory/grant', serializer.msgpack_dumps(GRANT_DATA), MSGPACK_HEADERS)
+
+        async def serializer_msgpack_response(request):
+            return serializer.response(request, GET_RESPONSE)
+
+        scenarios += [
+            ('serializer.read_json, msgpack', read_json, make_msgpack_get_request),
+            ('serializer.response, msgpack', serializer_msgpack_response, make_msgpack_get_request),
+            ('get_inventory full stack, msgpack',
+             with_middlewares(middlewares, swagger_get_inventory), make_msgpack_get_request),
+            ('grant_item full stack, msgpack',
+             with_middlewares(middlewares, swagger_grant_item), make_msgpack_grant_request),
+        ]
+
+    print(f'{platform.python_implementation()} {platform.python_version()}, json backend {serializer.backend}')
+    print(f"{'scenario':34} {'wall, us':>9} {'cpu, us':>9} {'peak, KiB':>10} {'retained, B':>12}")
+    results = {}
+    for name, call, make_request in scenarios:
+        # warm-up: caches of label children, swagger validators, statement lookups
+        await measure(call, make_request, min(args.requests, CHUNK_SIZE))
+        wall, cpu = await measure(call, make_request, args.requests)
+        peak, retained = await measure_memory(call, make_request, args.memory_requests)
+        results[name] = {'wall_us': wall * 10**6, 'cpu_us': cpu * 10**6, 'peak_bytes': peak,
+                         'retained_bytes': retained}
+        print(f'{name:34} {wall * 10**6:9.2f} {cpu * 10**6:9.2f} {peak / 1024:10.2f} {retained:12.1f}')
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'python': {'version': platform.python_version(), 'implementation': platform.python_implementation(),
+                           'build': sys.version},
+                'json_backend': serializer.backend,
+                'requests': args.requests,
+                'scenarios': results,
+            }, output_file, indent=2)
+
+
+def main_():
+    parser = argparse.ArgumentParser(description='In-process benchmark of handlers and middlewares')
+    parser.add_argument('--requests', '-n', type=int, default=10000, help='Measured requests per scenario')
+    parser.add_argument('--memory-requests', type=int, default=1000,
+                        help='Requests per scenario measured with tracemalloc, it slows them down a lot')
+    parser.add_argument('--json-backend', default='auto', choices=serializer.BACKENDS, help='json backend')
+    parser.add_argument('--output', '-o', help='Save results as JSON, e.g. to compare Python versions')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main_()
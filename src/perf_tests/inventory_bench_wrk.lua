@@ -5,20 +5,112 @@ end
 ulid_mod.set_time_func(time)
 
 wrk.method = "POST"
-wrk.headers["Content-Type"] = "application/json"
 
--- possible values for WRK_TEST_NAME: ["mix", "read", "write"]
+-- possible values for WRK_TEST_FORMAT: ["json", "msgpack"], requests and responses use the same format
+wrk_test_format = os.getenv("WRK_TEST_FORMAT") or "json"
+if wrk_test_format == "msgpack" then
+   wrk.headers["Content-Type"] = "application/msgpack"
+   wrk.headers["Accept"] = "application/msgpack"
+elseif wrk_test_format == "json" then
+   wrk.headers["Content-Type"] = "application/json"
+else
+   error("Wrong wrk_test_format: " .. wrk_test_format)
+end
+
+-- possible values for WRK_TEST_NAME: ["mix", "read", "read_batch", "write", "write_stored_trx",
+-- "consume_hot", "mix_hot"]
 wrk_test_name = os.getenv("WRK_TEST_NAME") or 'mix'
 
 min_player_id = tonumber(os.getenv("WRK_TEST_MIN_PLAYER_ID")) or 1
 max_player_id = tonumber(os.getenv("WRK_TEST_MAX_PLAYER_ID")) or 1000000
 next_player_id = min_player_id
+-- number of players in one /v1/inventory/get_batch request, compare read_batch RPS * batch_size with read RPS
+batch_size = tonumber(os.getenv("WRK_TEST_BATCH_SIZE")) or 50
+-- consume_hot and mix_hot send every request to one item of one player, to measure row lock contention
+hot_player_id = tonumber(os.getenv("WRK_TEST_HOT_PLAYER_ID")) or min_player_id
+hot_item_code = os.getenv("WRK_TEST_HOT_ITEM_CODE") or "item123"
 
--- Function to generate a POST request with a JSON payload
+-- Function to generate a POST request with a JSON or msgpack payload
 function post_request(endpoint, payload)
    return wrk.format("POST", endpoint, nil, payload)
 end
 
+-- Payloads are lists of {name, value} pairs, so fields keep their order in both formats.
+-- Values are non-negative integers, strings or arrays of integers.
+function encode_payload(fields)
+   if wrk_test_format == "msgpack" then
+      return encode_msgpack(fields)
+   end
+   return encode_json(fields)
+end
+
+function encode_json(fields)
+   local parts = {}
+   for _, field in ipairs(fields) do
+      local value = field[2]
+      if type(value) == "string" then
+         value = '"' .. value .. '"'
+      elseif type(value) == "table" then
+         value = '[' .. table.concat(value, ", ") .. ']'
+      end
+      parts[#parts + 1] = '"' .. field[1] .. '": ' .. value
+   end
+   return '{' .. table.concat(parts, ", ") .. '}'
+end
+
+-- big-endian bytes of a non-negative integer
+function be_bytes(n, size)
+   local bytes = {}
+   for i = size - 1, 0, -1 do
+      bytes[#bytes + 1] = string.char(math.floor(n / 2 ^ (8 * i)) % 256)
+   end
+   return table.concat(bytes)
+end
+
+function msgpack_uint(n)
+   if n < 128 then
+      return string.char(n)
+   elseif n < 2 ^ 8 then
+      return "\204" .. be_bytes(n, 1)
+   elseif n < 2 ^ 16 then
+      return "\205" .. be_bytes(n, 2)
+   elseif n < 2 ^ 32 then
+      return "\206" .. be_bytes(n, 4)
+   end
+   return "\207" .. be_bytes(n, 8)
+end
+
+function msgpack_str(s)
+   if #s < 32 then
+      return string.char(160 + #s) .. s
+   elseif #s < 2 ^ 8 then
+      return "\217" .. be_bytes(#s, 1) .. s
+   end
+   return "\218" .. be_bytes(#s, 2) .. s
+end
+
+function msgpack_value(value)
+   if type(value) == "string" then
+      return msgpack_str(value)
+   elseif type(value) == "table" then
+      local items = {#value < 16 and string.char(144 + #value) or "\220" .. be_bytes(#value, 2)}
+      for _, item in ipairs(value) do
+         items[#items + 1] = msgpack_uint(item)
+      end
+      return table.concat(items)
+   end
+   return msgpack_uint(value)
+end
+
+function encode_msgpack(fields)
+   -- payloads have less than 16 fields, so fixmap is enough
+   local parts = {string.char(128 + #fields)}
+   for _, field in ipairs(fields) do
+      parts[#parts + 1] = msgpack_str(field[1]) .. msgpack_value(field[2])
+   end
+   return table.concat(parts)
+end
+
 
 -- Function to generate a random item code
 function random_item_code()
@@ -28,23 +120,60 @@ end
 
 -- Function to generate random payload for /v1/inventory/get
 function get_inventory_payload(player_id)
-   return '{"player_id": ' .. player_id .. '}'
+   return encode_payload({{"player_id", player_id}})
+end
+
+-- Function to generate payload for /v1/inventory/get_batch with batch_size players starting from player_id
+function get_inventory_batch_payload(player_id)
+   local player_ids = {}
+   for i = 0, batch_size - 1 do
+      local batch_player_id = player_id + i
+      if batch_player_id > max_player_id then
+         batch_player_id = min_player_id + (batch_player_id - max_player_id - 1)
+      end
+      player_ids[#player_ids + 1] = batch_player_id
+   end
+   return encode_payload({{"player_ids", player_ids}})
 end
 
 -- Function to generate random payload for /v1/inventory/grant
 function grant_item_payload(player_id)
-   return '{"player_id": ' .. player_id .. ', "item_code": "' .. random_item_code() .. '", "amount": ' .. math.random(1, 10) .. ', "ext_trx_id": "' .. tostring(ulid_mod.ulid()) .. '"}'
+   return encode_payload({{"player_id", player_id}, {"item_code", random_item_code()},
+                          {"amount", math.random(1, 10)}, {"ext_trx_id", tostring(ulid_mod.ulid())}})
+end
+
+-- Function to generate payload for /v1/inventory/consume of one item, 420 when there are not enough items
+function consume_item_payload(player_id, item_code)
+   return encode_payload({{"player_id", player_id}, {"item_code", item_code}, {"amount", 1},
+                          {"ext_trx_id", tostring(ulid_mod.ulid())}})
+end
+
+-- Function to generate payload for /v1/inventory/grant of one item, grants more than mix_hot consumes
+function grant_hot_item_payload(player_id, item_code)
+   return encode_payload({{"player_id", player_id}, {"item_code", item_code}, {"amount", 2},
+                          {"ext_trx_id", tostring(ulid_mod.ulid())}})
 end
 
 -- The main request function
 function request()
   -- io.stderr:write(string.format("DEBUG: next_player_id is %s\n", next_player_id))  
-  next_player_id = next_player_id + 1
+  if wrk_test_name == "read_batch" then
+    -- every batch request reads the next batch_size players
+    next_player_id = next_player_id + batch_size
+  else
+    next_player_id = next_player_id + 1
+  end
   if next_player_id > max_player_id then
     next_player_id = min_player_id
     io.stderr:write(string.format("next_player_id is achive %d and reset to %d\n", max_player_id, min_player_id))  
   end
   local endpoint = choose_endpoint()
+  if wrk_test_name == "consume_hot" or wrk_test_name == "mix_hot" then
+    if endpoint == "/v1/inventory/consume" then
+      return post_request(endpoint, consume_item_payload(hot_player_id, hot_item_code))
+    end
+    return post_request(endpoint, grant_hot_item_payload(hot_player_id, hot_item_code))
+  end
   local payload = generate_payload(endpoint, next_player_id)
   return post_request(endpoint, payload)
 end
@@ -53,6 +182,8 @@ end
 function choose_endpoint()
   if wrk_test_name == "read" then
     return "/v1/inventory/get"
+  elseif wrk_test_name == "read_batch" then
+    return "/v1/inventory/get_batch"
   elseif wrk_test_name == "write" then
     return "/v1/inventory/grant"
   elseif wrk_test_name == "write_stored_trx" then
@@ -60,6 +191,11 @@ function choose_endpoint()
   elseif wrk_test_name == "mix" then
     local endpoints = {"/v1/inventory/get", "/v1/inventory/grant"}
     return endpoints[math.random(1, 2)]
+  elseif wrk_test_name == "consume_hot" then
+    return "/v1/inventory/consume"
+  elseif wrk_test_name == "mix_hot" then
+    local endpoints = {"/v1/inventory/consume", "/v1/inventory/grant"}
+    return endpoints[math.random(1, 2)]
   else
     error("Wrong wrk_test_name: " .. wrk_test_name)
   end
@@ -69,6 +205,8 @@ end
 function generate_payload(endpoint, player_id)
    if endpoint == "/v1/inventory/get" then
       return get_inventory_payload(player_id)
+   elseif endpoint == "/v1/inventory/get_batch" then
+      return get_inventory_batch_payload(player_id)
    elseif endpoint == "/v1/inventory/grant" then
       return grant_item_payload(player_id)
    elseif endpoint == "/internal/inventory/grant_stored_trx" then
@@ -77,3 +215,15 @@ function generate_payload(endpoint, player_id)
       return ""
    end
 end
+
+-- Machine-readable summary for perf_tests/bench_runner.py, wrk --latency stops at p99
+function done(summary, latency, requests)
+   io.write(string.format(
+      'WRK_JSON {"requests": %d, "duration_us": %d, "mean_us": %.1f, "p50_us": %d, "p90_us": %d, ' ..
+      '"p99_us": %d, "p999_us": %d, "max_us": %d, "non_2xx": %d, "socket_errors": %d, "bytes": %d}\n',
+      summary.requests, summary.duration, latency.mean, latency:percentile(50), latency:percentile(90),
+      latency:percentile(99), latency:percentile(99.9), latency.max, summary.errors.status,
+      summary.errors.connect + summary.errors.read + summary.errors.write + summary.errors.timeout,
+      summary.bytes
+   ))
+end
@@ -2,6 +2,7 @@ import random
 from itertools import chain
 import os
 
+import msgpack
 import six
 from ulid import ULID
 from flask import request, Response
@@ -18,6 +19,11 @@ import psutil
 
 MIN_USER_ID = 1
 MAX_USER_ID = 10**6
+# players per /v1/inventory/get_batch request
+GET_BATCH_SIZE = 50
+# json or msgpack, requests and responses use the same format
+WIRE_FORMAT = os.getenv('LOCUST_WIRE_FORMAT', 'json')
+MSGPACK_HEADERS = {'Content-Type': 'application/msgpack', 'Accept': 'application/msgpack'}
 
 
 class LocustCollector(object):
@@ -133,10 +139,21 @@ class InventoryUser(HttpUser):
     wait_time = between(1, 2)  # Wait between 1 and 2 seconds between tasks
     inventory_items = ('test_item', 'bfg', 'bla')
 
+    def post(self, path, data):
+        if WIRE_FORMAT == 'msgpack':
+            self.client.post(path, data=msgpack.packb(data), headers=MSGPACK_HEADERS)
+        else:
+            self.client.post(path, json=data)
+
     @task
     def get_inventory(self):
         player_id = random.randint(MIN_USER_ID, MAX_USER_ID)
-        self.client.post("/v1/inventory/get", json={"player_id": player_id})
+        self.post("/v1/inventory/get", {"player_id": player_id})
+
+    @task
+    def get_inventory_batch(self):
+        player_ids = random.sample(range(MIN_USER_ID, MAX_USER_ID + 1), GET_BATCH_SIZE)
+        self.post("/v1/inventory/get_batch", {"player_ids": player_ids})
 
     @task
     def grant_item(self):
@@ -145,4 +162,4 @@ class InventoryUser(HttpUser):
         player_id = random.randint(MIN_USER_ID, MAX_USER_ID)
         ext_trx_id = str(ULID())
         data = {"player_id": player_id, "item_code": item_code, "amount": item_amount, "ext_trx_id": ext_trx_id}
-        self.client.post("/v1/inventory/grant", json=data)
+        self.post("/v1/inventory/grant", data)
@@ -0,0 +1,91 @@
+import argparse
+import json
+import random
+import timeit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Compares json backends on payloads of inventory_service, and msgpack served with Accept: application/msgpack:
+# $ python3 json_backends_bench.py --number 20000
+
+INVENTORY_TYPES = ('weapon', 'consumable', 'jewelry', 'other')
+
+
+def make_inventory(player_id, items):
+    return [
+        {'id': player_id * 100 + i, 'inventory_type': random.choice(INVENTORY_TYPES),
+         'item_code': f'item{i:03d}', 'amount': random.randint(1, 10**6)}
+        for i in range(items)
+    ]
+
+
+def make_payloads():
+    return {
+        'get_request': {'player_id': 123456},
+        'grant_request': {'player_id': 123456, 'item_code': 'item123', 'amount': 5,
+                          'ext_trx_id': '01HM6Z7VKQ0D8Y4W3ZB5T3XJ2N', 'inventory_type': 'consumable'},
+        'get_response_10_items': {'status': 'OK',
+                                  'data': {'player_id': 123456, 'inventory': make_inventory(123456, 10)}},
+        'get_response_100_items': {'status': 'OK',
+                                   'data': {'player_id': 123456, 'inventory': make_inventory(123456, 100)}},
+        'get_batch_response_50_players': {'status': 'OK', 'data': {'inventories': [
+            {'player_id': player_id, 'inventory': make_inventory(player_id, 10)}
+            for player_id in range(1, 51)
+        ]}},
+        'event_meta_data': {'inventory_type': 'consumable', 'item_code': 'item123'},
+        'error_response': {'status': 'error', 'error_code': 'schema_validation_error',
+                           'error_message': 'Invalid params in body', 'context': {'body.amount': 'required'}},
+    }
+
+
+def get_backends():
+    # every backend is used the way serializer.py uses it: bytes in, bytes out
+    backends = {
+        'stdlib': (lambda obj: json.dumps(obj).encode('utf-8'), json.loads),
+    }
+    if orjson is not None:
+        backends['orjson'] = (orjson.dumps, orjson.loads)
+    if ujson is not None:
+        backends['ujson'] = (lambda obj: ujson.dumps(obj).encode('utf-8'), ujson.loads)
+    if msgpack is not None:
+        # one Packer is reused like in serializer.py, packb() allocates a new buffer every time
+        backends['msgpack'] = (msgpack.Packer().pack, msgpack.unpackb)
+    return backends
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of json backends on inventory payloads')
+    parser.add_argument('--number', '-n', type=int, default=10000, help='Number of calls per measurement')
+    parser.add_argument('--repeat', '-r', type=int, default=5, help='Number of measurements, best is reported')
+    args = parser.parse_args()
+
+    random.seed(42)
+    payloads = make_payloads()
+    backends = get_backends()
+
+    print(f"{'payload':32} {'size, bytes':>12} {'backend':>8} {'dumps, us':>10} {'loads, us':>10}")
+    for payload_name, payload in payloads.items():
+        for backend_name, (dumps, loads) in backends.items():
+            # sizes differ between formats, and a bit between json backends because of whitespace
+            encoded = dumps(payload)
+            dumps_time = min(timeit.repeat(lambda: dumps(payload), number=args.number, repeat=args.repeat))
+            loads_time = min(timeit.repeat(lambda: loads(encoded), number=args.number, repeat=args.repeat))
+            print(f'{payload_name:32} {len(encoded):12} {backend_name:>8} '
+                  f'{dumps_time / args.number * 10**6:10.2f} {loads_time / args.number * 10**6:10.2f}')
+
+
+if __name__ == '__main__':
+    main()
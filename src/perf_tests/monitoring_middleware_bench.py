@@ -0,0 +1,94 @@
+import argparse
+import asyncio
+import json
+import pathlib
+import sys
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+# Measures per-request overhead of monitoring_middleware, no network and no DB involved:
+# $ python3 monitoring_middleware_bench.py --requests 100000
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import monitoring  # noqa: E402
+from error import ApiValidationError, error_middleware  # noqa: E402
+from serializer import json_response  # noqa: E402
+
+
+# monitoring_middleware before label children caching and error code passing, kept for comparison
+@web.middleware
+async def legacy_monitoring_middleware(request, handler):
+    start_time = time.time()
+    response = await handler(request)
+    response_time = time.time() - start_time
+    if response.status == 200:
+        status = 'ok'
+        error_code = None
+    else:
+        status = 'error'
+        try:
+            error_code = json.loads(response.text)['error_code']
+        except ValueError:
+            error_code = 'unknown_code'
+    monitoring.api_request_counter.labels(
+        path=request.path, method=request.method, status=status, http_code=response.status, error_code=error_code
+    ).inc()
+    monitoring.api_response_time_hist.labels(
+        path=request.path, method=request.method, status=status, http_code=response.status
+    ).observe(response_time)
+    return response
+
+
+async def ok_handler(_request):
+    return json_response({'status': 'OK', 'data': {}})
+
+
+async def error_handler(_request):
+    raise ApiValidationError(error_message='Missing player_id, item_code or amount')
+
+
+def chain(middlewares, handler):
+    for middleware in reversed(middlewares):
+        handler = (lambda m, h: lambda request: m(request, h))(middleware, handler)
+    return handler
+
+
+async def measure(handler, requests):
+    request = make_mocked_request('POST', '/v1/inventory/grant')
+    started = time.perf_counter()
+    for _ in range(requests):
+        await handler(request)
+    return (time.perf_counter() - started) / requests
+
+
+async def run(requests):
+    scenarios = [
+        ('ok, no monitoring', [error_middleware], ok_handler, 1.0),
+        ('ok, legacy monitoring', [legacy_monitoring_middleware, error_middleware], ok_handler, 1.0),
+        ('ok, monitoring', [monitoring.monitoring_middleware, error_middleware], ok_handler, 1.0),
+        ('ok, monitoring, 10% sampling', [monitoring.monitoring_middleware, error_middleware], ok_handler, 0.1),
+        ('error, no monitoring', [error_middleware], error_handler, 1.0),
+        ('error, legacy monitoring', [legacy_monitoring_middleware, error_middleware], error_handler, 1.0),
+        ('error, monitoring', [monitoring.monitoring_middleware, error_middleware], error_handler, 1.0),
+    ]
+    baselines = {}
+    print(f"{'scenario':32} {'per request, us':>16} {'overhead, us':>13}")
+    for name, middlewares, handler, sample_rate in scenarios:
+        monitoring.configure_monitoring(histogram_sample_rate=sample_rate)
+        per_request = await measure(chain(middlewares, handler), requests)
+        baseline = baselines.setdefault(handler, per_request)
+        print(f'{name:32} {per_request * 10**6:16.2f} {(per_request - baseline) * 10**6:13.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of monitoring_middleware overhead')
+    parser.add_argument('--requests', '-n', type=int, default=100000, help='Number of requests per scenario')
+    args = parser.parse_args()
+    asyncio.run(run(args.requests))
+
+
+if __name__ == '__main__':
+    main()
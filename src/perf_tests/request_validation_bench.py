@@ -0,0 +1,50 @@
+import argparse
+import asyncio
+import json
+import platform
+
+from handlers_bench import GET_BODY, GRANT_BODY, create_app, make_request_factory, measure, with_middlewares
+# handlers_bench puts src/ on sys.path
+import serializer
+from request_validation import VALIDATION_MODES
+
+# Compares request validation modes of main.py on the full middleware stack, no network and no DB:
+# $ python3 request_validation_bench.py --requests 10000
+
+INVALID_GRANT_BODY = json.dumps({'player_id': 123456, 'item_code': 'item001',
+                                 'ext_trx_id': '01HM6Z7VKQ0D8Y4W3ZB5T3XJ2N'}).encode('utf-8')
+ENDPOINTS = (
+    ('get', '/v1/inventory/get', GET_BODY),
+    ('grant', '/v1/inventory/grant', GRANT_BODY),
+    ('grant, invalid', '/v1/inventory/grant', INVALID_GRANT_BODY),
+)
+
+
+async def run(args):
+    config = {'database': {}, 'json': {'backend': args.json_backend}}
+    # json backend is configured by create_app()
+    await create_app(config)
+    print(f'{platform.python_implementation()} {platform.python_version()}, json backend {serializer.backend}')
+    print(f"{'endpoint':16}" + ''.join(f'{mode + ", us":>14}' for mode in VALIDATION_MODES))
+    results = {}
+    for name, path, body in ENDPOINTS:
+        for mode in VALIDATION_MODES:
+            app = await create_app(config, request_validation=mode)
+            make_request, handler = await make_request_factory(app, path, body)
+            call = with_middlewares(list(app.middlewares), handler)
+            await measure(call, make_request, min(args.requests, 1000))
+            wall, _ = await measure(call, make_request, args.requests)
+            results.setdefault(name, {})[mode] = wall
+        print(f'{name:16}' + ''.join(f'{results[name][mode] * 10**6:14.2f}' for mode in VALIDATION_MODES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of request validation modes')
+    parser.add_argument('--requests', '-n', type=int, default=10000, help='Measured requests per scenario')
+    parser.add_argument('--json-backend', default='auto', choices=serializer.BACKENDS, help='json backend')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
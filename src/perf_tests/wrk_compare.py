@@ -0,0 +1,118 @@
+import argparse
+import os
+import pathlib
+import re
+import subprocess
+
+# Runs inventory_bench_wrk.lua scenarios one after another with the same wrk settings and prints
+# a side-by-side report, by default grants via the configured grant engine vs stored procedure:
+# $ python3 wrk_compare.py --url http://localhost:8080 --duration 30s
+# Grant engine of `write` is set by grants.engine in config of the service. With several --formats
+# every scenario runs in every wire format, e.g. json vs msgpack:
+# $ python3 wrk_compare.py --scenarios read read_batch write --formats json msgpack
+
+WRK_SCRIPT = pathlib.Path(__file__).parent / 'inventory_bench_wrk.lua'
+UNITS = {'us': 10**-3, 'ms': 1.0, 's': 10**3, 'm': 60 * 10**3}
+LATENCY_RE = re.compile(r'^\s+Latency\s+([\d.]+)(us|ms|s|m)\s', re.MULTILINE)
+PERCENTILE_RE = re.compile(r'^\s+(50|75|90|99)%\s+([\d.]+)(us|ms|s|m)$', re.MULTILINE)
+REQUESTS_RE = re.compile(r'^\s+(\d+) requests in', re.MULTILINE)
+RPS_RE = re.compile(r'^Requests/sec:\s+([\d.]+)', re.MULTILINE)
+NON_2XX_RE = re.compile(r'^\s+Non-2xx or 3xx responses: (\d+)', re.MULTILINE)
+SOCKET_ERRORS_RE = re.compile(r'^\s+Socket errors: (.*)$', re.MULTILINE)
+TRANSFER_RE = re.compile(r'^Transfer/sec:\s+([\d.]+)(B|KB|MB|GB)$', re.MULTILINE)
+BYTE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3}
+ROWS = (
+    ('requests/sec', 'rps', '{:.1f}'),
+    ('requests', 'requests', '{}'),
+    ('latency avg, ms', 'latency_avg', '{:.2f}'),
+    ('latency p50, ms', 'latency_p50', '{:.2f}'),
+    ('latency p75, ms', 'latency_p75', '{:.2f}'),
+    ('latency p90, ms', 'latency_p90', '{:.2f}'),
+    ('latency p99, ms', 'latency_p99', '{:.2f}'),
+    ('bytes/response', 'response_bytes', '{:.0f}'),
+    ('non-2xx responses', 'non_2xx', '{}'),
+    ('socket errors', 'socket_errors', '{}'),
+)
+
+
+def to_ms(value, unit):
+    return float(value) * UNITS[unit]
+
+
+def parse_wrk_output(output):
+    result = {
+        'rps': float(RPS_RE.search(output).group(1)),
+        'requests': int(REQUESTS_RE.search(output).group(1)),
+        'latency_avg': to_ms(*LATENCY_RE.search(output).groups()),
+        'non_2xx': 0,
+        'socket_errors': '-',
+    }
+    for percentile, value, unit in PERCENTILE_RE.findall(output):
+        result[f'latency_p{percentile}'] = to_ms(value, unit)
+    match = NON_2XX_RE.search(output)
+    if match:
+        result['non_2xx'] = int(match.group(1))
+    match = SOCKET_ERRORS_RE.search(output)
+    if match:
+        result['socket_errors'] = match.group(1)
+    match = TRANSFER_RE.search(output)
+    if match and result['rps']:
+        # bytes read by wrk, headers included
+        result['response_bytes'] = float(match.group(1)) * BYTE_UNITS[match.group(2)] / result['rps']
+    return result
+
+
+def run_wrk(url, scenario, threads, connections, duration, env=None):
+    env = dict(os.environ, **(env or {}), WRK_TEST_NAME=scenario)
+    command = ['wrk', '--latency', '-t', str(threads), '-c', str(connections), '-d', duration,
+               '-s', WRK_SCRIPT.name, url]
+    # the script requires ulid.lua, which is looked up relative to the working directory
+    completed = subprocess.run(command, env=env, cwd=WRK_SCRIPT.parent, capture_output=True, text=True,
+                               check=True)
+    return completed.stdout
+
+
+def print_report(results):
+    scenarios = list(results)
+    width = max(12, *(len(scenario) for scenario in scenarios))
+    print(f"{'':20}" + ''.join(f'{scenario:>{width + 2}}' for scenario in scenarios))
+    for title, key, value_format in ROWS:
+        values = [value_format.format(results[scenario][key]) if key in results[scenario] else '-'
+                  for scenario in scenarios]
+        print(f'{title:20}' + ''.join(f'{value:>{width + 2}}' for value in values))
+    base = results[scenarios[0]]['rps']
+    if base:
+        ratios = [f"{results[scenario]['rps'] / base:.2f}x" for scenario in scenarios]
+        print(f"{'rps vs ' + scenarios[0]:20}" + ''.join(f'{ratio:>{width + 2}}' for ratio in ratios))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Side-by-side report of wrk scenarios')
+    parser.add_argument('--url', default='http://localhost:8080', help='Base URL of inventory_service')
+    parser.add_argument('--scenarios', nargs='+', default=['write', 'write_stored_trx'],
+                        help='WRK_TEST_NAME values to run, the first one is the baseline')
+    parser.add_argument('--threads', '-t', type=int, default=4, help='wrk threads')
+    parser.add_argument('--connections', '-c', type=int, default=64, help='wrk connections')
+    parser.add_argument('--duration', '-d', default='30s', help='wrk duration of every scenario')
+    parser.add_argument('--formats', nargs='+', default=['json'], choices=('json', 'msgpack'),
+                        help='WRK_TEST_FORMAT values, every scenario runs in every format')
+    parser.add_argument('--save-output', help='Directory to store raw wrk output of every scenario')
+    args = parser.parse_args()
+
+    results = {}
+    for scenario in args.scenarios:
+        for wire_format in args.formats:
+            name = scenario if len(args.formats) == 1 else f'{scenario}/{wire_format}'
+            print(f'Running {name} for {args.duration}...')
+            output = run_wrk(args.url, scenario, args.threads, args.connections, args.duration,
+                             env={'WRK_TEST_FORMAT': wire_format})
+            if args.save_output:
+                os.makedirs(args.save_output, exist_ok=True)
+                with open(os.path.join(args.save_output, f"{name.replace('/', '_')}.txt"), 'w') as output_file:
+                    output_file.write(output)
+            results[name] = parse_wrk_output(output)
+    print_report(results)
+
+
+if __name__ == '__main__':
+    main()
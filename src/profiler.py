@@ -0,0 +1,97 @@
+import asyncio
+import collections
+import os
+import sys
+import threading
+
+from aiohttp import web
+
+from error import ApiErrorCode, ApiServiceUnavailableError, ApiValidationError
+
+DEFAULT_INTERVAL_MS = 10
+MIN_INTERVAL_MS = 1
+MAX_INTERVAL_MS = 100
+
+
+def get_frame_label(code, labels):
+    label = labels.get(code)
+    if label is None:
+        # co_qualname is 3.11+, co_name has no class name
+        name = getattr(code, 'co_qualname', code.co_name)
+        label = labels[code] = f'{os.path.basename(code.co_filename)}:{name}'
+    return label
+
+
+def sample_stacks(thread_id, interval, stop, stacks):
+    labels = {}
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(get_frame_label(frame.f_code, labels))
+            frame = frame.f_back
+        stack.reverse()
+        stacks[';'.join(stack)] += 1
+
+
+# Sampling profiler of the event loop thread. A separate thread takes the stack of the loop
+# thread every interval_ms, so the loop itself runs unchanged and the cost is one stack walk
+# per sample. While the loop waits for IO the samples end in selectors.py, that is idle time.
+# Stacks are returned collapsed, one "root;...;leaf count" line per stack, as flamegraph.pl
+# and speedscope read them.
+class SamplingProfiler:
+    def __init__(self, max_seconds=60):
+        self.max_seconds = max_seconds
+        self.running = False
+
+    def parse_params(self, query):
+        try:
+            seconds = float(query.get('seconds', 10))
+            interval_ms = float(query.get('interval_ms', DEFAULT_INTERVAL_MS))
+        except ValueError:
+            raise ApiValidationError(error_message='seconds and interval_ms must be numbers', context=dict(query))
+        if not 0 < seconds <= self.max_seconds:
+            raise ApiValidationError(
+                error_message=f'seconds must be between 0 and {self.max_seconds}',
+                context={'seconds': seconds, 'max_seconds': self.max_seconds}
+            )
+        if not MIN_INTERVAL_MS <= interval_ms <= MAX_INTERVAL_MS:
+            raise ApiValidationError(
+                error_message=f'interval_ms must be between {MIN_INTERVAL_MS} and {MAX_INTERVAL_MS}',
+                context={'interval_ms': interval_ms}
+            )
+        return seconds, interval_ms / 1000.0
+
+    async def profile(self, seconds, interval):
+        if self.running:
+            raise ApiServiceUnavailableError(
+                error_message='Profiler is already running',
+                error_code=ApiErrorCode.overloaded,
+            )
+        self.running = True
+        stop = threading.Event()
+        stacks = collections.Counter()
+        sampler = threading.Thread(
+            target=sample_stacks,
+            args=(threading.get_ident(), interval, stop, stacks),
+            name='sampling-profiler',
+            daemon=True,
+        )
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            # the sampler wakes up at once, at most one stack walk to wait for
+            sampler.join()
+            self.running = False
+        return stacks
+
+
+async def profile_view(request: web.Request):
+    # with several workers the request is served by one of them, its pid is in X-Worker-Pid
+    profiler = request.app.profiler
+    seconds, interval = profiler.parse_params(request.query)
+    stacks = await profiler.profile(seconds, interval)
+    body = ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+    return web.Response(text=body, content_type='text/plain', headers={'X-Worker-Pid': str(os.getpid())})
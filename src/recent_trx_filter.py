@@ -0,0 +1,61 @@
+import collections
+import random
+import time
+
+from monitoring import (
+    inc_recent_trx_filter_lookup, inc_recent_trx_filter_verified, inc_recent_trx_filter_false_positive,
+    set_recent_trx_filter_size
+)
+
+
+# Bounded per-process set of (player_id, ext_trx_id) keys known to be in player_inventory_trx,
+# used to answer retried grants without a DB round-trip. Keys are added only after the DB
+# confirmed them (granted or duplicate), expire after window_seconds and the least recently
+# used are evicted above max_keys. A miss says nothing, DB stays the source of truth.
+# verify_sample_rate of hits still go to DB to measure the false positive rate, e.g. after
+# rows were deleted or DB was restored from a backup.
+class RecentTrxFilter:
+    def __init__(self, window_seconds=300, max_keys=100000, verify_sample_rate=0.01):
+        self.window = window_seconds
+        self.max_keys = max_keys
+        self.verify_sample_rate = verify_sample_rate
+        self._keys = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._keys)
+
+    # Returns True if the grant is a known duplicate and must not be sent to DB
+    def is_duplicate(self, player_id, ext_trx_id):
+        key = (player_id, ext_trx_id)
+        expires_at = self._keys.get(key)
+        if expires_at is None:
+            inc_recent_trx_filter_lookup('miss')
+            return False
+        if expires_at < time.monotonic():
+            del self._keys[key]
+            set_recent_trx_filter_size(len(self._keys))
+            inc_recent_trx_filter_lookup('expired')
+            return False
+        self._keys.move_to_end(key)
+        if self.verify_sample_rate > 0 and random.random() < self.verify_sample_rate:
+            inc_recent_trx_filter_lookup('verify')
+            return False
+        inc_recent_trx_filter_lookup('hit')
+        return True
+
+    # Called with the DB result of every grant that was written or found duplicate
+    def remember(self, player_id, ext_trx_id, is_duplicate):
+        if ext_trx_id is None:
+            # rejected by NOT NULL constraint, never stored
+            return
+        key = (player_id, ext_trx_id)
+        if key in self._keys:
+            inc_recent_trx_filter_verified()
+            if not is_duplicate:
+                # the filter had the key, but DB didn't
+                inc_recent_trx_filter_false_positive()
+            self._keys.move_to_end(key)
+        self._keys[key] = time.monotonic() + self.window
+        while len(self._keys) > self.max_keys:
+            self._keys.popitem(last=False)
+        set_recent_trx_filter_size(len(self._keys))
@@ -0,0 +1,164 @@
+import asyncio
+import itertools
+import logging
+import time
+
+import asyncpg
+
+import statements
+from monitoring import inc_replica_read, set_replica_state
+
+# returned by grants and accepted by reads, carries the primary LSN after the grant committed
+READ_TOKEN_HEADER = 'X-Read-Token'
+# lost connections take the replica out of rotation until the next successful health check,
+# other errors (e.g. queries canceled by recovery conflicts) only send the read to the primary
+CONNECTION_ERRORS = (asyncpg.PostgresConnectionError, asyncpg.InterfaceError, OSError)
+READ_ERRORS = CONNECTION_ERRORS + (asyncpg.PostgresError, asyncio.TimeoutError)
+
+
+def format_lsn(lsn):
+    # the same text form as pg_lsn, e.g. 16/B374D848
+    return f'{lsn >> 32:X}/{lsn & 0xFFFFFFFF:X}'
+
+
+async def read_lsn_token(conn):
+    # primary LSN after a write committed on conn, a read with it sees the write on replicas too
+    return format_lsn(await conn.fetchval(statements.GET_CURRENT_WAL_LSN))
+
+
+def parse_lsn(token):
+    try:
+        high, low = token.split('/')
+        return (int(high, 16) << 32) | int(low, 16)
+    except ValueError:
+        return None
+
+
+class Replica:
+    def __init__(self, name, pool_settings):
+        self.name = name
+        self.pool_settings = pool_settings
+        self.pool = None
+        self.healthy = False
+        self.replay_lsn = 0
+        self.lag_bytes = None
+
+
+# Routes reads to replicas round-robin, replicas which fail health checks or lag more than
+# max_lag_bytes behind the primary are skipped, and reads go to the primary when none is left.
+# A read with min_lsn (read-your-writes) waits up to read_your_writes_wait_ms for the replica
+# to replay that LSN, then it is sent to the primary.
+class ReplicaRouter:
+    def __init__(self, primary_pool, replicas, create_pool, healthcheck_interval_seconds=1.0,
+                 max_lag_bytes=16 * 1024 * 1024, acquire_timeout_seconds=0.1, read_your_writes_wait_ms=20,
+                 lsn_poll_interval_ms=2):
+        self.primary_pool = primary_pool
+        self.replicas = replicas
+        self.create_pool = create_pool
+        self.healthcheck_interval = healthcheck_interval_seconds
+        self.max_lag_bytes = max_lag_bytes
+        self.acquire_timeout = acquire_timeout_seconds
+        self.read_your_writes_wait = read_your_writes_wait_ms / 1000.0
+        self.lsn_poll_interval = lsn_poll_interval_ms / 1000.0
+        self._next_replica = itertools.cycle(range(len(replicas)))
+        self._task = None
+
+    async def start(self):
+        # replicas start unhealthy, the first check runs before traffic is accepted
+        await self.check_health()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for replica in self.replicas:
+            if replica.pool is not None:
+                await replica.pool.close()
+                replica.pool = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.healthcheck_interval)
+            await self.check_health()
+
+    async def check_health(self):
+        primary_lsn = None
+        try:
+            async with self.primary_pool.acquire() as conn:
+                primary_lsn = await conn.fetchval(statements.GET_CURRENT_WAL_LSN)
+        except Exception as e:
+            # replicas are still checked, only their lag is unknown
+            logging.warning('Failed to get primary LSN for replica health check: %s', e)
+        await asyncio.gather(*[self._check_replica(replica, primary_lsn) for replica in self.replicas])
+
+    async def _check_replica(self, replica, primary_lsn):
+        try:
+            if replica.pool is None:
+                # created here, so a replica that is down at startup doesn't stop the service
+                replica.pool = await asyncio.wait_for(self.create_pool(replica.pool_settings),
+                                                      self.healthcheck_interval)
+            async with replica.pool.acquire(timeout=self.healthcheck_interval) as conn:
+                replica.replay_lsn = await conn.fetchval(statements.GET_REPLAY_LSN) or 0
+        except Exception as e:
+            if replica.healthy:
+                logging.warning('Replica %s failed health check, reads go to other replicas or primary: %s',
+                                replica.name, e)
+            replica.healthy = False
+            set_replica_state(replica.name, False, None)
+            return
+        if primary_lsn is not None:
+            replica.lag_bytes = max(primary_lsn - replica.replay_lsn, 0)
+        healthy = replica.lag_bytes is None or replica.lag_bytes <= self.max_lag_bytes
+        if healthy != replica.healthy:
+            logging.info('Replica %s is %s, lag %s bytes', replica.name, 'healthy' if healthy else 'lagging',
+                         replica.lag_bytes)
+        replica.healthy = healthy
+        set_replica_state(replica.name, healthy, replica.lag_bytes)
+
+    def _choose_replica(self):
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._next_replica)]
+            if replica.healthy:
+                return replica
+        return None
+
+    async def _wait_for_lsn(self, replica, conn, min_lsn):
+        if replica.replay_lsn >= min_lsn:
+            return True
+        deadline = time.monotonic() + self.read_your_writes_wait
+        while True:
+            replay_lsn = await conn.fetchval(statements.GET_REPLAY_LSN) or 0
+            replica.replay_lsn = max(replica.replay_lsn, replay_lsn)
+            if replay_lsn >= min_lsn:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(self.lsn_poll_interval)
+
+    async def fetch(self, sql, *args, min_lsn=None):
+        # returns rows and whether they were read on a replica
+        replica = self._choose_replica()
+        if replica is None:
+            reason = 'no_healthy_replica'
+        else:
+            try:
+                async with replica.pool.acquire(timeout=self.acquire_timeout) as conn:
+                    if min_lsn is None or await self._wait_for_lsn(replica, conn, min_lsn):
+                        rows = await conn.fetch(sql, *args)
+                        inc_replica_read('replica', 'ok')
+                        return rows, True
+                reason = 'lsn_not_replayed'
+            except READ_ERRORS as e:
+                if isinstance(e, CONNECTION_ERRORS):
+                    replica.healthy = False
+                    set_replica_state(replica.name, False, None)
+                logging.warning('Read from replica %s failed, retrying on primary: %s', replica.name, e)
+                reason = 'replica_error'
+        inc_replica_read('primary', reason)
+        async with self.primary_pool.acquire() as conn:
+            return await conn.fetch(sql, *args), False
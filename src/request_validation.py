@@ -0,0 +1,78 @@
+import fastjsonschema
+import yaml
+from aiohttp import web
+from aiohttp_swagger3.validators import ValidatorError
+
+import serializer
+from error import ApiErrorCode, ApiValidationError
+
+# swagger: aiohttp_swagger3 validates every request against openapi_spec.yaml,
+# compiled: json body schemas of the spec are compiled to python functions once at startup,
+# none: no validation
+VALIDATION_MODES = ('swagger', 'compiled', 'none')
+
+
+def resolve_refs(schema, spec):
+    # fastjsonschema resolves $ref against the schema itself, so components are inlined
+    if isinstance(schema, dict):
+        if '$ref' in schema:
+            target = spec
+            for part in schema['$ref'].lstrip('#/').split('/'):
+                target = target[part]
+            return resolve_refs(target, spec)
+        return {key: resolve_refs(value, spec) for key, value in schema.items()}
+    if isinstance(schema, list):
+        return [resolve_refs(item, spec) for item in schema]
+    return schema
+
+
+def compile_request_validators(spec_path):
+    with open(spec_path, 'r') as spec_file:
+        spec = yaml.safe_load(spec_file)
+    validators = {}
+    for path, operations in spec.get('paths', {}).items():
+        for method, operation in operations.items():
+            # msgpack bodies are decoded to the same objects and checked by the json schema too
+            schema = operation.get('requestBody', {}).get('content', {}).get('application/json', {}).get('schema')
+            if schema is not None:
+                validators[(method.upper(), path)] = fastjsonschema.compile(resolve_refs(schema, spec))
+    return validators
+
+
+async def msgpack_media_type_handler(request):
+    # application/msgpack bodies for aiohttp_swagger3, decoded by serializer like in compiled mode
+    try:
+        return await serializer.read_json(request), False
+    except web.HTTPBadRequest as e:
+        raise ValidatorError(e.reason)
+
+
+def get_error_context(e):
+    # same shape as errors of swagger validation, e.g. {'body': {'amount': 'required property'}}
+    if e.rule == 'required' and isinstance(e.value, dict):
+        context = {name: 'required property' for name in e.rule_definition if name not in e.value}
+    else:
+        context = e.message
+    for part in reversed(e.path[1:]):
+        context = {str(part): context}
+    return {'body': context}
+
+
+def make_validation_middleware(validators):
+    @web.middleware
+    async def validation_middleware(request: web.Request, handler) -> web.StreamResponse:
+        validate = validators.get((request.method, request.path))
+        if validate is not None:
+            # parsed body is kept in request, so handlers don't parse it again
+            data = await serializer.read_json(request)
+            try:
+                validate(data)
+            except fastjsonschema.JsonSchemaValueException as e:
+                raise ApiValidationError(
+                    error_message='Invalid params in body',
+                    error_code=ApiErrorCode.schema_validation_error,
+                    context=get_error_context(e)
+                )
+        return await handler(request)
+
+    return validation_middleware
@@ -0,0 +1,124 @@
+import json
+import logging
+
+from aiohttp import web
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+BACKENDS = ('auto', 'orjson', 'stdlib')
+JSON_BODY_KEY = 'json_body'
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+def stdlib_loads(data):
+    return json.loads(data)
+
+
+# Backend used by request parsing, responses and jsonb codec. Both functions work with bytes,
+# so no str <-> bytes copies are made on the way to/from the socket.
+dumps = stdlib_dumps
+loads = stdlib_loads
+backend = 'stdlib'
+
+
+def configure(name='auto'):
+    global dumps, loads, backend
+    if name not in BACKENDS:
+        raise Exception(f"Unknown json backend '{name}', possible values: {', '.join(BACKENDS)}")
+    if name == 'orjson' and orjson is None:
+        raise Exception("json backend 'orjson' is configured, but orjson is not installed")
+
+    if name in ('auto', 'orjson') and orjson is not None:
+        dumps, loads, backend = orjson.dumps, orjson.loads, 'orjson'
+    else:
+        dumps, loads, backend = stdlib_dumps, stdlib_loads, 'stdlib'
+    logging.info('Using %s json backend', backend)
+
+
+# msgpack.packb() creates a Packer with a 256KiB buffer on every call, one Packer is reused
+# instead, it is safe as long as it is used from the event loop thread only
+msgpack_packer = msgpack.Packer() if msgpack is not None else None
+
+
+def msgpack_dumps(obj):
+    return msgpack_packer.pack(obj)
+
+
+def msgpack_loads(data):
+    return msgpack.unpackb(data)
+
+
+def pack_response_head(key, length):
+    # start of {"status": "OK", "data": {key: [...]}} with an array of length items, which follow it
+    # packed one by one, so msgpack responses can be streamed like json ones
+    packer = msgpack_packer
+    return b''.join((packer.pack_map_header(2), packer.pack('status'), packer.pack('OK'), packer.pack('data'),
+                     packer.pack_map_header(1), packer.pack(key), packer.pack_array_header(length)))
+
+
+async def read_json(request):
+    # parsed once per request, compiled request validation and handlers share it. msgpack bodies
+    # are decoded to the same objects as json ones, so validation and handlers work with both
+    if JSON_BODY_KEY in request:
+        return request[JSON_BODY_KEY]
+    body = await request.read()
+    if request.content_type == MSGPACK_CONTENT_TYPE:
+        if msgpack is None:
+            raise web.HTTPBadRequest(reason='msgpack is not installed, send json')
+        try:
+            data = msgpack_loads(body)
+        except (ValueError, TypeError):
+            raise web.HTTPBadRequest(reason='Invalid msgpack in body')
+    else:
+        try:
+            data = loads(body)
+        except ValueError:
+            # turned into validation_error by error_middleware
+            raise web.HTTPBadRequest(reason='Invalid JSON in body')
+    request[JSON_BODY_KEY] = data
+    return data
+
+
+def accepts_msgpack(request):
+    return msgpack is not None and MSGPACK_CONTENT_TYPE in request.headers.get('Accept', '')
+
+
+def get_encoder(request):
+    # response format is chosen by Accept, json is the default
+    if accepts_msgpack(request):
+        return msgpack_dumps, MSGPACK_CONTENT_TYPE
+    return dumps, JSON_CONTENT_TYPE
+
+
+def json_response(data, status=200):
+    return web.Response(body=dumps(data), status=status, content_type=JSON_CONTENT_TYPE)
+
+
+def response(request, data, status=200):
+    encode, content_type = get_encoder(request)
+    return web.Response(body=encode(data), status=status, content_type=content_type)
+
+
+# jsonb binary wire format is a version byte followed by json text
+JSONB_FORMAT_VERSION = b'\x01'
+
+
+def encode_jsonb(obj):
+    return JSONB_FORMAT_VERSION + dumps(obj)
+
+
+def decode_jsonb(data):
+    return loads(data[1:])
@@ -0,0 +1,232 @@
+import asyncio
+import datetime
+import logging
+
+import asyncpg
+
+# All SQL used on pool connections lives here, so it can be prepared on every new
+# connection before it serves traffic.
+
+GET_INVENTORY = """
+    SELECT * FROM player_inventory WHERE player_id = $1
+"""
+
+GET_INVENTORY_BATCH = """
+    SELECT * FROM player_inventory WHERE player_id = ANY($1::bigint[])
+"""
+
+INSERT_INVENTORY_TRX = """
+    INSERT INTO player_inventory_trx (player_id, ext_trx_id)
+    VALUES ($1, $2)
+"""
+
+UPSERT_INVENTORY = """
+    INSERT INTO player_inventory (player_id, inventory_type, item_code, amount)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (player_id, item_code)
+    DO UPDATE SET amount = player_inventory.amount + $4
+    RETURNING *, (xmax = 0) AS inserted;
+"""
+
+INSERT_PLAYER_EVENT = """
+    INSERT INTO log_player_event
+        (player_id, event_type, event_value_int, meta_data, ext_trx_id)
+    VALUES ($1, $2, $3, $4, $5)
+"""
+
+GRANT_STORED_PROC = """
+    SELECT grant_inventory($1, $2, $3, $4, $5, $6)
+"""
+
+BATCH_GRANT_STORED_PROC = """
+    SELECT idx, status
+    FROM grant_inventory_batch($1::bigint[], $2::varchar[], $3::text[]::inventory_type[], $4::varchar[],
+                               $5::bigint[], $6)
+"""
+
+BATCH_INSERT_INVENTORY_TRX = """
+    INSERT INTO player_inventory_trx (player_id, ext_trx_id)
+    SELECT * FROM unnest($1::bigint[], $2::varchar[])
+    ON CONFLICT (player_id, ext_trx_id) DO NOTHING
+    RETURNING player_id, ext_trx_id
+"""
+
+BATCH_UPSERT_INVENTORY = """
+    INSERT INTO player_inventory (player_id, inventory_type, item_code, amount)
+    SELECT t.player_id, t.inventory_type::inventory_type, t.item_code, t.amount
+    FROM unnest($1::bigint[], $2::text[], $3::varchar[], $4::bigint[])
+        AS t(player_id, inventory_type, item_code, amount)
+    ON CONFLICT (player_id, item_code)
+    DO UPDATE SET amount = player_inventory.amount + EXCLUDED.amount
+    RETURNING player_id, item_code, inventory_type, (xmax = 0) AS inserted;
+"""
+
+BATCH_INSERT_GRANT_EVENTS = """
+    INSERT INTO log_player_event
+        (player_id, event_type, event_value_int, meta_data, ext_trx_id)
+    SELECT t.player_id, 'inventory_granted', t.amount,
+           jsonb_build_object('inventory_type', t.inventory_type, 'item_code', t.item_code),
+           t.ext_trx_id
+    FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::varchar[], $5::varchar[])
+        AS t(player_id, amount, inventory_type, item_code, ext_trx_id)
+"""
+
+# amount >= $3 makes the check and the write one statement, no row is read before it
+CONSUME_INVENTORY = """
+    UPDATE player_inventory SET amount = amount - $3
+    WHERE player_id = $1 AND item_code = $2 AND amount >= $3
+    RETURNING inventory_type, amount
+"""
+
+LOCK_INVENTORY_ROW = """
+    SELECT inventory_type, amount FROM player_inventory
+    WHERE player_id = $1 AND item_code = $2
+    FOR UPDATE
+"""
+
+DELETE_INVENTORY_TRX = """
+    DELETE FROM player_inventory_trx WHERE player_id = $1 AND ext_trx_id = ANY($2::varchar[])
+"""
+
+BATCH_INSERT_PLAYER_EVENTS = """
+    INSERT INTO log_player_event
+        (player_id, event_type, event_value_int, meta_data, ext_trx_id)
+    SELECT t.player_id, t.event_type::game_event_type, t.amount,
+           jsonb_build_object('inventory_type', t.inventory_type, 'item_code', t.item_code),
+           t.ext_trx_id
+    FROM unnest($1::bigint[], $2::text[], $3::bigint[], $4::text[], $5::varchar[], $6::varchar[])
+        AS t(player_id, event_type, amount, inventory_type, item_code, ext_trx_id)
+"""
+
+GET_CATALOG = """
+    SELECT * FROM game_inventory_dict ORDER BY item_code
+"""
+
+INSERT_CATALOG_ITEM = """
+    INSERT INTO game_inventory_dict (
+        item_code, inventory_type, item_rarity, gd_description, base_param_array, base_param1_name,
+        base_param1_type, base_param1_value, base_param2_name, base_param2_type, base_param2_value,
+        base_param3_name, base_param3_type, base_param3_value, base_param4_name, base_param4_type,
+        base_param4_value, base_param5_name, base_param5_type, base_param5_value, ext_params, i18n
+    ) VALUES (
+        $1, $2::inventory_type, $3::game_inventory_item_rarity, $4, $5, $6, $7::game_param_type, $8,
+        $9, $10::game_param_type, $11, $12, $13::game_param_type, $14, $15, $16::game_param_type,
+        $17, $18, $19::game_param_type, $20, $21, $22
+    )
+    ON CONFLICT (item_code) DO NOTHING
+    RETURNING item_code
+"""
+
+UPDATE_CATALOG_ITEM = """
+    UPDATE game_inventory_dict SET
+        inventory_type = $2::inventory_type, item_rarity = $3::game_inventory_item_rarity,
+        gd_description = $4, base_param_array = $5, base_param1_name = $6,
+        base_param1_type = $7::game_param_type, base_param1_value = $8, base_param2_name = $9,
+        base_param2_type = $10::game_param_type, base_param2_value = $11, base_param3_name = $12,
+        base_param3_type = $13::game_param_type, base_param3_value = $14, base_param4_name = $15,
+        base_param4_type = $16::game_param_type, base_param4_value = $17, base_param5_name = $18,
+        base_param5_type = $19::game_param_type, base_param5_value = $20, ext_params = $21,
+        i18n = $22
+    WHERE item_code = $1
+    RETURNING item_code
+"""
+
+DELETE_CATALOG_ITEM = """
+    DELETE FROM game_inventory_dict WHERE item_code = $1
+    RETURNING item_code
+"""
+
+# LSNs as numbers, pg_lsn - '0/0' is the byte position in WAL
+GET_CURRENT_WAL_LSN = """
+    SELECT (pg_current_wal_lsn() - '0/0')::bigint
+"""
+
+# the same instance can stand in for a replica, then its current LSN is used
+GET_REPLAY_LSN = """
+    SELECT (CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END
+            - '0/0')::bigint
+"""
+
+# Both bounds of event_time are always given, so only partitions of the range are scanned. Pages are
+# keyset ones: the next page starts after (event_time, id) of the last row of the previous one.
+GET_PLAYER_EVENTS = """
+    SELECT id, event_time, event_type, event_value_int, ext_trx_id, meta_data
+    FROM log_player_event
+    WHERE player_id = $1 AND event_time >= $2 AND event_time < $3 AND (event_time, id) > ($4, $5)
+    ORDER BY event_time, id
+    LIMIT $6
+"""
+
+EPOCH = datetime.datetime(1970, 1, 1)
+CATALOG_ITEM_WARM_UP_ARGS = ('warm_up', 'other', 'common', 'warm_up', None) + (None,) * 15 + ({}, None)
+
+# statement and arguments used to run it once during warm-up, player_id -1 never exists
+STATEMENT_REGISTRY = (
+    (GET_INVENTORY, (-1,)),
+    (GET_INVENTORY_BATCH, ([-1],)),
+    (INSERT_INVENTORY_TRX, (-1, 'warm_up')),
+    (UPSERT_INVENTORY, (-1, 'other', 'warm_up', 0)),
+    (INSERT_PLAYER_EVENT, (-1, 'inventory_granted', 0, {}, 'warm_up')),
+    (GRANT_STORED_PROC, (-1, 'warm_up', 'other', 'warm_up', 0, True)),
+    (BATCH_GRANT_STORED_PROC, ([-1], ['warm_up'], ['other'], ['warm_up'], [0], True)),
+    (BATCH_INSERT_INVENTORY_TRX, ([-1], ['warm_up'])),
+    (BATCH_UPSERT_INVENTORY, ([-1], ['other'], ['warm_up'], [0])),
+    (BATCH_INSERT_GRANT_EVENTS, ([-1], [0], ['other'], ['warm_up'], ['warm_up'])),
+    (CONSUME_INVENTORY, (-1, 'warm_up', 0)),
+    (LOCK_INVENTORY_ROW, (-1, 'warm_up')),
+    (DELETE_INVENTORY_TRX, (-1, ['warm_up'])),
+    (BATCH_INSERT_PLAYER_EVENTS, ([-1], ['inventory_consumed'], [0], ['other'], ['warm_up'], ['warm_up'])),
+    (GET_CATALOG, ()),
+    (INSERT_CATALOG_ITEM, CATALOG_ITEM_WARM_UP_ARGS),
+    (UPDATE_CATALOG_ITEM, CATALOG_ITEM_WARM_UP_ARGS),
+    (DELETE_CATALOG_ITEM, ('warm_up',)),
+    (GET_PLAYER_EVENTS, (-1, EPOCH, EPOCH, EPOCH, 0, 1)),
+    (GET_CURRENT_WAL_LSN, ()),
+)
+# prepared on every new primary connection, only reads, so they run without a transaction and
+# change nothing, writes are warmed up by warm_up_pool() with pool_warm_up enabled
+READ_STATEMENT_REGISTRY = (
+    (GET_INVENTORY, (-1,)),
+    (GET_INVENTORY_BATCH, ([-1],)),
+    (GET_PLAYER_EVENTS, (-1, EPOCH, EPOCH, EPOCH, 0, 1)),
+    (GET_CURRENT_WAL_LSN, ()),
+)
+# replicas serve only reads
+REPLICA_STATEMENT_REGISTRY = (
+    (GET_INVENTORY, (-1,)),
+    (GET_INVENTORY_BATCH, ([-1],)),
+    (GET_REPLAY_LSN, ()),
+)
+
+
+async def prepare_statements(conn, registry=READ_STATEMENT_REGISTRY):
+    # fetch() prepares statements through the connection statement cache, so running every
+    # statement once fills it, Connection.prepare() would bypass it
+    for sql, args in registry:
+        try:
+            await conn.fetch(sql, *args)
+        except asyncpg.exceptions.PostgresError as e:
+            logging.warning('Failed to prepare statement %s: %s', sql.strip().splitlines()[0], e)
+
+
+async def warm_up_connection(conn):
+    # every statement is executed and rolled back, so plans and catalog caches are hot
+    for sql, args in STATEMENT_REGISTRY:
+        trx = conn.transaction()
+        await trx.start()
+        try:
+            # not execute(), without arguments it uses the simple query protocol and prepares nothing
+            await conn.fetch(sql, *args)
+        except asyncpg.exceptions.PostgresError as e:
+            logging.warning('Failed to warm up statement %s: %s', sql.strip().splitlines()[0], e)
+        finally:
+            await trx.rollback()
+
+
+async def warm_up_pool(pool, connections):
+    async def warm_up_one():
+        async with pool.acquire() as conn:
+            await warm_up_connection(conn)
+
+    # connections are held at the same time, so each of them is a different one
+    await asyncio.gather(*[warm_up_one() for _ in range(connections)])
@@ -0,0 +1,85 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+from prometheus_client import multiprocess
+
+# a worker that dies sooner than this after start is restarted with a delay, to avoid a restart storm
+MIN_WORKER_UPTIME_SECONDS = 5.0
+RESTART_DELAY_SECONDS = 1.0
+
+
+def prepare_multiprocess_metrics_dir():
+    metrics_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if metrics_dir is None:
+        metrics_dir = tempfile.mkdtemp(prefix='inventory_metrics_')
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = metrics_dir
+    else:
+        # files of previous runs would be aggregated into /metrics otherwise
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir)
+    return metrics_dir
+
+
+# Runs N worker processes and restarts any of them that dies.
+# Workers are spawned, not forked, so each of them imports prometheus_client with
+# PROMETHEUS_MULTIPROC_DIR already set and builds its own event loop and db pool.
+class WorkerSupervisor:
+    def __init__(self, target, workers, args=()):
+        self.target = target
+        self.workers = workers
+        self.args = args
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = {}
+        self._stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop_signal)
+        signal.signal(signal.SIGINT, self._on_stop_signal)
+        for worker_id in range(self.workers):
+            self._start_worker(worker_id)
+        try:
+            while not self._stopping:
+                time.sleep(0.5)
+                self._restart_dead_workers()
+        finally:
+            self._stop_workers()
+
+    def _start_worker(self, worker_id):
+        process = self._context.Process(target=self.target, args=(worker_id,) + tuple(self.args),
+                                        name=f'inventory-worker-{worker_id}')
+        process.start()
+        self._processes[worker_id] = (process, time.monotonic())
+        logging.info('Started worker %s, pid %s', worker_id, process.pid)
+
+    def _restart_dead_workers(self):
+        for worker_id, (process, started_at) in list(self._processes.items()):
+            if process.is_alive() or self._stopping:
+                continue
+            logging.error('Worker %s (pid %s) exited with code %s, restarting', worker_id, process.pid,
+                          process.exitcode)
+            mark_worker_dead(process.pid)
+            if time.monotonic() - started_at < MIN_WORKER_UPTIME_SECONDS:
+                time.sleep(RESTART_DELAY_SECONDS)
+            self._start_worker(worker_id)
+
+    def _stop_workers(self):
+        for process, _ in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process, _ in self._processes.values():
+            process.join()
+            mark_worker_dead(process.pid)
+        logging.info('All workers stopped')
+
+    def _on_stop_signal(self, signum, _frame):
+        logging.info('Received signal %s, stopping workers', signum)
+        self._stopping = True
+
+
+def mark_worker_dead(pid):
+    multiprocess.mark_process_dead(pid)
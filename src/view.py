@@ -1,39 +1,214 @@
+import hashlib
 import logging
 
 from aiohttp import web
-import asyncpg
+
+import serializer
+import statements
+from error import ApiBaseError, ApiInternalError, ApiLogicalError, ApiValidationError
+from catalog import parse_catalog_item
+from consumes import Consume, consume_event, log_duplicate_consume, write_consume
+from event_history import NDJSON_CONTENT_TYPE, encode_cursor, format_event
+from grants import (
+    BATCH_GRANT_WRITERS, SINGLE_GRANT_WRITERS, Grant, grant_event, grant_events, write_grant_stored_proc
+)
+from monitoring import inc_event_history_export, inc_inventory_consume
+from replicas import READ_TOKEN_HEADER, parse_lsn, read_lsn_token
+
+MAX_GET_BATCH_SIZE = 100
+MAX_GRANT_BATCH_SIZE = 5000
+ENRICH_VALUES = ('true', '1')
+
+
+def error_response(request, data, status):
+    response = serializer.response(request, data, status=status)
+    response['error_code'] = data['error_code']
+    return response
+
+
+def format_inventory_item(row):
+    return {'id': row[0], 'inventory_type': row[2], 'item_code': row[3], 'amount': row[4]}
+
+
+def invalidate_inventory_cache(app, player_id):
+    if app.inventory_cache is not None:
+        app.inventory_cache.invalidate(player_id)
+    if app.cache_invalidation is not None:
+        app.cache_invalidation.publish(player_id)
+
+
+def get_min_lsn(request):
+    token = request.headers.get(READ_TOKEN_HEADER)
+    if token is None or request.app.replica_router is None:
+        return None
+    min_lsn = parse_lsn(token)
+    if min_lsn is None:
+        raise ApiValidationError(error_message='Invalid read token', context={'header': READ_TOKEN_HEADER})
+    return min_lsn
+
+
+async def fetch_for_read(app, sql, *args, min_lsn=None):
+    # returns rows and whether they were read on a replica
+    if app.replica_router is not None:
+        return await app.replica_router.fetch(sql, *args, min_lsn=min_lsn)
+    async with app.db_pool.acquire() as conn:
+        return await conn.fetch(sql, *args), False
+
+
+async def get_read_token(app, conn):
+    # read on the connection which made the write, after commit, so it costs no extra acquire
+    if app.replica_router is None:
+        return None
+    return await read_lsn_token(conn)
+
+
+def write_response(request, data, read_token):
+    response = serializer.response(request, {
+        'status': 'OK',
+        'data': data
+    })
+    if read_token is not None:
+        response.headers[READ_TOKEN_HEADER] = read_token
+    return response
+
+
+def etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    return any(value.strip() in (etag, '*') for value in if_none_match.split(','))
+
+
+def etag_response(request, body, etag=None, content_type=serializer.JSON_CONTENT_TYPE):
+    # without a given etag it is a hash of the body, so it is the same in every worker
+    if etag is None:
+        etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    # json and msgpack bodies have different etags, caches must keep them apart
+    headers = {'ETag': etag, 'Vary': 'Accept'}
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type=content_type, headers=headers)
+
+
+def inventory_response(request, player_id, inventory_data):
+    if request.query.get('enrich') not in ENRICH_VALUES:
+        return serializer.response(request, {
+            'status': 'OK',
+            'data': {'player_id': player_id, 'inventory': inventory_data}
+        })
+    # catalog items come from the in-memory snapshot, no join in SQL
+    catalog_items = request.app.catalog.snapshot.items
+    inventory_data = [dict(item, catalog=catalog_items.get(item['item_code'])) for item in inventory_data]
+    encode, content_type = serializer.get_encoder(request)
+    return etag_response(request, encode({
+        'status': 'OK',
+        'data': {'player_id': player_id, 'inventory': inventory_data}
+    }), content_type=content_type)
 
 
 async def get_inventory(request):
-    data = await request.json()
+    data = await serializer.read_json(request)
 
     # Validate and retrieve player_id from the request
     player_id = data.get('player_id')
+    min_lsn = get_min_lsn(request)
 
-    # Connect to the PostgreSQL database
-    async with request.app.db_pool.acquire() as conn:
-        # Perform a database query to get the player's inventory
-        inventory = await conn.fetch("SELECT * FROM player_inventory WHERE player_id = $1", player_id)
+    cache = request.app.inventory_cache
+    # with replicas the cache may hold data read before the grant, so reads with a token skip it
+    if cache is not None and min_lsn is None:
+        inventory_data = cache.get(player_id)
+        if inventory_data is not None:
+            return inventory_response(request, player_id, inventory_data)
+    if cache is not None:
+        cache.begin_load(player_id)
+
+    inventory_data = None
+    from_replica = False
+    try:
+        # Perform a database query to get the player's inventory, on a replica if there are any
+        inventory, from_replica = await fetch_for_read(request.app, statements.GET_INVENTORY, player_id,
+                                                       min_lsn=min_lsn)
 
         # Format the inventory data as needed
-        inventory_data = [
-            {'id': row[0], 'inventory_type': row[2], 'item_code': row[3], 'amount': row[4]}
-            for row in inventory
-        ]
+        inventory_data = [format_inventory_item(row) for row in inventory]
+    finally:
+        if cache is not None:
+            # a replica may not have replayed a grant committed before the read yet, while its
+            # invalidation has already happened, so only rows read on the primary are cached
+            cache.end_load(player_id, None if from_replica else inventory_data)
 
     # Return the inventory data as JSON response
-    return web.json_response({
-        'status': 'OK',
-        'data': {'player_id': player_id, 'inventory': inventory_data}
-    })
+    return inventory_response(request, player_id, inventory_data)
 
 
+async def get_inventory_batch(request):
+    data = await serializer.read_json(request)
+
+    # keep request order, but query every player only once
+    player_ids = list(dict.fromkeys(data.get('player_ids') or []))
+    if len(player_ids) > MAX_GET_BATCH_SIZE:
+        raise ApiValidationError(
+            error_message=f'Too many players in batch, max is {MAX_GET_BATCH_SIZE}',
+            context={'max_batch_size': MAX_GET_BATCH_SIZE, 'batch_size': len(player_ids)}
+        )
+
+    min_lsn = get_min_lsn(request)
+    inventories = {}
+    missed_player_ids = player_ids
+    cache = request.app.inventory_cache
+    if cache is not None:
+        missed_player_ids = []
+        for player_id in player_ids:
+            inventory_data = cache.get(player_id) if min_lsn is None else None
+            if inventory_data is None:
+                missed_player_ids.append(player_id)
+                cache.begin_load(player_id)
+            else:
+                inventories[player_id] = inventory_data
+
+    if missed_player_ids:
+        loaded = {}
+        from_replica = False
+        try:
+            rows, from_replica = await fetch_for_read(request.app, statements.GET_INVENTORY_BATCH,
+                                                      missed_player_ids, min_lsn=min_lsn)
+            for player_id in missed_player_ids:
+                loaded[player_id] = []
+            for row in rows:
+                loaded[row['player_id']].append(format_inventory_item(row))
+        finally:
+            if cache is not None:
+                # only rows read on the primary are cached, as in get_inventory
+                for player_id in missed_player_ids:
+                    cache.end_load(player_id, None if from_replica else loaded.get(player_id))
+        inventories.update(loaded)
+
+    # all inventories are loaded above, the response is encoded and written player by player
+    encode, content_type = serializer.get_encoder(request)
+    if content_type == serializer.MSGPACK_CONTENT_TYPE:
+        # msgpack arrays are prefixed with their length instead of being closed
+        head, separator, tail = serializer.pack_response_head('inventories', len(player_ids)), b'', b''
+    else:
+        head, separator, tail = b'{"status": "OK", "data": {"inventories": [', b', ', b']}}'
+    response = web.StreamResponse(status=200)
+    response.content_type = content_type
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    await response.write(head)
+    for i, player_id in enumerate(player_ids):
+        chunk = encode({'player_id': player_id, 'inventory': inventories[player_id]})
+        if i > 0 and separator:
+            chunk = separator + chunk
+        await response.write(chunk)
+    if tail:
+        await response.write(tail)
+    await response.write_eof()
+    return response
 
 
 async def grant_item_stored_trx(request):
     try:
         # Parse the JSON request body
-        data = await request.json()
+        data = await serializer.read_json(request)
 
         # Validate and retrieve player_id, item_code, and amount from the request
         player_id = data.get('player_id')
@@ -42,37 +217,30 @@ async def grant_item_stored_trx(request):
         ext_trx_id = data.get('ext_trx_id')
         inventory_type = data.get('inventory_type', 'consumable')
         if player_id is None or item_code is None or amount is None:
-            return web.json_response({
+            return error_response(request, {
                 'status': 'error',
                 'error_code': '400',
                 'error_message': 'Missing player_id, item_code or amount',
                 'context': {}
             }, status=400)
 
-        is_duplicate = False
+        grant = Grant(player_id, item_code, amount, ext_trx_id, inventory_type)
         async with request.app.db_pool.acquire() as conn:
-            async with conn.transaction():
-                try:
-                    await conn.fetchrow("""
-                        SELECT insert_inventory($1, $2, $3, $4, $5);
-                    """, player_id, ext_trx_id, inventory_type, item_code, amount)
-                except asyncpg.exceptions.IntegrityConstraintViolationError:
-                    is_duplicate = True
-    
-        if is_duplicate:
-            logging.info('Duplicate request detected when trying to add_item player_id: %s, item_code: %s, '
-                            'inventory_type: %s, ext_trx_id: %s', player_id, item_code,
-                            inventory_type, ext_trx_id)
+            is_duplicate = await write_grant_stored_proc(conn, grant)
+            read_token = await get_read_token(request.app, conn)
+
+        if not is_duplicate:
+            invalidate_inventory_cache(request.app, player_id)
 
         # Return a success response
-        return web.json_response({
-            'status': 'OK',
-            'data': {}
-        })
+        return write_response(request, {}, read_token)
 
+    except ApiBaseError:
+        # e.g. 503 on pool acquire timeout, rendered by error_middleware
+        raise
     except Exception as e:
         logging.exception(e)
-        return web.json_response({
+        return error_response(request, {
             'status': 'error',
             'error_code': '500',
             'error_message': str(e),
@@ -80,10 +248,23 @@ async def grant_item_stored_trx(request):
         }, status=500)
     
 
+async def write_single_grant(app, grant):
+    # returns is_duplicate and the read token
+    # Connect to the PostgreSQL database
+    async with app.db_pool.acquire() as conn:
+        write_grant = SINGLE_GRANT_WRITERS[app.grant_engine]
+        is_duplicate = await write_grant(conn, grant, log_events=app.event_log_writer is None)
+        read_token = await get_read_token(app, conn)
+    if not is_duplicate and app.event_log_writer is not None:
+        # the event is written after commit by the async writer, outside of the grant transaction
+        await app.event_log_writer.put(grant_event(grant))
+    return is_duplicate, read_token
+
+
 async def grant_item(request):
     try:
         # Parse the JSON request body
-        data = await request.json()
+        data = await serializer.read_json(request)
 
         # Validate and retrieve player_id, item_code, and amount from the request
         player_id = data.get('player_id')
@@ -92,65 +273,257 @@ async def grant_item(request):
         ext_trx_id = data.get('ext_trx_id')
         inventory_type = data.get('inventory_type', 'consumable')
         if player_id is None or item_code is None or amount is None:
-            return web.json_response({
+            return error_response(request, {
                 'status': 'error',
                 'error_code': '400',
                 'error_message': 'Missing player_id, item_code or amount',
                 'context': {}
             }, status=400)
 
-        is_duplicate = False
+        recent_trx_filter = request.app.recent_trx_filter
+        if recent_trx_filter is not None and recent_trx_filter.is_duplicate(player_id, ext_trx_id):
+            logging.info('Duplicate request detected by recent ext_trx_id filter player_id: %s, item_code: %s, '
+                         'inventory_type: %s, ext_trx_id: %s', player_id, item_code, inventory_type, ext_trx_id)
+            # no token, it would cost a DB round-trip the filter exists to avoid
+            return write_response(request, {}, None)
 
-        # Connect to the PostgreSQL database
-        async with request.app.db_pool.acquire() as conn:
-            async with conn.transaction():
-                try:
-                    await conn.fetchrow("""
-                        INSERT INTO player_inventory_trx (player_id, ext_trx_id)
-                        VALUES ($1, $2)
-                    """, player_id, ext_trx_id)
-                except asyncpg.exceptions.IntegrityConstraintViolationError:
-                    is_duplicate = True
-
-                if not is_duplicate:
-                    # Perform an upsert operation to grant items to the player's inventory
-                    res = await conn.fetchrow("""
-                        INSERT INTO player_inventory (player_id, inventory_type, item_code, amount)
-                        VALUES ($1, $2, $3, $4)
-                        ON CONFLICT (player_id, item_code)
-                        DO UPDATE SET amount = player_inventory.amount + $4
-                        RETURNING *, (xmax = 0) AS inserted;
-                    """, player_id, inventory_type, item_code, amount)
-                    if res['inserted']:
-                        logging.info('A new inventory created for player_id: %s, item_code: %s, inventory_type: %s, '
-                                     'ext_trx_id: %s', player_id, item_code, inventory_type, ext_trx_id)
-                    else:
-                        logging.info('An existing inventory updated for player_id: %s, item_code: %s, '
-                                     'inventory_type: %s, ext_trx_id: %s', player_id, item_code,
-                                     inventory_type, ext_trx_id)
-
-                    sql = """
-                        INSERT INTO log_player_event 
-                            (player_id, event_type, event_value_int, meta_data, ext_trx_id)
-                        VALUES ($1, $2, $3, $4, $5)
-                    """
-                    await conn.execute(sql, player_id, 'inventory_granted', amount,
-                                       {'inventory_type': inventory_type, 'item_code': item_code}, ext_trx_id)
-                else:
-                    logging.info('Duplicate request detected when trying to add_item player_id: %s, item_code: %s, '
-                                 'inventory_type: %s, ext_trx_id: %s', player_id, item_code,
-                                 inventory_type, ext_trx_id)
+        if request.app.grant_batcher is not None:
+            # group-commit mode, the grant is written together with other queued grants
+            is_duplicate, read_token = await request.app.grant_batcher.submit(player_id, item_code, amount,
+                                                                              ext_trx_id, inventory_type)
+            if recent_trx_filter is not None:
+                recent_trx_filter.remember(player_id, ext_trx_id, is_duplicate)
+            if not is_duplicate:
+                invalidate_inventory_cache(request.app, player_id)
+            return write_response(request, {}, read_token)
+
+        grant = Grant(player_id, item_code, amount, ext_trx_id, inventory_type)
+        if request.app.hot_rows is not None:
+            # merged with other grants and consumes of the row if it is being written right now
+            is_duplicate, read_token = await request.app.hot_rows.run(
+                grant, lambda: write_single_grant(request.app, grant))
+        else:
+            is_duplicate, read_token = await write_single_grant(request.app, grant)
+
+        if recent_trx_filter is not None:
+            recent_trx_filter.remember(player_id, ext_trx_id, is_duplicate)
+        if not is_duplicate:
+            invalidate_inventory_cache(request.app, player_id)
 
         # Return a success response
-        return web.json_response({
-            'status': 'OK',
-            'data': {}
-        })
+        return write_response(request, {}, read_token)
 
+    except ApiBaseError:
+        raise
     except Exception as e:
-        return web.json_response({
+        return error_response(request, {
             'status': 'error',
             'error_code': '500',
             'error_message': str(e),
             'context': {}
         }, status=500)
+
+
+async def grant_item_batch(request):
+    data = await serializer.read_json(request)
+    if not isinstance(data, list):
+        raise ApiValidationError(error_message='Request body must be a list of grants')
+    if len(data) > MAX_GRANT_BATCH_SIZE:
+        raise ApiValidationError(
+            error_message=f'Too many grants in batch, max is {MAX_GRANT_BATCH_SIZE}',
+            context={'max_batch_size': MAX_GRANT_BATCH_SIZE, 'batch_size': len(data)}
+        )
+
+    grants = []
+    for i, item in enumerate(data):
+        if not isinstance(item, dict):
+            raise ApiValidationError(error_message='Grant must be an object', context={'index': i})
+        player_id = item.get('player_id')
+        item_code = item.get('item_code')
+        amount = item.get('amount')
+        if player_id is None or item_code is None or amount is None:
+            raise ApiValidationError(
+                error_message='Missing player_id, item_code or amount',
+                context={'index': i}
+            )
+        grants.append(Grant(player_id, item_code, amount, item.get('ext_trx_id'),
+                            item.get('inventory_type', 'consumable')))
+
+    duplicates = []
+    read_token = None
+    if grants:
+        async with request.app.db_pool.acquire() as conn:
+            async with conn.transaction():
+                write_grants = BATCH_GRANT_WRITERS[request.app.grant_engine]
+                duplicates = await write_grants(conn, grants, log_events=request.app.event_log_writer is None)
+            read_token = await get_read_token(request.app, conn)
+        if request.app.event_log_writer is not None:
+            for event in grant_events(grants, duplicates):
+                await request.app.event_log_writer.put(event)
+
+    results = []
+    granted_player_ids = set()
+    recent_trx_filter = request.app.recent_trx_filter
+    for grant, is_duplicate in zip(grants, duplicates):
+        if recent_trx_filter is not None:
+            recent_trx_filter.remember(grant.player_id, grant.ext_trx_id, is_duplicate)
+        if not is_duplicate:
+            granted_player_ids.add(grant.player_id)
+        results.append({
+            'player_id': grant.player_id,
+            'ext_trx_id': grant.ext_trx_id,
+            'status': 'duplicate' if is_duplicate else 'granted'
+        })
+    for player_id in granted_player_ids:
+        invalidate_inventory_cache(request.app, player_id)
+
+    return write_response(request, {'results': results}, read_token)
+
+
+async def write_single_consume(app, consume):
+    # returns inventory_type (None for a duplicate) and the read token
+    async with app.db_pool.acquire() as conn:
+        inventory_type = await write_consume(conn, consume, log_events=app.event_log_writer is None)
+        read_token = await get_read_token(app, conn)
+    if inventory_type is not None and app.event_log_writer is not None:
+        await app.event_log_writer.put(consume_event(consume, inventory_type))
+    return inventory_type, read_token
+
+
+async def consume_item(request):
+    data = await serializer.read_json(request)
+
+    player_id = data.get('player_id')
+    item_code = data.get('item_code')
+    amount = data.get('amount')
+    ext_trx_id = data.get('ext_trx_id')
+    if player_id is None or item_code is None or amount is None or ext_trx_id is None:
+        raise ApiValidationError(error_message='Missing player_id, item_code, amount or ext_trx_id')
+    if amount <= 0:
+        raise ApiValidationError(error_message='Amount must be positive', context={'amount': amount})
+
+    recent_trx_filter = request.app.recent_trx_filter
+    if recent_trx_filter is not None and recent_trx_filter.is_duplicate(player_id, ext_trx_id):
+        log_duplicate_consume(Consume(player_id, item_code, amount, ext_trx_id))
+        inc_inventory_consume('duplicate')
+        return write_response(request, {}, None)
+
+    consume = Consume(player_id, item_code, amount, ext_trx_id)
+    try:
+        if request.app.hot_rows is not None:
+            inventory_type, read_token = await request.app.hot_rows.run(
+                consume, lambda: write_single_consume(request.app, consume))
+        else:
+            inventory_type, read_token = await write_single_consume(request.app, consume)
+    except ApiLogicalError:
+        inc_inventory_consume('insufficient_amount')
+        raise
+
+    is_duplicate = inventory_type is None
+    if recent_trx_filter is not None:
+        recent_trx_filter.remember(player_id, ext_trx_id, is_duplicate)
+    if is_duplicate:
+        inc_inventory_consume('duplicate')
+    else:
+        inc_inventory_consume('consumed')
+        invalidate_inventory_cache(request.app, player_id)
+
+    return write_response(request, {}, read_token)
+
+
+async def get_catalog(request):
+    snapshot = request.app.catalog.snapshot
+    if serializer.accepts_msgpack(request):
+        return etag_response(request, snapshot.msgpack_body, snapshot.msgpack_etag,
+                             serializer.MSGPACK_CONTENT_TYPE)
+    return etag_response(request, snapshot.body, snapshot.etag)
+
+
+async def create_catalog_item(request):
+    args = parse_catalog_item(await serializer.read_json(request))
+    async with request.app.db_pool.acquire() as conn:
+        created = await conn.fetchval(statements.INSERT_CATALOG_ITEM, *args)
+    if created is None:
+        raise ApiLogicalError(error_message='Catalog item already exists', context={'item_code': args[0]})
+    await request.app.catalog.reload()
+    return write_response(request, {'version': request.app.catalog.snapshot.version}, None)
+
+
+async def update_catalog_item(request):
+    args = parse_catalog_item(await serializer.read_json(request))
+    async with request.app.db_pool.acquire() as conn:
+        updated = await conn.fetchval(statements.UPDATE_CATALOG_ITEM, *args)
+    if updated is None:
+        raise ApiLogicalError(error_message='Catalog item not found', context={'item_code': args[0]})
+    await request.app.catalog.reload()
+    return write_response(request, {'version': request.app.catalog.snapshot.version}, None)
+
+
+async def delete_catalog_item(request):
+    item_code = (await serializer.read_json(request)).get('item_code')
+    if item_code is None:
+        raise ApiValidationError(error_message='Missing item_code')
+    async with request.app.db_pool.acquire() as conn:
+        deleted = await conn.fetchval(statements.DELETE_CATALOG_ITEM, item_code)
+    if deleted is None:
+        raise ApiLogicalError(error_message='Catalog item not found', context={'item_code': item_code})
+    await request.app.catalog.reload()
+    return write_response(request, {'version': request.app.catalog.snapshot.version}, None)
+
+
+async def prepare_ndjson_response(request):
+    response = web.StreamResponse(status=200)
+    response.content_type = NDJSON_CONTENT_TYPE
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    return response
+
+
+async def get_event_history(request):
+    history = request.app.event_history
+    args, page_size = history.parse_page(await serializer.read_json(request))
+    history.acquire()
+    rows = 0
+    response = None
+    try:
+        async with request.app.db_pool.acquire() as conn:
+            # a server-side cursor fetches prefetch rows at a time and they are sent before the next
+            # fetch, so memory doesn't grow with the page and a slow client slows the cursor down
+            async with conn.transaction(readonly=True):
+                lines = []
+                last_row = None
+                next_cursor = None
+                # one row more than the page, it only tells that there is a next page
+                async for row in conn.cursor(statements.GET_PLAYER_EVENTS, *args, page_size + 1,
+                                             prefetch=history.prefetch):
+                    if rows == page_size:
+                        next_cursor = encode_cursor(last_row['event_time'], last_row['id'])
+                        break
+                    lines.append(format_event(row))
+                    last_row = row
+                    rows += 1
+                    if len(lines) >= history.prefetch:
+                        if response is None:
+                            response = await prepare_ndjson_response(request)
+                        await response.write(b''.join(lines))
+                        lines = []
+        if response is None:
+            response = await prepare_ndjson_response(request)
+        # the last line tells the page is complete, a page cut by an error has no such line
+        lines.append(serializer.dumps({'status': 'OK', 'rows': rows, 'next_cursor': next_cursor}) + b'\n')
+        await response.write(b''.join(lines))
+        await response.write_eof()
+    except Exception as e:
+        inc_event_history_export('failed', rows)
+        if response is None or isinstance(e, ConnectionResetError):
+            raise
+        # status 200 is already sent, so the error goes as the last line
+        logging.exception('Event history export of player_id %s failed after %s rows', args[0], rows)
+        err = ApiInternalError(error_message='Event history export failed', context={'rows': rows})
+        await response.write(serializer.dumps(err.as_dict()) + b'\n')
+        await response.write_eof()
+        return response
+    finally:
+        history.release()
+    inc_event_history_export('ok', rows)
+    return response